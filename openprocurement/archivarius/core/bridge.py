@@ -8,47 +8,85 @@ import os
 import argparse
 import uuid
 from ConfigParser import ConfigParser, NoOptionError
+from couchdb.client import Row
 from datetime import datetime
 from functools import partial
 from gevent import spawn, sleep
 from gevent.pool import Pool
 from gevent.queue import Queue
+from gevent.pywsgi import WSGIServer
 from itertools import ifilter
+from json import dumps
 from openprocurement_client.exceptions import RequestFailed
 from openprocurement.edge.utils import prepare_couchdb_views
 from pkg_resources import iter_entry_points
 from pytz import timezone
+from time import time
 from urlparse import urlparse
-from .workers import ArchiveWorker
+from .checkpoints import ScanCheckpoint
+from .metrics import Metrics, metrics_app
+from .scheduler import RetryScheduler
+from .spool import DeadLetterSpool, DumpSpool, SpillingQueue
+from .storages.composite import composite
+from .workers import CDB_STAGES, DUMP_ON_DELETE_STAGES, STAGES, ArchivePipeline, ArchiveWorker
 from .client import APIClient
 from .db import prepare_couchdb, ConfigError
 
 LOGGER = logging.getLogger(__name__)
 TZ = timezone(os.environ['TZ'] if 'TZ' in os.environ else 'Europe/Kiev')
+CHANGES_DOC_ID = '_local/archivarius_changes'
 
 WORKER_CONFIG = {
+    'bulk_delete_interval': 5,
+    'bulk_delete_limit': 100,
+    'bulk_get_limit': 100,
     'client_dec_step_timeout': 0.02,
     'client_inc_step_timeout': 0.1,
     'drop_threshold_client_cookies': 2,
+    'dump_on_delete': False,
+    'dump_delete_concurrency': 2,
+    'dump_get_concurrency': 2,
+    'edge_delete_concurrency': 1,
+    'edge_get_concurrency': 1,
+    'public_save_concurrency': 1,
     'queue_timeout': 3,
     'retries_count': 10,
     'retry_default_timeout': 3,
+    'secret_save_concurrency': 2,
+    'stage_queue_size': 100,
     'worker_sleep': 5,
 }
 
 DEFAULTS = {
     'api_key': '',
+    'changes_heartbeat': 10000,
+    'changes_save_interval': 10,
+    'checkpoint_interval': 0,
     'couch_url': 'http://127.0.0.1:5984',
     'db_name': 'edge_db',
     'db_archive_name': 'archive_db',
+    'dead_letters_path': '',
+    'dump_spool_path': '',
+    'follow': False,
+    'follow_sweep_interval': 3600,
+    'metrics_host': '127.0.0.1',
+    'metrics_port': 0,
     'queues_controller_timeout': 60,
     'resource_items_queue_size': 10000,
     'retry_resource_items_queue_size': -1,
+    'retry_spool_memory_limit': 10000,
+    'retry_spool_path': '',
     'retry_workers_max': 2,
     'retry_workers_min': 1,
     'retry_workers_pool': 2,
+    'run_summary_path': '',
+    'scan_include_docs': False,
+    'scan_partitions': 1,
+    'secret_compression': '',
+    'secret_quorum': 'all',
     'user_agent': 'ArchivariusBridge',
     'watch_interval': 10,
+    'worker_pipeline': False,
     'workers_dec_threshold': 35,
     'workers_inc_threshold': 75,
     'workers_max': 3,
@@ -71,13 +109,11 @@ class ArchivariusBridge(object):
 
         # Workers settings
         for key in WORKER_CONFIG:
-            self.workers_config[key] = (self.config_get(key) or
-                                        WORKER_CONFIG[key])
+            self.workers_config[key] = self.config_get_value(key, WORKER_CONFIG[key])
 
         # Init config
         for key in DEFAULTS:
-            value = self.config_get(key)
-            setattr(self, key, type(DEFAULTS[key])(value) if value else DEFAULTS[key])
+            setattr(self, key, self.config_get_value(key, DEFAULTS[key]))
 
         # Pools
         self.workers_pool = Pool(self.workers_max)
@@ -90,14 +126,29 @@ class ArchivariusBridge(object):
             self.resource_items_queue = Queue()
         else:
             self.resource_items_queue = Queue(self.resource_items_queue_size)
-        if self.retry_resource_items_queue_size == -1:
+        if self.retry_spool_path:
+            self.retry_resource_items_queue = SpillingQueue(self.retry_spool_path,
+                                                            self.retry_spool_memory_limit)
+        elif self.retry_resource_items_queue_size == -1:
             self.retry_resource_items_queue = Queue()
         else:
             self.retry_resource_items_queue = Queue(
                 self.retry_resource_items_queue_size)
+        self.retry_scheduler = RetryScheduler(self.retry_resource_items_queue)
+        self.dead_letters = DeadLetterSpool(self.dead_letters_path) if self.dead_letters_path else None
+        self.dump_spool = None
+        if self.workers_config['dump_on_delete']:
+            if not self.dump_spool_path:
+                raise ConfigError('Option \'dump_on_delete\' requires \'dump_spool_path\'.')
+            self.dump_spool = DumpSpool(self.dump_spool_path)
+        # Ids of items queued, retried or being archived
+        self.in_flight = set()
+        self.metrics = Metrics()
+        self.api_clients = []
 
         # Default values for statistic variables
         for key in ('droped',
+                    'skiped',
                     'add_to_resource_items_queue',
                     'add_to_retry',
                     'exceptions_count',
@@ -118,20 +169,36 @@ class ArchivariusBridge(object):
         self.db = prepare_couchdb(self.couch_url, self.db_name, LOGGER)
         self.archive_db = prepare_couchdb(self.couch_url, self.db_archive_name)
 
-        # find storages for secret db
-        for entry_point in iter_entry_points('openprocurement.archivarius.storages', self.secret_storage):
-            storage = entry_point.load()
-            storage(self)
+        # find storages for secret db, several ones are written together
+        secret_storages = []
+        for name in self.secret_storage.split(','):
+            for entry_point in iter_entry_points('openprocurement.archivarius.storages', name.strip()):
+                storage = entry_point.load()
+                self.secret_archive = None
+                storage(self)
+                if self.secret_archive is not None:
+                    secret_storages.append((entry_point.name, self.secret_archive))
+        if len(secret_storages) > 1:
+            composite(self, secret_storages)
+        elif secret_storages:
+            self.secret_archive = secret_storages[0][1]
 
         self.resources = {}
         for entry_point in iter_entry_points('openprocurement.archivarius.resources'):
+            filter_func = entry_point.load()
             self.resources[entry_point.name] = {
-                'filter': entry_point.load(),
+                'filter': filter_func,
+                'view_options': getattr(filter_func, 'view_options', None),
                 'view_path': '_design/{}/_view/by_dateModified'.format(entry_point.name)
             }
         for resource in self.resources:
             prepare_couchdb_views(self.couch_url + '/' + self.db_name, resource, LOGGER)
 
+        self.checkpoints = {}
+        if self.checkpoint_interval:
+            for resource in self.resources:
+                self.checkpoints[resource] = ScanCheckpoint(self.db, resource)
+
     def create_api_client(self):
         client_user_agent = self.user_agent + '/' + self.bridge_id + '/' + uuid.uuid4().hex
         timeout = 0.1
@@ -142,9 +209,11 @@ class ArchivariusBridge(object):
                                        api_version=self.api_version,
                                        resource='RESOURCE',
                                        key=self.api_key)
-                self.api_clients_queue.put({
+                api_client_dict = {
                     'client': api_client,
-                    'request_interval': 0})
+                    'request_interval': 0}
+                self.api_clients.append(api_client_dict)
+                self.api_clients_queue.put(api_client_dict)
                 LOGGER.info('Started api_client {}'.format(
                     api_client.session.headers['User-Agent']))
                 break
@@ -156,75 +225,395 @@ class ArchivariusBridge(object):
                 timeout = timeout * 2
                 sleep(timeout)
 
+    def pipeline_api_clients_count(self):
+        # Each greenlet of cdb stages of every pipeline worker has own client
+        stages = DUMP_ON_DELETE_STAGES if self.workers_config['dump_on_delete'] else STAGES
+        concurrency = sum(max(self.workers_config['{}_concurrency'.format(stage)], 1)
+                          for stage in CDB_STAGES if stage in stages)
+        return concurrency * max(len(self.workers_pool) + len(self.retry_workers_pool), 1)
+
     def fill_api_clients_queue(self):
+        if self.worker_pipeline:
+            while len(self.api_clients) < self.pipeline_api_clients_count():
+                self.create_api_client()
+            return
         while self.api_clients_queue.qsize() == 0:
             self.create_api_client()
 
-    def fill_resource_items_queue(self, resource):
+    def fill_resource_items_queue(self, resource, resume=True):
         start_time = datetime.now(TZ)
-        rows = self.db.iterview(self.resources[resource]['view_path'], 10 ** 3)
+        view_options = {'include_docs': True} if self.scan_include_docs else {}
+        # Resource filter may narrow the scan to candidate keys
+        # (startkey, endkey, ...) so the filter only does the final check
+        if self.resources[resource].get('view_options'):
+            view_options.update(self.resources[resource]['view_options'](time=start_time))
+        # Resume interrupted scan from saved checkpoint, catch-up sweeps
+        # always scan whole key range
+        checkpoint = self.checkpoints.get(resource)
+        if checkpoint is not None and resume:
+            position = checkpoint.load()
+            if position and ('startkey' not in view_options or position[0] >= view_options['startkey']):
+                view_options['startkey'], view_options['startkey_docid'] = position
+        partitions = self.get_scan_partitions(resource, view_options)
+        if checkpoint is not None:
+            for partition, partition_options in enumerate(partitions):
+                checkpoint.start(partition, partition_options)
+        for partition, partition_options in enumerate(partitions[1:], 1):
+            self.filter_workers_pool.spawn(self.scan_resource_items, resource,
+                                           start_time, partition_options, partition)
+        self.scan_resource_items(resource, start_time, partitions[0])
+
+    def get_scan_partitions(self, resource, view_options):
+        # Split view key range into equal time buckets between first and
+        # last dateModified found in the view
+        if self.scan_partitions < 2:
+            return [view_options]
+        view_path = self.resources[resource]['view_path']
+        first_options = dict((key, value) for key, value in view_options.items()
+                             if key in ('startkey', 'endkey', 'inclusive_end'))
+        first = list(self.db.view(view_path, limit=1, **first_options))
+        last_options = {'limit': 1, 'descending': True}
+        if 'endkey' in view_options:
+            last_options['startkey'] = view_options['endkey']
+        if 'startkey' in view_options:
+            last_options['endkey'] = view_options['startkey']
+        last = list(self.db.view(view_path, **last_options))
+        if not first or not last:
+            return [view_options]
+        try:
+            first_date = datetime.strptime(first[0].key[:19], '%Y-%m-%dT%H:%M:%S')
+            last_date = datetime.strptime(last[0].key[:19], '%Y-%m-%dT%H:%M:%S')
+        except ValueError:
+            LOGGER.warning('Can\'t split {} view by dateModified, scan it as whole.'.format(resource))
+            return [view_options]
+        step = (last_date - first_date) // self.scan_partitions
+        if not step:
+            return [view_options]
+        bounds = [(first_date + step * i).isoformat() for i in range(1, self.scan_partitions)]
+        partitions = []
+        for startkey, endkey in zip([None] + bounds, bounds + [None]):
+            partition_options = dict(view_options)
+            if startkey is not None:
+                partition_options['startkey'] = startkey
+                partition_options.pop('startkey_docid', None)
+            if endkey is not None:
+                partition_options['endkey'] = endkey
+                partition_options['inclusive_end'] = False
+            partitions.append(partition_options)
+        LOGGER.info('Scan {} view in {} partitions: {}'.format(resource, len(partitions), ', '.join(bounds)))
+        return partitions
+
+    def scan_resource_items(self, resource, start_time, view_options, partition=0):
+        checkpoint = self.checkpoints.get(resource)
+        rows = self.db.iterview(self.resources[resource]['view_path'], 10 ** 3, **view_options)
+        if checkpoint is not None:
+            rows = self.track_scan_position(rows, checkpoint, partition)
         filter_func = partial(self.resources[resource]['filter'], time=start_time)
         for row in ifilter(filter_func, rows):
-            self.resource_items_queue.put({
+            resource_item = {
                 'id': row.id,
                 'dateModified': row.key,
                 'resource': resource
-            })
-            self.log_dict['add_to_resource_items_queue'] += 1
+            }
+            if self.scan_include_docs:
+                # Worker skips its own edge fetch for items with doc
+                resource_item['doc'] = row.doc
+            self.put_resource_item(resource_item, checkpoint)
+        if checkpoint is not None:
+            checkpoint.finish(partition)
+
+    def put_resource_item(self, resource_item, checkpoint=None):
+        if resource_item['id'] in self.in_flight:
+            LOGGER.debug('{} {} already in flight, skip.'.format(resource_item['resource'],
+                                                                 resource_item['id']))
+            self.log_dict['skiped'] += 1
+            self.metrics.inc('skiped', resource_item['resource'])
+            return False
+        resource_item['id'] = intern(str(resource_item['id']))
+        self.in_flight.add(resource_item['id'])
+        if checkpoint is not None:
+            checkpoint.add(resource_item)
+        self.resource_items_queue.put(resource_item)
+        self.log_dict['add_to_resource_items_queue'] += 1
+        self.metrics.inc('add_to_resource_items_queue', resource_item['resource'])
+        return True
+
+    def put_changed_resource_item(self, change):
+        resource_item_doc = change.get('doc')
+        if change.get('deleted') or not resource_item_doc:
+            return
+        resource = '{}s'.format(resource_item_doc.get('doc_type', '').lower())
+        if resource not in self.resources or 'dateModified' not in resource_item_doc or \
+                resource_item_doc.get('status') == 'draft':
+            return
+        # Changed doc stands for by_dateModified row, filter gets whole doc as value
+        row = Row(id=resource_item_doc['_id'], key=resource_item_doc['dateModified'],
+                  value=resource_item_doc, doc=resource_item_doc)
+        if not self.resources[resource]['filter'](row, time=datetime.now(TZ)):
+            return
+        resource_item = {
+            'id': row.id,
+            'dateModified': row.key,
+            'resource': resource
+        }
+        if self.scan_include_docs:
+            resource_item['doc'] = resource_item_doc
+        self.put_resource_item(resource_item)
+
+    def follow_changes(self):
+        # Items queued from changes are not tracked by since sequence,
+        # lost ones are picked up by next catch-up sweep
+        changes_doc = self.db.get(CHANGES_DOC_ID, {'_id': CHANGES_DOC_ID})
+        since = changes_doc.get('since', 'now')
+        LOGGER.info('Follow edge db changes since {}'.format(since))
+        saved_at = time()
+        while True:
+            try:
+                for change in self.db.changes(feed='continuous', since=since, include_docs=True,
+                                              heartbeat=self.changes_heartbeat):
+                    if 'last_seq' in change:
+                        since = change['last_seq']
+                        break
+                    since = change['seq']
+                    self.put_changed_resource_item(change)
+                    if time() - saved_at >= self.changes_save_interval:
+                        changes_doc['since'] = since
+                        self.db.save(changes_doc)
+                        saved_at = time()
+            except Exception as e:
+                LOGGER.error('Error while following edge db changes: {}'.format(e.message))
+                self.log_dict['exceptions_count'] += 1
+                sleep(self.watch_interval)
+
+    def sweep_controller(self):
+        # Catch up items which expire by time alone and have no changes
+        while True:
+            sleep(self.follow_sweep_interval)
+            if len(self.filter_workers_pool) > 0:
+                LOGGER.info('Previous sweep is still running, skip catch-up sweep.')
+                continue
+            LOGGER.info('Start catch-up sweep.')
+            for resource in self.resources:
+                self.filter_workers_pool.spawn(self.fill_resource_items_queue, resource=resource, resume=False)
+
+    def track_scan_position(self, rows, checkpoint, partition):
+        for row in rows:
+            checkpoint.scanned(partition, row)
+            yield row
+
+    def resource_item_done(self, resource_item):
+        self.in_flight.discard(resource_item['id'])
+        checkpoint = self.checkpoints.get(resource_item['resource'])
+        if checkpoint is not None:
+            checkpoint.done(resource_item)
+
+    def save_checkpoints(self):
+        for resource, checkpoint in self.checkpoints.items():
+            try:
+                checkpoint.save()
+            except Exception as e:
+                LOGGER.error('Failed save {} scan checkpoint: {}'.format(resource, e.message))
+
+    def checkpoints_controller(self):
+        while True:
+            sleep(self.checkpoint_interval)
+            self.save_checkpoints()
+
+    def create_worker(self, resource_items_queue):
+        worker_class = ArchivePipeline if self.worker_pipeline else ArchiveWorker
+        return worker_class.spawn(self.api_clients_queue,
+                                  resource_items_queue,
+                                  self.db, self.archive_db, self.secret_archive, self.workers_config,
+                                  self.retry_resource_items_queue,
+                                  self.log_dict,
+                                  done_callback=self.resource_item_done,
+                                  retry_scheduler=self.retry_scheduler,
+                                  dead_letters=self.dead_letters,
+                                  metrics=self.metrics,
+                                  dump_spool=self.dump_spool)
+
+    def metrics_gauges(self):
+        gauges = [
+            ('queue_items', {'queue': 'main'}, self.resource_items_queue.qsize()),
+            ('queue_items', {'queue': 'retry'}, self.retry_resource_items_queue.qsize()),
+            ('queue_items', {'queue': 'retry_scheduled'}, self.retry_scheduler.pending),
+            ('queue_items', {'queue': 'api_clients'}, self.api_clients_queue.qsize()),
+            ('in_flight_items', {}, len(self.in_flight)),
+            ('workers', {'pool': 'main'}, len(self.workers_pool)),
+            ('workers', {'pool': 'retry'}, len(self.retry_workers_pool)),
+            ('workers', {'pool': 'filter'}, len(self.filter_workers_pool)),
+        ]
+        for api_client_dict in self.api_clients:
+            gauges.append(('api_client_request_interval',
+                           {'client': api_client_dict['client'].session.headers['User-Agent']},
+                           api_client_dict['request_interval']))
+        for pool_name, pool in (('main', self.workers_pool), ('retry', self.retry_workers_pool)):
+            stages = {}
+            for worker in pool:
+                if isinstance(worker, ArchivePipeline):
+                    for stage, queued, running in worker.stages_status():
+                        stages[stage] = map(sum, zip(stages.get(stage, (0, 0)), (queued, running)))
+            for stage, (queued, running) in stages.items():
+                gauges.append(('stage_queue_items', {'pool': pool_name, 'stage': stage}, queued))
+                gauges.append(('stage_running', {'pool': pool_name, 'stage': stage}, running))
+        return gauges
+
+    def start_metrics_server(self):
+        server = WSGIServer((self.metrics_host, self.metrics_port), metrics_app(self), log=None)
+        server.start()
+        LOGGER.info('Serving metrics on http://{}:{}/metrics'.format(self.metrics_host, self.metrics_port))
+        return server
+
+    def log_retry_scheduler(self):
+        next_due = self.retry_scheduler.next_due()
+        LOGGER.info('Retry scheduler contains {} pending items{}'.format(
+            self.retry_scheduler.pending,
+            ', next due in {:.1f} sec'.format(max(next_due - time(), 0)) if next_due else ''))
+
+    def log_pipeline_stages(self):
+        for pool_name, pool in (('main', self.workers_pool), ('retry', self.retry_workers_pool)):
+            for worker in pool:
+                if isinstance(worker, ArchivePipeline):
+                    LOGGER.info('Pipeline {} worker stages: {}'.format(pool_name, ', '.join(
+                        '{} - {} queued, {} running'.format(stage, queued, running)
+                        for stage, queued, running in worker.stages_status())))
+
+    def log_stage_latency(self):
+        for stage, resources in sorted(self.metrics.stages_summary().items()):
+            for resource, outcomes in sorted(resources.items()):
+                summary = outcomes['all']
+                LOGGER.info('Stage {} {} latency: p50 - {p50:.3f}, p95 - {p95:.3f}, p99 - {p99:.3f} sec '
+                            '({count} items, {failed} failed)'.format(
+                                stage, resource, failed=outcomes.get('failed', {}).get('count', 0), **summary))
+
+    def write_run_summary(self, started):
+        finished = time()
+        summary = dumps({
+            'started': datetime.fromtimestamp(started, TZ).isoformat(),
+            'finished': datetime.fromtimestamp(finished, TZ).isoformat(),
+            'duration': finished - started,
+            'counters': self.log_dict,
+            'stages': self.metrics.stages_summary()
+        }, indent=2, sort_keys=True)
+        if not self.run_summary_path:
+            LOGGER.info('Run summary: {}'.format(summary))
+            return
+        try:
+            with open(self.run_summary_path, 'w') as summary_file:
+                summary_file.write(summary + '\n')
+        except IOError as e:
+            LOGGER.error('Failed write run summary to {}: {}'.format(self.run_summary_path, e))
 
     def queues_controller(self):
         while True:
             self.fill_api_clients_queue()
             #if self.workers_pool.free_count() > 0 and (self.resource_items_queue.qsize() > int((self.resource_items_queue_size / 100) * self.workers_inc_threshold)):
             if self.resource_items_queue.qsize() > 0 and self.workers_pool.free_count() > 0:
-                w = ArchiveWorker.spawn(self.api_clients_queue,
-                                        self.resource_items_queue,
-                                        self.db, self.archive_db, self.secret_archive, self.workers_config,
-                                        self.retry_resource_items_queue,
-                                        self.log_dict)
+                w = self.create_worker(self.resource_items_queue)
                 self.workers_pool.add(w)
                 LOGGER.info('Queue controller: Create main queue worker.')
             #elif self.resource_items_queue.qsize() < int((self.resource_items_queue_size / 100) * self.workers_dec_threshold):
             elif self.resource_items_queue.qsize() == 0:
-                if len(self.workers_pool) > self.workers_min:
-                    wi = self.workers_pool.greenlets.pop()
-                    wi.shutdown()
+                # Worker stays in pool until its items are archived,
+                # otherwise run() may return while it's still busy
+                running = [w for w in self.workers_pool if not w.exit]
+                if len(running) > self.workers_min:
+                    running[-1].shutdown()
                     LOGGER.info('Queue controller: Kill main queue worker.')
             LOGGER.info('Main resource items queue contains {} items'.format(self.resource_items_queue.qsize()))
             LOGGER.info('Retry resource items queue contains {} items'.format(self.retry_resource_items_queue.qsize()))
-            LOGGER.info('Status: add to queue - {add_to_resource_items_queue}, add to retry - {add_to_retry}, moved to public archive - {moved_to_public_archive}, dumped to secret archive - {dumped_to_secret_archive}, archived - {archived}, exceptions - {exceptions_count}, not found - {not_found_count}'.format(**self.log_dict))
+            self.log_retry_scheduler()
+            self.log_pipeline_stages()
+            self.log_stage_latency()
+            self.metrics.update_rates()
+            LOGGER.info('Status: add to queue - {add_to_resource_items_queue}, skipped in flight - {skiped}, add to retry - {add_to_retry}, moved to public archive - {moved_to_public_archive}, dumped to secret archive - {dumped_to_secret_archive}, archived - {archived}, exceptions - {exceptions_count}, not found - {not_found_count}'.format(**self.log_dict))
             sleep(self.queues_controller_timeout)
 
     def gevent_watcher(self):
         self.fill_api_clients_queue()
         if not self.resource_items_queue.empty() and len(self.workers_pool) < self.workers_min:
-            w = ArchiveWorker.spawn(self.api_clients_queue,
-                                    self.resource_items_queue,
-                                    self.db, self.archive_db, self.secret_archive, self.workers_config,
-                                    self.retry_resource_items_queue,
-                                    self.log_dict)
+            w = self.create_worker(self.resource_items_queue)
             self.workers_pool.add(w)
             LOGGER.info('Watcher: Create main queue worker.')
         if not self.retry_resource_items_queue.empty() and len(self.retry_workers_pool) < self.retry_workers_min:
-            w = ArchiveWorker.spawn(self.api_clients_queue,
-                                    self.retry_resource_items_queue,
-                                    self.db, self.archive_db, self.secret_archive, self.workers_config,
-                                    self.retry_resource_items_queue,
-                                    self.log_dict)
+            w = self.create_worker(self.retry_resource_items_queue)
             self.retry_workers_pool.add(w)
             LOGGER.info('Watcher: Create retry queue worker.')
 
-    def run(self):
+    def replay_dead_letters(self):
+        count = 0
+        for resource_item in self.dead_letters.replay():
+            # Replayed item gets full retries count again
+            resource_item.pop('retries_count', None)
+            resource_item.pop('timeout', None)
+            if self.put_resource_item(resource_item):
+                count += 1
+        LOGGER.info('Replayed {} dead letters.'.format(count))
+
+    def replay_dump_spool(self):
+        # Dumps deleted from cdb by previous run. Ids are taken before scan
+        # starts, so their edge documents aren't queued again without dump.
+        resource_items = list(self.dump_spool.items())
+        for resource_item in resource_items:
+            resource_item['id'] = intern(str(resource_item['id']))
+            self.in_flight.add(resource_item['id'])
+        if resource_items:
+            LOGGER.info('Replay {} spooled dumps.'.format(len(resource_items)))
+            self.filter_workers_pool.spawn(self.put_spooled_items, resource_items)
+
+    def register_spilled_items(self):
+        # Retry items spilled by previous run are still in flight, so scan
+        # doesn't queue them again and checkpoint doesn't pass them
+        count = 0
+        for resource_item in self.retry_resource_items_queue.spilled_items():
+            resource_item['id'] = intern(str(resource_item['id']))
+            self.in_flight.add(resource_item['id'])
+            checkpoint = self.checkpoints.get(resource_item['resource'])
+            if checkpoint is not None:
+                checkpoint.add(resource_item)
+            count += 1
+        if count:
+            LOGGER.info('Registered {} spilled retry items.'.format(count))
+
+    def put_spooled_items(self, resource_items):
+        for resource_item in resource_items:
+            self.resource_items_queue.put(resource_item)
+            self.log_dict['add_to_resource_items_queue'] += 1
+            self.metrics.inc('add_to_resource_items_queue', resource_item['resource'])
+
+    def run(self, replay_dead_letters=False):
+        started = time()
         LOGGER.info('Start Archivarius Bridge',
                     extra={'MESSAGE_ID': 'edge_bridge_start_bridge'})
-        for resource in self.resources:
-            self.filter_workers_pool.spawn(self.fill_resource_items_queue, resource=resource)
+        if replay_dead_letters:
+            if self.dead_letters is None:
+                raise ConfigError('Missing \'dead_letters_path\' option.')
+            self.filter_workers_pool.spawn(self.replay_dead_letters)
+        else:
+            if self.dump_spool is not None:
+                self.replay_dump_spool()
+            if self.retry_spool_path:
+                self.register_spilled_items()
+            for resource in self.resources:
+                self.filter_workers_pool.spawn(self.fill_resource_items_queue, resource=resource)
+        self.retry_scheduler.start()
+        if self.metrics_port:
+            self.start_metrics_server()
         spawn(self.queues_controller)
+        if self.checkpoints:
+            spawn(self.checkpoints_controller)
+        if self.follow:
+            spawn(self.follow_changes)
+            spawn(self.sweep_controller)
         while True:
             self.gevent_watcher()
-            if len(self.filter_workers_pool) == 0 and len(self.workers_pool) == 0 and len(self.retry_workers_pool) == 0:
+            if not self.follow and len(self.filter_workers_pool) == 0 and len(self.workers_pool) == 0 and \
+                    len(self.retry_workers_pool) == 0 and self.retry_scheduler.pending == 0:
                 break
             sleep(self.watch_interval)
+        self.retry_scheduler.shutdown()
+        self.save_checkpoints()
+        self.write_run_summary(started)
 
     def config_get(self, name):
         try:
@@ -232,16 +621,31 @@ class ArchivariusBridge(object):
         except NoOptionError:
             return
 
+    def config_get_value(self, name, default):
+        # Convert option to type of its default value
+        value = self.config_get(name)
+        if not value:
+            return default
+        if isinstance(default, bool):
+            return value.lower() in ('1', 'true', 'yes', 'on')
+        return type(default)(value)
+
 
 def main():
     parser = argparse.ArgumentParser(description='---- Archivarius Bridge ----')
+    parser.add_argument('command', nargs='?', default='run', choices=('run', 'replay-dead-letters'),
+                        help='Archive edge db (default) or feed dropped items back')
     parser.add_argument('config', type=str, help='Path to configuration file')
+    parser.add_argument('--follow', action='store_true',
+                        help='Follow edge db changes instead of exiting after one scan')
     params = parser.parse_args()
     if os.path.isfile(params.config):
         config = ConfigParser()
         config.read([params.config])
+        if params.follow:
+            config.set('main', 'follow', 'true')
         logging.config.fileConfig(params.config)
-        ArchivariusBridge(config).run()
+        ArchivariusBridge(config).run(replay_dead_letters=params.command == 'replay-dead-letters')
 
 
 if __name__ == "__main__":
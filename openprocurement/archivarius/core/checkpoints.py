@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from logging import getLogger
+
+LOGGER = getLogger(__name__)
+
+BEGIN = None  # position before the first row of a view
+
+
+class ScanCheckpoint(object):
+
+    """Low-watermark of by_dateModified scan of one resource.
+
+    Watermark is the smallest (dateModified, id) among rows not scanned yet
+    and items still in flight (queued, retried or being archived), so
+    resuming the view from it never skips unfinished items. It is kept in
+    a _local document of the edge database and removed once the scan is
+    completed.
+    """
+
+    def __init__(self, db, resource):
+        self.db = db
+        self.resource = resource
+        self.doc_id = '_local/archivarius_{}'.format(resource)
+        self.started = False
+        self.positions = {}
+        self.in_flight = {}
+
+    def load(self):
+        doc = self.db.get(self.doc_id)
+        if doc is None:
+            return None
+        LOGGER.info('Resume {} scan from {} {}'.format(self.resource, doc['key'], doc['id']))
+        return doc['key'], doc['id']
+
+    def start(self, partition, view_options):
+        self.started = True
+        if 'startkey' in view_options:
+            self.positions[partition] = (view_options['startkey'],
+                                         view_options.get('startkey_docid', ''))
+        else:
+            self.positions[partition] = BEGIN
+
+    def scanned(self, partition, row):
+        self.positions[partition] = (row.key, row.id)
+
+    def finish(self, partition):
+        self.positions.pop(partition, None)
+
+    def add(self, resource_item):
+        self.in_flight[resource_item['id']] = (resource_item['dateModified'], resource_item['id'])
+
+    def done(self, resource_item):
+        self.in_flight.pop(resource_item['id'], None)
+
+    @property
+    def completed(self):
+        return self.started and not self.positions and not self.in_flight
+
+    def watermark(self):
+        marks = self.in_flight.values() + self.positions.values()
+        if not marks or BEGIN in marks:
+            return None
+        return min(marks)
+
+    def save(self):
+        doc = self.db.get(self.doc_id, {'_id': self.doc_id})
+        if self.completed:
+            if '_rev' in doc:
+                self.db.delete(doc)
+                LOGGER.info('Scan of {} completed, checkpoint removed.'.format(self.resource))
+            return
+        watermark = self.watermark()
+        if watermark is None or (doc.get('key'), doc.get('id')) == watermark:
+            return
+        doc['key'], doc['id'] = watermark
+        self.db.save(doc)
+        LOGGER.info('Saved {} scan checkpoint {} {}'.format(self.resource, doc['key'], doc['id']))
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+from math import ceil, log
+from time import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIX = 'archivarius_'
+RATE_COUNTERS = ('add_to_resource_items_queue', 'archived', 'moved_to_public_archive',
+                 'dumped_to_secret_archive')
+QUANTILES = (0.5, 0.95, 0.99)
+MIN_LATENCY = 0.0001
+BUCKET_FACTOR = 2 ** 0.25
+
+
+def format_sample(name, labels, value):
+    if labels:
+        name = '{}{{{}}}'.format(name, ','.join(
+            '{}="{}"'.format(label, str(labels[label]).replace('\\', '\\\\').replace('"', '\\"'))
+            for label in sorted(labels)))
+    return '{} {}'.format(name, value)
+
+
+class Histogram(object):
+
+    """Log-bucketed latency histogram.
+
+    Bucket bounds grow by BUCKET_FACTOR starting from MIN_LATENCY, so
+    quantiles are off by less than 20% at any scale and histograms are
+    merged by adding bucket counts.
+    """
+
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        if value <= MIN_LATENCY:
+            index = 0
+        else:
+            index = int(ceil(log(value / MIN_LATENCY, BUCKET_FACTOR)))
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] += count
+        self.count += other.count
+        self.total += other.total
+        return self
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding q-th value
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return MIN_LATENCY * BUCKET_FACTOR ** index
+        return 0.0
+
+    def summary(self):
+        summary = {'count': self.count,
+                   'mean': self.total / self.count if self.count else 0.0}
+        for q in QUANTILES:
+            summary['p{}'.format(int(q * 100))] = self.quantile(q)
+        return summary
+
+
+class Metrics(object):
+
+    """Bridge counters broken down by resource.
+
+    Throughput rates are recalculated by update_rates() calls, so they
+    cover the interval between two status updates of the bridge.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.rates = {}
+        self.snapshot = ({}, time())
+
+    def inc(self, key, resource, value=1):
+        self.counters[(key, resource)] += value
+
+    def observe(self, stage, resource, outcome, seconds):
+        self.histograms[(stage, resource, outcome)].add(seconds)
+
+    def stages_summary(self):
+        # {stage: {resource: {outcome: summary}}}, 'all' merges outcomes
+        merged = defaultdict(Histogram)
+        summary = defaultdict(lambda: defaultdict(dict))
+        for (stage, resource, outcome), histogram in self.histograms.items():
+            summary[stage][resource][outcome] = histogram.summary()
+            merged[(stage, resource)].merge(histogram)
+        for (stage, resource), histogram in merged.items():
+            summary[stage][resource]['all'] = histogram.summary()
+        return dict((stage, dict(resources)) for stage, resources in summary.items())
+
+    def update_rates(self):
+        counters, snapshot_time = self.snapshot
+        now = time()
+        if now > snapshot_time:
+            self.rates = dict(
+                (counter, (value - counters.get(counter, 0)) / (now - snapshot_time))
+                for counter, value in self.counters.items() if counter[0] in RATE_COUNTERS)
+        self.snapshot = (dict(self.counters), now)
+
+    def render(self, gauges=()):
+        # gauges are (name, labels, value) tuples from the bridge
+        metrics = defaultdict(list)
+        for (key, resource), value in self.counters.items():
+            name = PREFIX + key + '_total'
+            metrics[(name, 'counter')].append((name, {'resource': resource}, value))
+        for (key, resource), value in self.rates.items():
+            name = PREFIX + key + '_per_second'
+            metrics[(name, 'gauge')].append((name, {'resource': resource}, value))
+        for name, labels, value in gauges:
+            metrics[(PREFIX + name, 'gauge')].append((PREFIX + name, labels, value))
+        name = PREFIX + 'stage_seconds'
+        for (stage, resource, outcome), histogram in self.histograms.items():
+            labels = {'stage': stage, 'resource': resource, 'outcome': outcome}
+            samples = metrics[(name, 'summary')]
+            for q in QUANTILES:
+                samples.append((name, dict(labels, quantile=q), histogram.quantile(q)))
+            samples.append((name + '_count', labels, histogram.count))
+            samples.append((name + '_sum', labels, histogram.total))
+        lines = []
+        for name, kind in sorted(metrics):
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend(format_sample(*sample) for sample in sorted(
+                metrics[(name, kind)], key=lambda sample: (sample[0], sorted(sample[1].items()))))
+        return '\n'.join(lines) + '\n'
+
+
+def metrics_app(bridge):
+    def app(environ, start_response):
+        if environ.get('PATH_INFO') != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not Found\n']
+        body = bridge.metrics.render(bridge.metrics_gauges())
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+        return [body]
+    return app
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from gevent import Greenlet
+from gevent.event import Event
+from heapq import heappop, heappush
+from itertools import count
+from logging import getLogger
+from time import time
+
+LOGGER = getLogger(__name__)
+
+
+class RetryScheduler(Greenlet):
+
+    """Releases retried items into retry queue when they become due.
+
+    Items wait in a min-heap keyed by due time, so one greenlet serves
+    any number of pending retries.
+    """
+
+    def __init__(self, retry_queue):
+        Greenlet.__init__(self)
+        self.retry_queue = retry_queue
+        self.heap = []
+        self.counter = count()
+        self.wakeup = Event()
+        self.exit = False
+
+    @property
+    def pending(self):
+        return len(self.heap)
+
+    def next_due(self):
+        return self.heap[0][0] if self.heap else None
+
+    def schedule(self, item, delay):
+        due = time() + delay
+        heappush(self.heap, (due, next(self.counter), item))
+        if self.heap[0][0] == due:
+            self.wakeup.set()  # new item is the earliest one
+
+    def release_due(self):
+        now = time()
+        released = 0
+        while self.heap and self.heap[0][0] <= now:
+            _, _, item = heappop(self.heap)
+            self.retry_queue.put(item)
+            released += 1
+        return released
+
+    def _run(self):
+        while not self.exit:
+            self.wakeup.clear()
+            released = self.release_due()
+            if released:
+                LOGGER.debug('Released {} items to retry queue.'.format(released))
+            next_due = self.next_due()
+            self.wakeup.wait(None if next_due is None else max(next_due - time(), 0))
+
+    def shutdown(self):
+        self.exit = True
+        self.wakeup.set()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import os
+from gevent.queue import Queue
+from json import dumps, loads
+from logging import getLogger
+
+LOGGER = getLogger(__name__)
+
+
+def read_items(path, offset=0):
+    with open(path) as spool:
+        spool.seek(offset)
+        while True:
+            line = spool.readline()
+            if not line.endswith('\n'):
+                break  # end of file or unfinished write
+            try:
+                item = loads(line)
+            except ValueError:
+                LOGGER.error('Skip broken line in {}: {}'.format(path, line.strip()))
+                item = None
+            yield spool.tell(), item
+
+
+class SpillingQueue(object):
+
+    """FIFO queue keeping at most memory_limit items in memory.
+
+    Past the limit items are appended to a spool file and read back in
+    chunks while the in-memory part drains. Items left in the file by a
+    previous run are picked up on start.
+    """
+
+    def __init__(self, path, memory_limit):
+        self.path = path
+        self.memory_limit = memory_limit
+        self.queue = Queue()
+        self.offset = 0
+        self.spilled = 0
+        if os.path.exists(path):
+            self.spilled = sum(1 for _ in read_items(path))
+            if self.spilled:
+                LOGGER.info('Found {} spilled items in {}'.format(self.spilled, path))
+
+    def put(self, item, block=True, timeout=None):
+        if self.spilled or self.queue.qsize() >= self.memory_limit:
+            with open(self.path, 'a') as spool:
+                spool.write(dumps(item) + '\n')
+            self.spilled += 1
+        else:
+            self.queue.put(item)
+
+    def _refill(self):
+        if not self.spilled:
+            return
+        for offset, item in read_items(self.path, self.offset):
+            self.offset = offset
+            self.spilled -= 1
+            if item is not None:
+                self.queue.put(item)
+            if not self.spilled or self.queue.qsize() >= self.memory_limit:
+                break
+        else:
+            self.spilled = 0  # nothing left in file
+        if not self.spilled:
+            open(self.path, 'w').close()
+            self.offset = 0
+
+    def spilled_items(self):
+        # Items waiting in spool file, read without taking them from queue
+        if not self.spilled:
+            return
+        for _, item in read_items(self.path, self.offset):
+            if item is not None:
+                yield item
+
+    def get(self, block=True, timeout=None):
+        if self.queue.empty():
+            self._refill()
+        return self.queue.get(block, timeout)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return self.queue.qsize() + self.spilled
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class DeadLetterSpool(object):
+
+    """Append-only file of items dropped after reaching retries limit."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, item):
+        with open(self.path, 'a') as spool:
+            spool.write(dumps(item) + '\n')
+
+    def replay(self):
+        # Spool is moved aside, so items dropped again during replay
+        # are written to a new one. Leftover of interrupted replay goes first.
+        replay_path = self.path + '.replay'
+        if not os.path.exists(replay_path):
+            if not os.path.exists(self.path):
+                return
+            os.rename(self.path, replay_path)
+        for _, item in read_items(replay_path):
+            if item is not None:
+                yield item
+        os.remove(replay_path)
+
+
+class DumpSpool(object):
+
+    """Dumps deleted from cdb which aren't saved to secret archive yet.
+
+    Each item with its dump is written to own file in path directory and
+    fsynced, so dump returned by delete request survives restart. File is
+    removed once dump is saved, items left by previous run are replayed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _item_path(self, item):
+        return os.path.join(self.path, '{}.{}.json'.format(item['resource'], item['id']))
+
+    def add(self, item):
+        item_path = self._item_path(item)
+        with open(item_path + '.tmp', 'w') as spool:
+            spool.write(dumps(item))
+            spool.flush()
+            os.fsync(spool.fileno())
+        os.rename(item_path + '.tmp', item_path)
+        # Renamed entry is durable only after directory is synced
+        directory = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def remove(self, item):
+        try:
+            os.remove(self._item_path(item))
+        except OSError:
+            pass
+
+    def items(self):
+        for name in sorted(os.listdir(self.path)):
+            item_path = os.path.join(self.path, name)
+            if name.endswith('.tmp'):
+                os.remove(item_path)  # unfinished write, dump wasn't used yet
+                continue
+            with open(item_path) as spool:
+                try:
+                    yield loads(spool.read())
+                except ValueError:
+                    LOGGER.error('Skip broken dump spool file {}'.format(item_path))
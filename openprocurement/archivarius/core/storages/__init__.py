@@ -1,3 +1,3 @@
-from .storages import S3Storage
+from .storages import CouchStorage, S3Storage
 
-__all__ = [S3Storage]
+__all__ = [CouchStorage, S3Storage]
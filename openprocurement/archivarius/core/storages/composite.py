@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+from gevent import spawn
+from gevent.pool import Pool
+from gevent.queue import Queue
+from logging import getLogger
+from time import time
+from openprocurement.archivarius.core.db import ConfigError
+from .storages import s3_pool_size
+
+logger = getLogger(__name__)
+
+QUORUMS = ('all', 'any', 'primary')
+RETRY_INTERVAL = 30
+# Weight of the last request in moving average latency
+LATENCY_WEIGHT = 0.2
+
+
+def get_quorum(name):
+    if name not in QUORUMS:
+        raise ConfigError('Unknown secret archive quorum \'{}\', available: {}'.format(
+            name, ', '.join(QUORUMS)))
+    return name
+
+
+def save_newer(storage, data):
+    # Each storage keeps its own revisions, so it gets its own copy
+    if getattr(storage, 'save_newer', None) is not None:
+        return storage.save_newer(dict(data))
+    doc = storage.get(data['_id'])
+    if doc is None:
+        storage.save(dict(data))
+        return True
+    if doc['dateModified'] >= data['dateModified']:
+        return False
+    storage.save(dict(data, _rev=doc.get('_rev')))
+    return True
+
+
+def get_date_modified(storage, doc_id):
+    if getattr(storage, 'get_date_modified', None) is not None:
+        return storage.get_date_modified(doc_id)
+    doc = storage.get(doc_id)
+    return doc['dateModified'] if doc is not None else None
+
+
+def get(storage, doc_id):
+    return storage.get(doc_id)
+
+
+class Replica(object):
+
+    """Storage of composite storage with its latency and last failure."""
+
+    def __init__(self, name, storage):
+        self.name = name
+        self.storage = storage
+        self.latency = 0.0
+        self.failed_at = None
+
+
+class CompositeStorage(object):
+
+    """Secret archive written to several storages at once.
+
+    Documents are written to all storages in parallel greenlets and save
+    returns according to quorum: 'all' waits for every storage, 'any' for
+    the first one which saved document, 'primary' for the first storage
+    while the others are written in background by at most concurrency
+    greenlets, their failures are only logged. Failed save raises, so item
+    is retried, saving newer document again is harmless.
+
+    Reads go to replica with the lowest moving average latency, replicas
+    failed within retry_interval seconds are tried last. Missing document
+    is looked up in the next replica.
+    """
+
+    def __init__(self, storages, quorum='all', concurrency=1, retry_interval=RETRY_INTERVAL):
+        self.replicas = [Replica(name, storage) for name, storage in storages]
+        self.quorum = quorum
+        self.retry_interval = retry_interval
+        self.background = Pool(concurrency)
+
+    def _call(self, replica, func, *args):
+        started = time()
+        try:
+            result = func(replica.storage, *args)
+        except Exception as e:
+            replica.failed_at = time()
+            logger.warning('Error in secret storage {}: {}'.format(replica.name, e.message or repr(e)))
+            raise
+        replica.failed_at = None
+        replica.latency += LATENCY_WEIGHT * (time() - started - replica.latency)
+        return result
+
+    def _call_to(self, results, replica, func, *args):
+        try:
+            results.put((None, self._call(replica, func, *args)))
+        except Exception as e:
+            results.put((e, None))
+
+    def _background_call(self, replica, func, *args):
+        try:
+            self._call(replica, func, *args)
+        except Exception:
+            pass  # already logged
+
+    def _fan_out(self, func, *args):
+        # (error, result) of each replica comes to queue once it's done
+        results = Queue()
+        for replica in self.replicas:
+            spawn(self._call_to, results, replica, func, *args)
+        return results
+
+    def _call_all(self, func, *args):
+        results = self._fan_out(func, *args)
+        outcomes = [results.get() for _ in self.replicas]
+        for error, _ in outcomes:
+            if error is not None:
+                raise error
+        return [result for _, result in outcomes]
+
+    def _read_order(self):
+        now = time()
+        return sorted(self.replicas, key=lambda replica: (
+            replica.failed_at is not None and now - replica.failed_at < self.retry_interval,
+            replica.latency))
+
+    def _call_fastest(self, func, *args):
+        # First found value, error is raised only if no replica has it
+        error = None
+        for replica in self._read_order():
+            try:
+                result = self._call(replica, func, *args)
+            except Exception as e:
+                error = e
+                continue
+            if result is not None:
+                return result
+        if error is not None:
+            raise error
+        return None
+
+    def save_newer(self, data):
+        if self.quorum == 'primary':
+            saved = self._call(self.replicas[0], save_newer, data)
+            for replica in self.replicas[1:]:
+                # Blocks when background writes fall behind
+                self.background.spawn(self._background_call, replica, save_newer, data)
+            return saved
+        if self.quorum == 'any':
+            results = self._fan_out(save_newer, data)
+            error = None
+            for _ in self.replicas:
+                error, saved = results.get()
+                if error is None:
+                    return saved
+            raise error
+        return any(self._call_all(save_newer, data))
+
+    def save(self, data):
+        # Revisions differ between storages, document is written where it's newer
+        self.save_newer(data)
+
+    def get_date_modified(self, doc_id):
+        if self.quorum == 'primary':
+            return self._call(self.replicas[0], get_date_modified, doc_id)
+        if self.quorum == 'any':
+            return self._call_fastest(get_date_modified, doc_id)
+        # Document is up to date only when every storage has it
+        dates = self._call_all(get_date_modified, doc_id)
+        return None if None in dates else min(dates)
+
+    def get(self, key):
+        return self._call_fastest(get, key)
+
+
+def composite(bridge, storages):
+    storage = CompositeStorage(storages, quorum=get_quorum(bridge.secret_quorum),
+                               concurrency=s3_pool_size(bridge))
+    setattr(bridge, 'secret_archive', storage)
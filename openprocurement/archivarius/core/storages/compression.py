@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Packing of secret archive documents.
+
+Dump keeps encrypted resource as base64 'item' string, which is stored as
+binary blob after JSON header and the whole body is compressed by codec.
+Encoding name is saved next to the body (S3 metadata or couchdb document
+field), documents without it are plain JSON written before.
+
+Body is produced by iterencode in chunks: blobs are decoded by slices and
+fed to streaming compressor, so large document isn't copied in memory.
+Plain JSON is produced by iterdumps the same way.
+"""
+import zlib
+from base64 import b64decode, b64encode
+from json import dumps, loads
+from json.encoder import encode_basestring_ascii
+from struct import Struct
+from openprocurement.archivarius.core.db import ConfigError
+
+try:
+    import lz4.frame as lz4
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+HEADER = Struct('>I')
+CHUNK_SIZE = 1024 * 1024
+
+
+class Packed(object):
+
+    """Compressor which leaves packed body as is."""
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+
+class LZ4Compressor(object):  # pragma: no cover
+
+    """lz4 frame compressor with zlib.compressobj interface."""
+
+    def __init__(self):
+        self.compressor = lz4.LZ4FrameCompressor()
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, ''
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+
+# encoding: (compressor factory, decompress)
+CODECS = {
+    'packed': (Packed, str),
+    'zlib': (zlib.compressobj, zlib.decompress)
+}
+if lz4 is not None:  # pragma: no cover
+    CODECS['lz4'] = (LZ4Compressor, lz4.decompress)
+
+
+def get_encoding(name):
+    if not name:
+        return None
+    if name not in CODECS:
+        raise ConfigError('Unknown secret archive compression \'{}\', available: {}'.format(
+            name, ', '.join(sorted(CODECS))))
+    return name
+
+
+def _encrypted_items(doc):
+    # {'data': {'tender': {'item': ..., 'pubkey': ...}, ...}}
+    data = doc.get('data')
+    if not isinstance(data, dict):
+        return []
+    return [(name, data[name]) for name in sorted(data)
+            if isinstance(data[name], dict) and 'item' in data[name]]
+
+
+def iterencode(doc, encoding, chunk_size=CHUNK_SIZE):
+    items = []
+    data = doc.get('data')
+    for name, value in _encrypted_items(doc):
+        item = value['item']
+        items.append(item)
+        # Length of decoded blob stands for item in header
+        length = len(item) // 4 * 3 - item[-2:].count('=')
+        data = dict(data, **{name: dict(value, item=length)})
+    if items:
+        doc = dict(doc, data=data)
+    header = dumps(doc)
+    compressor = CODECS[encoding][0]()
+    yield compressor.compress(HEADER.pack(len(header)) + header)
+    # Slices of whole base64 quads are decoded independently
+    step = max(chunk_size // 4 * 4, 4)
+    for item in items:
+        for start in xrange(0, len(item), step):
+            yield compressor.compress(b64decode(item[start:start + step]))
+    yield compressor.flush()
+
+
+def iterdumps(obj, chunk_size=CHUNK_SIZE):
+    # Like JSONEncoder.iterencode, but long strings are escaped by slices
+    if isinstance(obj, basestring) and len(obj) > chunk_size:
+        yield '"'
+        for start in xrange(0, len(obj), chunk_size):
+            yield encode_basestring_ascii(obj[start:start + chunk_size])[1:-1]
+        yield '"'
+    elif isinstance(obj, dict):
+        yield '{'
+        for index, (key, value) in enumerate(obj.iteritems()):
+            yield '{}{}: '.format(', ' if index else '',
+                                  encode_basestring_ascii(key if isinstance(key, basestring) else str(key)))
+            for chunk in iterdumps(value, chunk_size):
+                yield chunk
+        yield '}'
+    elif isinstance(obj, (list, tuple)):
+        yield '['
+        for index, value in enumerate(obj):
+            if index:
+                yield ', '
+            for chunk in iterdumps(value, chunk_size):
+                yield chunk
+        yield ']'
+    else:
+        yield dumps(obj)
+
+
+def encode(doc, encoding):
+    return ''.join(iterencode(doc, encoding))
+
+
+def decode(body, encoding):
+    if encoding not in CODECS:
+        raise ValueError('Unknown encoding of secret archive document: {}'.format(encoding))
+    body = CODECS[encoding][1](body)
+    offset = HEADER.size + HEADER.unpack_from(body)[0]
+    doc = loads(body[HEADER.size:offset])
+    for _, value in _encrypted_items(doc):
+        length = value['item']
+        value['item'] = b64encode(body[offset:offset + length])
+        offset += length
+    return doc
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import mmap
+import os
+from gevent import get_hub, sleep, spawn
+from logging import getLogger
+from struct import Struct
+from .compression import get_encoding
+from .segments import FSYNC_BATCH, FSYNC_INTERVAL, FSYNC_TIMEOUT, SegmentStorage
+from .storages import config_get
+
+logger = getLogger(__name__)
+
+INDEX_NAME = 'index'
+INDEX_MAGIC = 'ARCIDX01'
+# magic, segment and end of data merged into index
+INDEX_HEADER = Struct('>8sIQ')
+# id, segment, offset, length, dateModified, rev, encoding
+INDEX_RECORD = Struct('>32sIQI32sI8s')
+ID_SIZE = 32
+# Journal frozen while it's merged into index
+MERGING_SUFFIX = '.merging'
+# Index records are copied in blocks of this size
+COPY_SIZE = 1024 * 1024
+MERGE_RETRY_INTERVAL = 60
+
+
+def pack_entry(doc_id, entry):
+    segment, offset, length, date_modified, rev, encoding = entry
+    # Entries recovered from segment headers have unicode strings
+    return INDEX_RECORD.pack(str(doc_id), segment, offset, length, str(date_modified or ''), rev, str(encoding or ''))
+
+
+def unpack_entry(record):
+    _, segment, offset, length, date_modified, rev, encoding = INDEX_RECORD.unpack(record)
+    return segment, offset, length, date_modified.rstrip('\0') or None, rev, encoding.rstrip('\0') or None
+
+
+class FileSystemStorage(SegmentStorage):
+
+    """Secret archive in append-only data files on local disk.
+
+    Data files are rolling segments without upload. Index is a file of
+    fixed-size records sorted by id, which is memory-mapped and searched
+    with bisection. New entries go to journal kept in memory and are merged
+    into new sorted index file once journal has merge_limit entries. Merge
+    runs in thread of background greenlet: journal is frozen and new
+    entries go to the next journal meanwhile. Saves share fsyncs of data
+    and journal files as in SegmentStorage.
+    """
+
+    index_name = 'journal'
+
+    def __init__(self, path, segment_size, fsync_interval=FSYNC_INTERVAL, fsync_batch=FSYNC_BATCH,
+                 merge_limit=100000, encoding=None, fsync_timeout=FSYNC_TIMEOUT):
+        self.merge_limit = merge_limit
+        self.segment_file = None
+        self.merging = {}
+        self.merger = None
+        self._map_index(os.path.join(path, INDEX_NAME))
+        super(FileSystemStorage, self).__init__(path, segment_size, encoding=encoding, fsync_interval=fsync_interval,
+                                                fsync_batch=fsync_batch, fsync_timeout=fsync_timeout)
+        # Entries recovered on start and journal of interrupted merge are
+        # merged once segment file is open
+        if os.path.exists(self._merging_path()) or len(self.index) >= self.merge_limit:
+            self._merge()
+
+    def _map_index(self, index_path):
+        if not os.path.exists(os.path.dirname(index_path)):
+            os.makedirs(os.path.dirname(index_path))
+        if not os.path.exists(index_path):
+            with open(index_path, 'wb') as index_file:
+                index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, 0, 0))
+        with open(index_path, 'rb') as index_file:
+            self.index_map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.merged_segment, self.merged_end = INDEX_HEADER.unpack_from(self.index_map)
+        if magic != INDEX_MAGIC:
+            raise ValueError('{} is not archive index'.format(index_path))
+        self.index_size = (len(self.index_map) - INDEX_HEADER.size) // INDEX_RECORD.size
+
+    def _record(self, position):
+        start = INDEX_HEADER.size + position * INDEX_RECORD.size
+        return self.index_map[start:start + INDEX_RECORD.size]
+
+    def _bisect(self, key, low=0):
+        # Bisection over mapped records, only touched pages are read
+        high = self.index_size
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[:ID_SIZE] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _search(self, doc_id):
+        key = doc_id.ljust(ID_SIZE, '\0')
+        position = self._bisect(key)
+        if position < self.index_size:
+            record = self._record(position)
+            if record[:ID_SIZE] == key:
+                return unpack_entry(record)
+        return None
+
+    def _merging_path(self):
+        return os.path.join(self.path, self.index_name + MERGING_SUFFIX)
+
+    def _load_index(self):
+        # Entries of the current journal are newer
+        if os.path.exists(self._merging_path()):
+            self._read_index(self._merging_path())
+        super(FileSystemStorage, self)._load_index()
+        self.segment = max(self.segment, self.merged_segment)
+
+    def _indexed_end(self):
+        end = super(FileSystemStorage, self)._indexed_end()
+        return max(end, self.merged_end) if self.merged_segment == self.segment else end
+
+    def _get_entry(self, doc_id):
+        entry = self.index.get(doc_id) or self.merging.get(doc_id)
+        if entry is None and len(doc_id) <= ID_SIZE:
+            entry = self._search(doc_id)
+        return entry
+
+    def _add_to_index(self, doc_id, entry):
+        super(FileSystemStorage, self)._add_to_index(doc_id, entry)
+        if len(self.index) >= self.merge_limit and self.segment_file is not None and self.merger is None:
+            self._start_merge()
+
+    def _write_index(self, journal, segment, end):
+        # Records between journal entries are copied from mapped index in
+        # blocks, found by bisection. Called in thread, so doesn't touch hub
+        index_path = os.path.join(self.path, INDEX_NAME)
+        with open(index_path + '.tmp', 'wb') as index_file:
+            index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, segment, end))
+            position = 0
+            for key, entry in sorted((doc_id.ljust(ID_SIZE, '\0'), entry) for doc_id, entry in journal.items()):
+                found = self._bisect(key, position)
+                self._copy_records(index_file, position, found)
+                position = found
+                if position < self.index_size and self._record(position)[:ID_SIZE] == key:
+                    position += 1  # replaced by journal entry
+                index_file.write(pack_entry(key, entry))
+            self._copy_records(index_file, position, self.index_size)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.rename(index_path + '.tmp', index_path)
+
+    def _copy_records(self, index_file, start, stop):
+        start = INDEX_HEADER.size + start * INDEX_RECORD.size
+        stop = INDEX_HEADER.size + stop * INDEX_RECORD.size
+        while start < stop:
+            index_file.write(self.index_map[start:min(stop, start + COPY_SIZE)])
+            start += COPY_SIZE
+
+    def _merged(self):
+        self.index_map.close()
+        self._map_index(os.path.join(self.path, INDEX_NAME))
+        if os.path.exists(self._merging_path()):
+            os.remove(self._merging_path())
+        logger.info('Merged {} journal entries into index of {} entries'.format(len(self.merging), self.index_size))
+        self.merging = {}
+
+    def _merge(self):
+        # Blocking merge on start, before any save waits for it
+        self._fsync()
+        self.merging, self.index = self.index, {}
+        self._write_index(self.merging, self.segment, self.segment_file.tell())
+        self._merged()
+        self.index_file.close()
+        self.index_file = open(os.path.join(self.path, self.index_name), 'w')
+
+    def _start_merge(self):
+        # Data indexed by journal must be on disk before index refers to it
+        self._fsync()
+        journal_path = os.path.join(self.path, self.index_name)
+        self.index_file.close()
+        os.rename(journal_path, self._merging_path())
+        self.index_file = open(journal_path, 'a')
+        directory = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.merging, self.index = self.index, {}
+        self.merger = spawn(self._background_merge, self.segment, self.segment_file.tell())
+
+    def _background_merge(self, segment, end):
+        while True:
+            try:
+                get_hub().threadpool.apply(self._write_index, (self.merging, segment, end))
+            except Exception as e:
+                logger.error('Error while merging journal into index, retry in {} seconds: {}'.format(
+                    MERGE_RETRY_INTERVAL, e))
+                sleep(MERGE_RETRY_INTERVAL)
+                continue
+            break
+        self._merged()
+        self.merger = None
+
+    def save(self, data):
+        _id = data.get('id') if 'id' in data else data.get('_id')
+        if len(_id) > ID_SIZE:
+            raise ValueError('Document id {} is longer than {} bytes'.format(_id, ID_SIZE))
+        super(FileSystemStorage, self).save(data)
+
+
+def filesystem(bridge):
+    storage = FileSystemStorage(config_get(bridge.config, 'filesystem.path') or 'archive',
+                                int(config_get(bridge.config, 'filesystem.segment_size') or 1024 ** 3),
+                                fsync_interval=float(config_get(bridge.config, 'filesystem.fsync_interval') or
+                                                     FSYNC_INTERVAL),
+                                fsync_batch=int(config_get(bridge.config, 'filesystem.fsync_batch') or FSYNC_BATCH),
+                                merge_limit=int(config_get(bridge.config, 'filesystem.merge_limit') or 100000),
+                                encoding=get_encoding(bridge.secret_compression),
+                                fsync_timeout=float(config_get(bridge.config, 'filesystem.fsync_timeout') or
+                                                    FSYNC_TIMEOUT))
+    setattr(bridge, 'secret_archive', storage)
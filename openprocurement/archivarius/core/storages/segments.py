@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+import os
+from gevent import Timeout, sleep, spawn, spawn_later
+from gevent.event import AsyncResult
+from json import dumps, loads
+from logging import getLogger
+from openprocurement.archivarius.core.spool import read_items
+from .compression import decode, encode, get_encoding
+from .storages import config_get, s3_storage
+
+logger = getLogger(__name__)
+
+SEGMENT_NAME = '{:08d}.seg'
+SEGMENT_SIZE = 256 * 1024 * 1024
+UPLOAD_RETRY_INTERVAL = 60
+FSYNC_INTERVAL = 0.02
+FSYNC_BATCH = 100
+FSYNC_TIMEOUT = 30
+
+
+class SegmentStorage(object):
+
+    """Secret archive packed into rolling segment files.
+
+    Documents are appended to current segment file in path directory. Each
+    record is a JSON header line [id, dateModified, rev, encoding, length]
+    followed by document body, so segments are read sequentially on
+    restore. Documents are found by id -> (segment, offset, length) index,
+    append-only index file which is loaded to memory on start.
+
+    Segments grown over segment_size are closed and, if s3 storage is
+    given, uploaded with multipart upload and read back with range
+    requests. Uploads run in background greenlet and failed ones are
+    retried every upload_retry_interval seconds. Storage is meant for one
+    bridge process.
+
+    Saves wait for the next fsync of segment and index files, which is done
+    for all pending saves at once every fsync_interval seconds or after
+    fsync_batch saves. Failed fsync is raised by all saves waiting for it,
+    saves waiting longer than fsync_timeout seconds raise IOError.
+    """
+
+    index_name = 'index'
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, s3=None, prefix='', encoding=None,
+                 upload_retry_interval=UPLOAD_RETRY_INTERVAL, fsync_interval=FSYNC_INTERVAL,
+                 fsync_batch=FSYNC_BATCH, fsync_timeout=FSYNC_TIMEOUT):
+        self.path = path
+        self.segment_size = segment_size
+        self.s3 = s3
+        self.prefix = prefix
+        self.encoding = encoding
+        self.upload_retry_interval = upload_retry_interval
+        self.uploads = []
+        self.uploader = None
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.fsync_timeout = fsync_timeout
+        self.pending = 0
+        self.synced = AsyncResult()
+        self.sync_greenlet = None
+        # id: (segment, offset, length, dateModified, rev, encoding)
+        self.index = {}
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.segment = 0
+        self._load_index()
+        # Next segment is created before closed one is uploaded
+        self.segment = max([self.segment] + self._local_segments())
+        self._recover()
+        self.segment_file = open(self._segment_path(self.segment), 'ab')
+        self.segment_file.seek(0, os.SEEK_END)
+        if self.s3 is not None:
+            # Segments closed but not uploaded before restart
+            for segment in sorted(self._local_segments()):
+                if segment < self.segment:
+                    self._schedule_upload(segment)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, SEGMENT_NAME.format(segment))
+
+    def _local_segments(self):
+        return [int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.seg')]
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, self.index_name)
+        if os.path.exists(index_path):
+            self._read_index(index_path)
+        self.index_file = open(index_path, 'a')
+
+    def _read_index(self, index_path):
+        end = 0
+        for end, entry in read_items(index_path):
+            if entry is not None:
+                self.index[intern(str(entry[0]))] = tuple(entry[1:])
+                self.segment = max(self.segment, entry[1])
+        # Entries appended after line torn by crash would be lost with it
+        if os.path.getsize(index_path) > end:
+            logger.warning('Truncate unfinished line of {} at {}'.format(index_path, end))
+            with open(index_path, 'r+b') as index_file:
+                index_file.truncate(end)
+
+    def _indexed_end(self):
+        return max([entry[1] + entry[2] for entry in self.index.values() if entry[0] == self.segment] or [0])
+
+    def _get_entry(self, doc_id):
+        return self.index.get(doc_id)
+
+    def _recover(self):
+        # Index records written to current segment after last index entry,
+        # drop record left unfinished by crash
+        segment_path = self._segment_path(self.segment)
+        if not os.path.exists(segment_path):
+            return
+        end = self._indexed_end()
+        with open(segment_path, 'r+b') as segment_file:
+            segment_file.seek(end)
+            while True:
+                header = segment_file.readline()
+                try:
+                    doc_id, date_modified, rev, encoding, length = loads(header)
+                except ValueError:
+                    break
+                offset = segment_file.tell()
+                if len(segment_file.read(length)) < length:
+                    break
+                self._add_to_index(doc_id, (self.segment, offset, length, date_modified, rev, encoding))
+                end = segment_file.tell()
+            if end < os.fstat(segment_file.fileno()).st_size:
+                logger.warning('Truncate unfinished record of segment {} at {}'.format(self.segment, end))
+                segment_file.truncate(end)
+
+    def _add_to_index(self, doc_id, entry):
+        self.index_file.write(dumps([doc_id] + list(entry)) + '\n')
+        self.index_file.flush()
+        self.index[intern(str(doc_id))] = entry
+
+    def _roll(self):
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+        self.segment_file.close()
+        finished, self.segment = self.segment, self.segment + 1
+        self.segment_file = open(self._segment_path(self.segment), 'ab')
+        self.segment_file.seek(0, os.SEEK_END)
+        if self.s3 is not None:
+            self._schedule_upload(finished)
+
+    def _schedule_upload(self, segment):
+        # Saved documents stay readable from local segment until uploaded
+        self.uploads.append(segment)
+        if self.uploader is None or self.uploader.ready():
+            self.uploader = spawn(self._upload_segments)
+
+    def _upload_segments(self):
+        while self.uploads:
+            try:
+                self._upload(self.uploads[0])
+            except Exception as e:
+                logger.error('Error while uploading segment {}, retry in {} seconds: {}'.format(
+                    self.uploads[0], self.upload_retry_interval, e.message or repr(e)))
+                sleep(self.upload_retry_interval)
+                continue
+            self.uploads.pop(0)
+
+    def _upload(self, segment):
+        segment_path = self._segment_path(segment)
+        self.s3.upload_file(self.prefix + SEGMENT_NAME.format(segment), segment_path)
+        os.remove(segment_path)
+        logger.info('Uploaded segment {}'.format(segment))
+
+    def _scheduled_fsync(self):
+        self.sync_greenlet = None
+        try:
+            self._fsync()
+        except Exception as e:
+            logger.error('Error while syncing secret archive files: {}'.format(e))
+
+    def _fsync(self):
+        if self.sync_greenlet is not None:
+            self.sync_greenlet.kill(block=False)
+            self.sync_greenlet = None
+        synced, self.synced = self.synced, AsyncResult()
+        self.pending = 0
+        try:
+            for synced_file in (self.segment_file, self.index_file):
+                synced_file.flush()
+                os.fsync(synced_file.fileno())
+        except Exception as e:
+            # Waiting saves raise, so their items are retried
+            synced.set_exception(e)
+            raise
+        synced.set()
+
+    def save(self, data):
+        _id = data.get('id') if 'id' in data else data.get('_id')
+        entry = self._get_entry(_id)
+        data['_rev'] = entry[4] + 1 if entry else 1
+        body = encode(data, self.encoding) if self.encoding else dumps(data)
+        # Whole record is written without switching greenlets
+        self.segment_file.write(dumps([_id, data.get('dateModified'), data['_rev'], self.encoding, len(body)]) + '\n')
+        offset = self.segment_file.tell()
+        self.segment_file.write(body)
+        self.segment_file.flush()
+        self._add_to_index(_id, (self.segment, offset, len(body), data.get('dateModified'),
+                                 data['_rev'], self.encoding))
+        if offset + len(body) >= self.segment_size:
+            self._roll()
+        # Group commit, saves made meanwhile share one fsync
+        synced = self.synced
+        self.pending += 1
+        if self.pending >= self.fsync_batch or not self.fsync_interval:
+            self._fsync()
+        elif self.sync_greenlet is None:
+            self.sync_greenlet = spawn_later(self.fsync_interval, self._scheduled_fsync)
+        try:
+            synced.get(timeout=self.fsync_timeout)
+        except Timeout:
+            raise IOError('Secret archive fsync timed out in {} seconds'.format(self.fsync_timeout))
+
+    def save_newer(self, data):
+        # Index answers without reading segments
+        if self.get_date_modified(data['_id']) >= data['dateModified']:
+            return False
+        self.save(data)
+        return True
+
+    def get_date_modified(self, doc_id):
+        entry = self._get_entry(doc_id)
+        return entry[3] if entry else None
+
+    def get(self, key):
+        entry = self._get_entry(key)
+        if entry is None:
+            return None
+        segment, offset, length, _, _, encoding = entry
+        try:
+            with open(self._segment_path(segment), 'rb') as segment_file:
+                segment_file.seek(offset)
+                body = segment_file.read(length)
+        except IOError:
+            if self.s3 is None:
+                raise
+            body = self.s3.get_range(self.prefix + SEGMENT_NAME.format(segment), offset, length)
+        return decode(body, encoding) if encoding else loads(body)
+
+
+def segments(bridge):
+    s3 = s3_storage(bridge) if config_get(bridge.config, 's3.bucket') else None
+    storage = SegmentStorage(config_get(bridge.config, 'segments.path') or 'segments',
+                             int(config_get(bridge.config, 'segments.size') or SEGMENT_SIZE),
+                             s3=s3, prefix=config_get(bridge.config, 'segments.prefix') or '',
+                             encoding=get_encoding(bridge.secret_compression),
+                             upload_retry_interval=float(config_get(bridge.config, 'segments.upload_retry_interval') or
+                                                         UPLOAD_RETRY_INTERVAL),
+                             fsync_interval=float(config_get(bridge.config, 'segments.fsync_interval') or
+                                                  FSYNC_INTERVAL),
+                             fsync_batch=int(config_get(bridge.config, 'segments.fsync_batch') or FSYNC_BATCH),
+                             fsync_timeout=float(config_get(bridge.config, 'segments.fsync_timeout') or FSYNC_TIMEOUT))
+    setattr(bridge, 'secret_archive', storage)
@@ -1,48 +1,200 @@
+import os
+from base64 import b64decode, b64encode
+from boto.exception import S3ResponseError
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
-from json import dumps, loads
+from contextlib import contextmanager
+from cStringIO import StringIO
+from couchdb import Database
+from couchdb.design import ViewDefinition
+from functools import partial
+from gevent.queue import Queue
+from json import loads
 from ConfigParser import NoOptionError
 from uuid import UUID
 from logging import getLogger
 from openprocurement.archivarius.core.db import prepare_couchdb
+from .compression import decode, encode, get_encoding, iterdumps, iterencode
 
 logger = getLogger(__name__)
 
+PART_SIZE = 16 * 1024 * 1024
+COMPLETE_PART = '<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'
+
+DATE_MODIFIED_VIEW = ViewDefinition('secret', 'date_modified', '''function(doc) {
+    if(doc.dateModified) {
+        emit(doc._id, doc.dateModified);
+    }
+}''')
+
 
 def config_get(config, opt):
     try:
-        config.get('main', opt)
+        return config.get('main', opt)
     except NoOptionError: # pragma: no cover
         return ''
 
 
 class S3Storage(object):
 
-    def __init__(self, connection, bucket):
+    """Secret archive in S3 bucket.
+
+    Bucket handles are opened once without validating request and pooled
+    together with their connections, so greenlets never share boto
+    connection and reuse its keep-alive HTTP connection. Pool grows up to
+    pool_size connections, extra ones are made by connect.
+
+    With encoding set objects are packed and compressed, encoding is kept
+    in x-amz-meta-encoding.
+
+    Objects are serialized in chunks to part_size buffer, the ones which
+    don't fit into single part go with multipart upload, so memory taken by
+    upload is bounded by part size.
+    """
+
+    part_size = PART_SIZE
+
+    def __init__(self, connection, bucket, pool_size=1, connect=None, encoding=None):
         self.connection = connection
         self.bucket = bucket
+        self.encoding = encoding
+        self.pool_size = pool_size if connect is not None else 1
+        self.connect = connect
+        self.buckets = Queue()
+        self.buckets_count = 0
+
+    @contextmanager
+    def _get_bucket(self):
+        if self.buckets.empty() and self.buckets_count < self.pool_size:
+            self.buckets_count += 1
+            try:
+                connection = self.connect() if self.buckets_count > 1 else self.connection
+                bucket = connection.get_bucket(self.bucket, validate=False)
+            except Exception:
+                self.buckets_count -= 1
+                raise
+        else:
+            bucket = self.buckets.get()
+        try:
+            yield bucket
+        finally:
+            self.buckets.put(bucket)
 
     def _parse_key(self, doc_id):
         return '/'.join([format(i, 'x') for i in UUID(doc_id).fields])
 
+    def _put(self, key, data, rev, headers):
+        # Revision and dateModified go as x-amz-meta-* headers of the same
+        # PUT request, so they can be checked with HEAD request
+        data = dict(data, _rev=rev)
+        key.set_metadata('rev', str(rev))
+        if data.get('dateModified'):
+            key.set_metadata('datemodified', data['dateModified'])
+        if self.encoding:
+            key.set_metadata('encoding', self.encoding)
+            content_type = 'application/octet-stream'
+            chunks = iterencode(data, self.encoding)
+        else:
+            content_type = 'application/json'
+            chunks = iterdumps(data)
+        upload = None
+        etags = []
+        part = StringIO()
+        try:
+            for chunk in chunks:
+                # Chunk is split between parts, so each one is part_size
+                offset = 0
+                while offset < len(chunk):
+                    size = min(len(chunk) - offset, self.part_size - part.tell())
+                    part.write(chunk[offset:offset + size])
+                    offset += size
+                    if part.tell() < self.part_size:
+                        continue
+                    if upload is None:
+                        upload = key.bucket.initiate_multipart_upload(
+                            key.name, headers={'Content-Type': content_type}, metadata=key.metadata)
+                    etags.append(self._upload_part(upload, part, len(etags) + 1))
+                    part = StringIO()
+            if upload is None:
+                key.set_contents_from_string(part.getvalue(), headers=dict(headers, **{'Content-Type': content_type}))
+                return rev
+            if part.tell():
+                etags.append(self._upload_part(upload, part, len(etags) + 1))
+            # Conditions are checked when upload is completed
+            self._complete_upload(key.bucket, upload, etags, headers)
+        except Exception:
+            if upload is not None:
+                upload.cancel_upload()
+            raise
+        return rev
+
+    def _upload_part(self, upload, part, number):
+        size = part.tell()
+        part.seek(0)
+        return upload.upload_part_from_file(part, number, size=size).etag
+
+    def _complete_upload(self, bucket, upload, etags, headers):
+        # Parts are listed from etags instead of request made by boto, so
+        # conditional headers can be passed too
+        xml = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(
+            ''.join(COMPLETE_PART.format(number, etag) for number, etag in enumerate(etags, 1)))
+        bucket.complete_multipart_upload(upload.key_name, upload.id, xml, headers=headers)
+
     def save(self, data):
+        # Document without _rev is created only if object doesn't exist yet,
+        # like in couchdb. Existing object is overwritten without reading it.
         _id = data.get('id') if 'id' in data else data.get('_id')
-        path = self._parse_key(_id)
-        bucket = self.connection.get_bucket(self.bucket)
-        key = Key(bucket, path)
-        if key.exists():
-            dumped_resource = loads(key.get_contents_as_string())
-            dumped_resource.update(data)
-            dumped_resource['_rev'] = int(dumped_resource['_rev']) + 1
-            key.set_contents_from_string(dumps(dumped_resource))
-        else:
-            key = bucket.new_key(path)
-            data['_rev'] = 1
-            key.set_contents_from_string(dumps(data))
-        key.set_metadata('Content-Type', 'application/json')
+        headers = {} if data.get('_rev') else {'If-None-Match': '*'}
+        with self._get_bucket() as bucket:
+            data['_rev'] = self._put(Key(bucket, self._parse_key(_id)), data,
+                                     int(data.get('_rev') or 0) + 1, headers)
+
+    def save_newer(self, data):
+        # HEAD request compares dateModified, then document is uploaded once
+        # with conditional PUT, so it's written only if object wasn't created
+        # or changed meanwhile, otherwise S3 answers 412 Precondition Failed
+        # and item is retried.
+        path = self._parse_key(data['_id'])
+        with self._get_bucket() as bucket:
+            key = bucket.get_key(path)
+            if key is None:
+                self._put(Key(bucket, path), data, 1, {'If-None-Match': '*'})
+                return True
+            if key.get_metadata('datemodified') >= data['dateModified']:
+                return False
+            # Objects saved before revision was kept in metadata have rev 1
+            rev = int(key.get_metadata('rev') or 1) + 1
+            self._put(Key(bucket, path), data, rev, {'If-Match': key.etag})
+            return True
+
+    def upload_file(self, name, path, part_size=PART_SIZE):
+        # Multipart upload keeps memory bounded by part size
+        with self._get_bucket() as bucket:
+            upload = bucket.initiate_multipart_upload(name)
+            try:
+                with open(path, 'rb') as upload_file:
+                    size = os.fstat(upload_file.fileno()).st_size
+                    for part, offset in enumerate(xrange(0, size or 1, part_size), 1):
+                        upload.upload_part_from_file(upload_file, part, size=min(part_size, size - offset))
+                upload.complete_upload()
+            except Exception:
+                upload.cancel_upload()
+                raise
+
+    def get_range(self, name, offset, length):
+        with self._get_bucket() as bucket:
+            return Key(bucket, name).get_contents_as_string(
+                headers={'Range': 'bytes={}-{}'.format(offset, offset + length - 1)})
+
+    def get_date_modified(self, doc_id):
+        # HEAD request, object body is not downloaded
+        with self._get_bucket() as bucket:
+            key = bucket.get_key(self._parse_key(doc_id))
+        if key is None:
+            return None
+        return key.get_metadata('datemodified')
 
     def get(self, key):
-        bucket = self.connection.get_bucket(self.bucket)
         if '/' in key:
             path = key
         else:
@@ -50,26 +202,87 @@ class S3Storage(object):
                 path = self._parse_key(key)
             except ValueError:
                 return None
-        if path not in bucket:
-            return None
-        key = bucket.get_key(path)
-        data = loads(key.get_contents_as_string(path))
+        with self._get_bucket() as bucket:
+            key = bucket.get_key(path)
+            if key is None:
+                return None
+            body = key.get_contents_as_string()
+        encoding = key.get_metadata('encoding')
+        return decode(body, encoding) if encoding else loads(body)
+
+
+class CouchStorage(Database):
+
+    """Secret archive in couchdb.
+
+    With encoding set dump is packed and compressed into 'data' attachment,
+    so it's kept binary at rest. Document keeps dateModified for the view
+    and encoding name.
+    """
+
+    def __init__(self, url, name=None, session=None, encoding=None):
+        super(CouchStorage, self).__init__(url, name=name, session=session)
+        self.encoding = encoding
+
+    def save(self, doc, **options):
+        if not self.encoding:
+            return super(CouchStorage, self).save(doc, **options)
+        packed_doc = dict((name, doc[name]) for name in ('_id', '_rev', 'dateModified') if doc.get(name))
+        packed_doc['encoding'] = self.encoding
+        packed_doc['_attachments'] = {'data': {
+            'content_type': 'application/octet-stream',
+            'data': b64encode(encode(doc, self.encoding))
+        }}
+        doc['_id'], doc['_rev'] = super(CouchStorage, self).save(packed_doc, **options)
+        return doc['_id'], doc['_rev']
+
+    def get(self, id, default=None, **options):
+        # Attachments are inlined, so packed document takes one request too
+        doc = super(CouchStorage, self).get(id, default, attachments=True, **options)
+        if doc is default or not doc.get('encoding'):
+            return doc
+        data = decode(b64decode(doc['_attachments']['data']['data']), doc['encoding'])
+        data.update(_id=doc.id, _rev=doc.rev)
         return data
 
+    def get_date_modified(self, doc_id):
+        # Stale view is safe here: it can only be older than the document
+        rows = list(self.view(DATE_MODIFIED_VIEW.design + '/' + DATE_MODIFIED_VIEW.name,
+                              key=doc_id, stale='update_after'))
+        return rows[0].value if rows else None
 
-def s3(bridge):
+
+def s3_pool_size(bridge):
+    # Greenlets of all workers which may request S3 at the same time
+    concurrency = 1
+    if bridge.worker_pipeline:
+        concurrency = bridge.workers_config['dump_get_concurrency'] + \
+            bridge.workers_config['secret_save_concurrency']
+    return (bridge.workers_max + bridge.retry_workers_max) * concurrency
+
+
+def s3_storage(bridge):
     aws_params = {}
     for name, value in bridge.config.items('main'):
         if name[:3] != 's3.' or 'bucket' in name:
             continue
         aws_params[name[3:]] = value
-    connection = S3Connection(**aws_params)
-    storage = S3Storage(connection, config_get(bridge.config, 's3.bucket'))
-    setattr(bridge, 'secret_archive', storage)
+    connect = partial(S3Connection, **aws_params)
+    return S3Storage(connect(), config_get(bridge.config, 's3.bucket'),
+                     pool_size=s3_pool_size(bridge), connect=connect,
+                     encoding=get_encoding(bridge.secret_compression))
+
+
+def s3(bridge):
+    setattr(bridge, 'secret_archive', s3_storage(bridge))
 
 
 def couch(bridge):
     url = getattr(bridge, 'couch_url')
     default_db_name = getattr(bridge, 'db_archive_name')
     name = '{}_{}'.format(default_db_name, 'secret')
-    setattr(bridge, 'secret_archive', prepare_couchdb(url, name, logger))
+    db = prepare_couchdb(url, name, logger)
+    storage = CouchStorage(db.resource.url, session=db.resource.session,
+                           encoding=get_encoding(bridge.secret_compression))
+    DATE_MODIFIED_VIEW.sync(storage)
+    setattr(bridge, 'secret_archive', storage)
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""Offline end-to-end benchmark of ArchivariusBridge.
+
+Edge and public archive CouchDB, CDB /dump API and boto connection of
+secret S3 archive are replaced with in-process stand-ins with configurable
+latency, error rate and 429 rate, then bridge archives N synthetic tenders
+to S3Storage. Throughput, per-stage latency and peak memory are printed as
+JSON.
+
+    python -m openprocurement.archivarius.core.tests.benchmark --items 10000
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import uuid
+from base64 import b64encode
+from boto.exception import S3ResponseError
+from ConfigParser import ConfigParser
+from couchdb.client import Row
+from couchdb.http import ResourceConflict, ServerError
+from datetime import datetime, timedelta
+from gevent import sleep
+from hashlib import md5
+from mock import patch
+from munch import munchify
+from openprocurement_client.exceptions import RequestFailed
+from time import time
+
+from openprocurement.archivarius.core import bridge as bridge_module
+from openprocurement.archivarius.core.bridge import ArchivariusBridge
+from openprocurement.archivarius.core.storages import S3Storage
+from openprocurement.archivarius.core.storages import storages as storages_module
+from openprocurement.archivarius.core.storages.compression import get_encoding
+from openprocurement.archivarius.core.storages.storages import s3_pool_size
+from openprocurement.archivarius.core.tests.workers import NOT_IMPL, MockBucket, MockConnection, MockKey
+
+
+class Stand(object):
+
+    """Latency and failure injection shared by stand-ins."""
+
+    def __init__(self, latency=0, error_rate=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+
+    def request(self):
+        self.requests += 1
+        if self.latency:
+            sleep(random.uniform(self.latency / 2, self.latency * 1.5))
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return False
+        return True
+
+
+class FakeCouchDB(Stand):
+
+    """In-memory database with the part of couchdb.Database bridge uses."""
+
+    def __init__(self, name, latency=0, error_rate=0):
+        super(FakeCouchDB, self).__init__(latency, error_rate)
+        self.name = name
+        self.docs = {}
+
+    def _check(self):
+        if not self.request():
+            raise ServerError((500, ('internal_server_error', 'Injected error')))
+
+    def _save(self, doc):
+        current = self.docs.get(doc['_id'])
+        if (current and current['_rev']) != doc.get('_rev'):
+            return False, doc['_id'], ResourceConflict(('conflict', 'Document update conflict.'))
+        revision = int(current['_rev'].split('-')[0]) + 1 if current else 1
+        doc = dict(doc, _rev='{}-{}'.format(revision, uuid.uuid4().hex))
+        if doc.get('_deleted'):
+            del self.docs[doc['_id']]
+        else:
+            self.docs[doc['_id']] = doc
+        return True, doc['_id'], doc['_rev']
+
+    def view(self, name, wrapper=None, **options):
+        self._check()
+        if name == '_all_docs':
+            rows = []
+            for key in options['keys']:
+                doc = self.docs.get(key)
+                if doc is None:
+                    rows.append(Row(key=key, error='not_found'))
+                else:
+                    rows.append(Row(id=key, key=key, value={'rev': doc['_rev']},
+                                    doc=dict(doc) if options.get('include_docs') else None))
+            return rows
+        # Any other view is by_dateModified
+        descending = options.get('descending', False)
+        rows = sorted((Row(id=doc['_id'], key=doc['dateModified'], value=None,
+                           doc=dict(doc) if options.get('include_docs') else None)
+                       for doc in self.docs.values()), key=lambda row: (row.key, row.id), reverse=descending)
+        if 'startkey' in options:
+            rows = [row for row in rows if row.key == options['startkey'] or
+                    (row.key > options['startkey']) != descending]
+        if 'endkey' in options:
+            rows = [row for row in rows if (row.key != options['endkey'] and
+                                            (row.key < options['endkey']) != descending) or
+                    (row.key == options['endkey'] and options.get('inclusive_end', True))]
+        if 'limit' in options:
+            rows = rows[:options['limit']]
+        return rows
+
+    def iterview(self, name, batch, wrapper=None, **options):
+        # Rows are fetched at once, batches only add latency
+        rows = self.view(name, **options)
+        for index, row in enumerate(rows, 1):
+            yield row
+            if index % batch == 0:
+                self._check()
+
+    def update(self, documents):
+        self._check()
+        return [self._save(doc) for doc in documents]
+
+
+class S3Key(MockKey):
+
+    """Mock key which PUT and GET requests go through bucket stand."""
+
+    def get_contents_as_string(self, headers=None, *args, **kwargs):
+        # Key is the one found by HEAD request
+        self.bucket.request()
+        return self.data
+
+    def set_contents_from_string(self, s, headers=NOT_IMPL, *args, **kwargs):
+        self.bucket.request()
+        return super(S3Key, self).set_contents_from_string(s, headers, *args, **kwargs)
+
+
+class S3Upload(object):
+
+    """Multipart upload of S3Bucket."""
+
+    def __init__(self, bucket, key_name, headers, metadata):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.id = uuid.uuid4().hex
+        self.headers = headers or {}
+        self.metadata = metadata or {}
+        self.parts = {}
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        self.bucket.request()
+        self.parts[part_num] = fp.read(size)
+        return munchify({'etag': md5(self.parts[part_num]).hexdigest()})
+
+    def cancel_upload(self):
+        self.bucket.uploads.pop(self.id, None)
+
+
+class S3Bucket(MockBucket):
+
+    """Mock bucket with latency and errors of S3 requests, HEAD, conditional
+    PUT and multipart upload are enough for S3Storage."""
+
+    def __init__(self, connection, name, stand):
+        super(S3Bucket, self).__init__(connection, name)
+        self.stand = stand
+        self.uploads = {}
+
+    def request(self):
+        if not self.stand.request():
+            raise S3ResponseError(500, 'Internal Server Error')
+
+    def get_key(self, key_name, headers=NOT_IMPL, version_id=NOT_IMPL):
+        self.request()
+        return super(S3Bucket, self).get_key(key_name, headers, version_id)
+
+    def initiate_multipart_upload(self, key_name, headers=None, metadata=None):
+        self.request()
+        upload = S3Upload(self, key_name, headers, metadata)
+        self.uploads[upload.id] = upload
+        return upload
+
+    def complete_multipart_upload(self, key_name, upload_id, xml_body, headers=None):
+        self.request()
+        upload = self.uploads.pop(upload_id)
+        stored = self.keys.get(key_name)
+        headers = headers or {}
+        if stored is not None and (headers.get('If-None-Match') == '*' or
+                                   headers.get('If-Match', stored.etag) != stored.etag) or \
+                stored is None and 'If-Match' in headers:
+            raise S3ResponseError(412, 'Precondition Failed')
+        key = S3Key(self, key_name)
+        key.data = ''.join(upload.parts[number] for number in sorted(upload.parts))
+        key.size = len(key.data)
+        key.metadata = dict(upload.metadata)
+        key.set_etag()
+        key._handle_headers(upload.headers)
+        self.keys[key_name] = key
+        return key
+
+
+def s3_connection(stand):
+    connection = MockConnection()
+    connection.buckets['secret'] = S3Bucket(connection, 'secret', stand)
+    return connection
+
+
+class FakeDumpAPI(Stand):
+
+    """CDB /dump endpoint shared by all API clients of the bridge."""
+
+    def __init__(self, latency=0, error_rate=0, rate_limit_rate=0):
+        super(FakeDumpAPI, self).__init__(latency, error_rate)
+        self.rate_limit_rate = rate_limit_rate
+        self.rate_limited = 0
+        self.dumps = {}
+
+    def call(self, method, id):
+        if self.rate_limit_rate and random.random() < self.rate_limit_rate:
+            self.rate_limited += 1
+            raise RequestFailed(munchify({'status_code': 429, 'text': 'Too Many Requests'}))
+        if not self.request():
+            raise RequestFailed(munchify({'status_code': 500, 'text': 'Injected error'}))
+        if method == 'delete':
+            return {'data': self.dumps.pop(id, {})}
+        return {'data': self.dumps.get(id, {})}
+
+
+class FakeAPIClient(object):
+
+    def __init__(self, api, user_agent):
+        self.api = api
+        self.session = munchify({'headers': {'User-Agent': user_agent}, 'cookies': {}})
+
+    def get_resource_dump(self, id, resource):
+        return self.api.call('get', id)
+
+    def delete_resource_dump(self, id, resource):
+        return self.api.call('delete', id)
+
+
+def tenders_filter(row, time):
+    return True
+
+
+def generate_tenders(edge_db, api, items, size):
+    started = datetime(2016, 1, 1)
+    for index in xrange(items):
+        tender_id = uuid.uuid4().hex
+        date_modified = (started + timedelta(seconds=index)).isoformat()
+        edge_db.docs[tender_id] = {
+            '_id': tender_id,
+            '_rev': '1-{}'.format(uuid.uuid4().hex),
+            'doc_type': 'Tender',
+            'dateModified': date_modified,
+            'description': 'x' * size
+        }
+        # Dump carries encrypted tender of the same size
+        api.dumps[tender_id] = {'id': tender_id, 'dateModified': date_modified, 'owner_token': uuid.uuid4().hex,
+                                'tender': {'item': b64encode(os.urandom(size)), 'pubkey': b64encode(os.urandom(32))}}
+
+
+def make_config(options):
+    config = ConfigParser()
+    config.add_section('main')
+    for key, value in (
+            ('resources_api_server', 'http://127.0.0.1:6543'),
+            ('resources_api_version', '2.3'),
+            ('secret_storage', 'benchmark'),
+            ('queues_controller_timeout', options.status_interval),
+            ('workers_max', options.workers),
+            ('retry_workers_max', options.workers),
+            ('worker_pipeline', options.pipeline),
+            ('scan_include_docs', options.include_docs),
+            ('secret_compression', options.compression),
+            ('run_summary_path', ''),
+    ):
+        config.set('main', key, str(value))
+    return config
+
+
+def run(options):
+    edge_db = FakeCouchDB('edge_db', options.couch_latency, options.couch_error_rate)
+    archive_db = FakeCouchDB('archive_db', options.couch_latency, options.couch_error_rate)
+    s3 = Stand(options.s3_latency, options.s3_error_rate)
+    connection = s3_connection(s3)
+    api = FakeDumpAPI(options.api_latency, options.api_error_rate, options.rate_limit_rate)
+    generate_tenders(edge_db, api, options.items, options.doc_size)
+    databases = {'edge_db': edge_db, 'archive_db': archive_db}
+
+    with patch.object(bridge_module, 'prepare_couchdb', lambda url, name, *args: databases[name]), \
+            patch.object(bridge_module, 'APIClient', lambda user_agent, **kwargs: FakeAPIClient(api, user_agent)), \
+            patch.object(storages_module, 'Key', S3Key):
+        bridge = ArchivariusBridge(make_config(options))
+        # Pooled bucket handles share in-memory bucket
+        bridge.secret_archive = S3Storage(connection, 'secret', pool_size=s3_pool_size(bridge),
+                                          connect=lambda: connection,
+                                          encoding=get_encoding(bridge.secret_compression))
+        bridge.secret_archive.part_size = options.s3_part_size
+        # Integer options of config are too coarse for benchmark runs
+        bridge.watch_interval = 0.1
+        bridge.workers_config.update(queue_timeout=0.5, bulk_delete_interval=0.5,
+                                     retry_default_timeout=options.retry_timeout)
+        bridge.resources = {'tenders': {'filter': tenders_filter, 'view_options': None,
+                                        'view_path': '_design/tenders/_view/by_dateModified'}}
+        memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time()
+        bridge.run()
+        duration = time() - started
+
+    stages = bridge.metrics.stages_summary()
+    return {
+        'items': options.items,
+        'archived': bridge.log_dict['archived'],
+        'left_in_edge': len(edge_db.docs),
+        'duration': duration,
+        'items_per_second': bridge.log_dict['archived'] / duration if duration else 0.0,
+        'counters': bridge.log_dict,
+        'stages': dict((stage, resources['tenders']['all']) for stage, resources in stages.items()),
+        'injected': {'couch_errors': edge_db.errors + archive_db.errors, 's3_errors': s3.errors,
+                     'api_errors': api.errors, 'api_rate_limited': api.rate_limited},
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'max_rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory_before
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Archivarius Bridge benchmark ----')
+    parser.add_argument('--items', type=int, default=1000, help='Number of synthetic tenders')
+    parser.add_argument('--doc-size', type=int, default=1024, help='Padding of tender docs, bytes')
+    parser.add_argument('--workers', type=int, default=3, help='Main and retry workers pool size')
+    parser.add_argument('--pipeline', action='store_true', help='Use stage pipeline workers')
+    parser.add_argument('--include-docs', action='store_true', help='Scan edge view with include_docs')
+    parser.add_argument('--couch-latency', type=float, default=0.005, help='CouchDB request latency, sec')
+    parser.add_argument('--couch-error-rate', type=float, default=0, help='Share of failed CouchDB requests')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='/dump request latency, sec')
+    parser.add_argument('--api-error-rate', type=float, default=0, help='Share of failed /dump requests')
+    parser.add_argument('--rate-limit-rate', type=float, default=0, help='Share of /dump requests answered 429')
+    parser.add_argument('--s3-latency', type=float, default=0.01, help='S3 request latency, sec')
+    parser.add_argument('--s3-error-rate', type=float, default=0, help='Share of failed S3 requests')
+    parser.add_argument('--s3-part-size', type=int, default=S3Storage.part_size,
+                        help='Multipart upload part size, bytes')
+    parser.add_argument('--compression', default='', help='Secret archive compression')
+    parser.add_argument('--retry-timeout', type=float, default=0.1, help='First retry delay, sec')
+    parser.add_argument('--status-interval', type=int, default=1,
+                        help='Bridge status interval, sec, main workers are added once per interval')
+    parser.add_argument('--seed', type=int, help='Random seed for injected failures')
+    options = parser.parse_args()
+    random.seed(options.seed)
+    print(json.dumps(run(options), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
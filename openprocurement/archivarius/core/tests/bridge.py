@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
 import unittest
 import uuid
 from ConfigParser import ConfigParser
@@ -9,6 +13,7 @@ from mock import patch, MagicMock
 from munch import munchify
 from openprocurement_client.exceptions import RequestFailed
 from socket import error
+from time import time
 from openprocurement.archivarius.core.db import (
     prepare_couchdb
 )
@@ -16,9 +21,13 @@ from openprocurement.archivarius.core.bridge import (
     ConfigError,
     ArchivariusBridge
 )
+from openprocurement.archivarius.core.checkpoints import ScanCheckpoint
+from openprocurement.archivarius.core.workers import ArchivePipeline
+from openprocurement.archivarius.core.spool import SpillingQueue
 from openprocurement.archivarius.core.storages import (
     S3Storage
 )
+from openprocurement.archivarius.core.storages.composite import CompositeStorage
 
 logger = getLogger(__name__)
 
@@ -97,7 +106,9 @@ class TestBridge(unittest.TestCase):
         del archivarius
         tender_entrypoint = MagicMock()
         tender_entrypoint.name = 'tenders'
-        tender_entrypoint.load.return_value = lambda x: x
+        tender_filter = lambda x: x
+        tender_filter.view_options = lambda time: {'endkey': time.isoformat()}
+        tender_entrypoint.load.return_value = tender_filter
         plan_entrypoint = MagicMock()
         plan_entrypoint.name = 'plans'
         plan_entrypoint.load.return_value = lambda x: x
@@ -111,6 +122,8 @@ class TestBridge(unittest.TestCase):
         self.assertNotEqual(archivarius.db.get('_design/contracts'), None)
         self.assertNotEqual(archivarius.db.get('_design/plans'), None)
         self.assertNotEqual(archivarius.db.get('_design/tenders'), None)
+        self.assertEqual(archivarius.resources['tenders']['view_options'], tender_filter.view_options)
+        self.assertEqual(archivarius.resources['plans']['view_options'], None)
         del archivarius
 
     def test_init_storages(self):
@@ -120,6 +133,17 @@ class TestBridge(unittest.TestCase):
         self.config.set('main', 's3.bucket', 'BUCKET')
         archivarius = ArchivariusBridge(self.config)
         self.assertTrue(isinstance(archivarius.secret_archive, S3Storage))
+        self.assertEqual(archivarius.secret_archive.bucket, 'BUCKET')
+        self.assertEqual(archivarius.secret_archive.pool_size,
+                         archivarius.workers_max + archivarius.retry_workers_max)
+        del archivarius
+
+        # Pipeline workers request S3 from dump_get and secret_save stages
+        self.config.set('main', 'worker_pipeline', 'true')
+        archivarius = ArchivariusBridge(self.config)
+        self.config.remove_option('main', 'worker_pipeline')
+        self.assertEqual(archivarius.secret_archive.pool_size,
+                         (archivarius.workers_max + archivarius.retry_workers_max) * 4)
         del archivarius
 
         self.config.set('main', 'secret_storage', 'couchdb')
@@ -127,6 +151,26 @@ class TestBridge(unittest.TestCase):
         self.assertTrue(isinstance(archivarius.secret_archive, Database))
         del archivarius
 
+        self.config.set('main', 'secret_compression', 'zlib')
+        archivarius = ArchivariusBridge(self.config)
+        self.assertEqual(archivarius.secret_archive.encoding, 'zlib')
+        del archivarius
+        self.config.set('main', 'secret_compression', 'gzip')
+        self.assertRaises(ConfigError, ArchivariusBridge, self.config)
+        self.config.remove_option('main', 'secret_compression')
+
+        # Several storages are written together
+        self.config.set('main', 'secret_storage', 'couchdb, s3')
+        archivarius = ArchivariusBridge(self.config)
+        self.assertTrue(isinstance(archivarius.secret_archive, CompositeStorage))
+        self.assertEqual([replica.name for replica in archivarius.secret_archive.replicas], ['couchdb', 's3'])
+        self.assertTrue(isinstance(archivarius.secret_archive.replicas[1].storage, S3Storage))
+        self.assertEqual(archivarius.secret_archive.quorum, 'all')
+        del archivarius
+        self.config.set('main', 'secret_quorum', 'majority')
+        self.assertRaises(ConfigError, ArchivariusBridge, self.config)
+        self.config.remove_option('main', 'secret_quorum')
+
     @patch('openprocurement.archivarius.core.bridge.APIClient')
     def test_create_api_client(self, mock_APIClient):
         mock_APIClient.side_effect = [RequestFailed(), munchify({
@@ -149,6 +193,20 @@ class TestBridge(unittest.TestCase):
         self.assertEqual(bridge.api_clients_queue.qsize(),
                          bridge.workers_min)
 
+        # Pipeline gets client for each greenlet of cdb stages
+        bridge.worker_pipeline = True
+        bridge.fill_api_clients_queue()
+        self.assertEqual(bridge.api_clients_queue.qsize(), 4)
+        # Only dump_delete stage requests cdb with dump_on_delete
+        bridge.workers_config['dump_on_delete'] = True
+        for _ in range(2):
+            bridge.workers_pool.add(MagicMock(spec=ArchivePipeline))
+        bridge.fill_api_clients_queue()
+        self.assertEqual(bridge.api_clients_queue.qsize(), 4)
+        bridge.retry_workers_pool.add(MagicMock(spec=ArchivePipeline))
+        bridge.fill_api_clients_queue()
+        self.assertEqual(bridge.api_clients_queue.qsize(), 6)
+
     @patch('openprocurement.archivarius.core.bridge.ifilter')
     def test_fill_resource_items_queue(self, mock_ifilter):
         mock_ifilter.return_value = [munchify({'id': uuid.uuid4().hex, 'key': "2015"}),
@@ -160,6 +218,349 @@ class TestBridge(unittest.TestCase):
         bridge.fill_resource_items_queue('tenders')
         self.assertEqual(bridge.resource_items_queue.qsize(), 2)
         self.assertEqual(bridge.log_dict['add_to_resource_items_queue'], 2)
+        self.assertNotIn('doc', bridge.resource_items_queue.get())
+
+    @patch('openprocurement.archivarius.core.bridge.ifilter')
+    def test_fill_resource_items_queue_view_options(self, mock_ifilter):
+        mock_ifilter.return_value = [munchify({'id': uuid.uuid4().hex, 'key': "2015"})]
+        bridge = ArchivariusBridge(self.config)
+        bridge.db = MagicMock()
+        view_options = MagicMock(return_value={'endkey': '2016'})
+        bridge.resources['tenders'] = {'view_path': 'path', 'filter': MagicMock(),
+                                       'view_options': view_options}
+        bridge.fill_resource_items_queue('tenders')
+        self.assertEqual(bridge.db.iterview.call_args[0], ('path', 10 ** 3))
+        self.assertEqual(bridge.db.iterview.call_args[1], {'endkey': '2016'})
+        self.assertIn('time', view_options.call_args[1])
+        self.assertEqual(bridge.resource_items_queue.qsize(), 1)
+
+    def test_get_scan_partitions(self):
+        bridge = ArchivariusBridge(self.config)
+        bridge.db = MagicMock()
+        bridge.resources['tenders'] = {'view_path': 'path', 'filter': MagicMock()}
+
+        # Single partition by default
+        self.assertEqual(bridge.get_scan_partitions('tenders', {'endkey': '2017'}), [{'endkey': '2017'}])
+        self.assertEqual(bridge.db.view.call_count, 0)
+
+        bridge.scan_partitions = 4
+        bridge.db.view.side_effect = [[munchify({'key': '2016-01-01T00:00:00+02:00'})],
+                                      [munchify({'key': '2016-01-05T00:00:00.123+02:00'})]]
+        partitions = bridge.get_scan_partitions('tenders', {'include_docs': True, 'endkey': '2017'})
+        self.assertEqual(bridge.db.view.call_args_list[0][1], {'limit': 1, 'endkey': '2017'})
+        self.assertEqual(bridge.db.view.call_args_list[1][1],
+                         {'limit': 1, 'descending': True, 'startkey': '2017'})
+        self.assertEqual(partitions, [
+            {'include_docs': True, 'endkey': '2016-01-02T00:00:00', 'inclusive_end': False},
+            {'include_docs': True, 'startkey': '2016-01-02T00:00:00',
+             'endkey': '2016-01-03T00:00:00', 'inclusive_end': False},
+            {'include_docs': True, 'startkey': '2016-01-03T00:00:00',
+             'endkey': '2016-01-04T00:00:00', 'inclusive_end': False},
+            {'include_docs': True, 'startkey': '2016-01-04T00:00:00', 'endkey': '2017'}
+        ])
+
+        # Empty view or single key
+        bridge.db.view.side_effect = [[], []]
+        self.assertEqual(bridge.get_scan_partitions('tenders', {}), [{}])
+        bridge.db.view.side_effect = [[munchify({'key': '2016-01-01T00:00:00+02:00'})],
+                                      [munchify({'key': '2016-01-01T00:00:00+02:00'})]]
+        self.assertEqual(bridge.get_scan_partitions('tenders', {}), [{}])
+
+    @patch('openprocurement.archivarius.core.bridge.ifilter')
+    def test_fill_resource_items_queue_partitions(self, mock_ifilter):
+        mock_ifilter.return_value = [munchify({'id': uuid.uuid4().hex, 'key': "2016"})]
+        bridge = ArchivariusBridge(self.config)
+        bridge.resources['tenders'] = {'view_path': 'path', 'filter': MagicMock()}
+        bridge.get_scan_partitions = MagicMock(return_value=[{'endkey': '2016'}, {'startkey': '2016'}])
+        bridge.db = MagicMock()
+        bridge.filter_workers_pool = MagicMock()
+        bridge.fill_resource_items_queue('tenders')
+        self.assertEqual(bridge.filter_workers_pool.spawn.call_count, 1)
+        spawn_args = bridge.filter_workers_pool.spawn.call_args[0]
+        self.assertEqual(spawn_args[0], bridge.scan_resource_items)
+        self.assertEqual(spawn_args[1], 'tenders')
+        self.assertEqual(spawn_args[3], {'startkey': '2016'})
+        self.assertEqual(bridge.db.iterview.call_args[1], {'endkey': '2016'})
+        self.assertEqual(bridge.resource_items_queue.qsize(), 1)
+
+    def test_fill_resource_items_queue_checkpoint(self):
+        self.config.set('main', 'checkpoint_interval', '10')
+        bridge = ArchivariusBridge(self.config)
+        self.config.remove_option('main', 'checkpoint_interval')
+        filter_func = MagicMock(side_effect=lambda row, time: row.key > '2016-01')
+        bridge.resources['tenders'] = {'view_path': 'path', 'filter': filter_func}
+        bridge.checkpoints['tenders'] = checkpoint = ScanCheckpoint(MagicMock(), 'tenders')
+        checkpoint.db.get.return_value = {'_id': checkpoint.doc_id, '_rev': '0-1', 'key': '2016-01', 'id': 'a'}
+        rows = [munchify({'id': 'a', 'key': '2016-01'}), munchify({'id': 'b', 'key': '2016-02'})]
+        bridge.db = MagicMock()
+        bridge.db.iterview.return_value = iter(rows)
+
+        # Scan is resumed from checkpoint and items are tracked until done
+        bridge.fill_resource_items_queue('tenders')
+        self.assertEqual(bridge.db.iterview.call_args[1], {'startkey': '2016-01', 'startkey_docid': 'a'})
+        self.assertEqual(bridge.resource_items_queue.qsize(), 1)
+        self.assertEqual(checkpoint.positions, {})
+        self.assertEqual(checkpoint.watermark(), ('2016-02', 'b'))
+        self.assertEqual(checkpoint.completed, False)
+        bridge.resource_item_done(bridge.resource_items_queue.get())
+        self.assertEqual(checkpoint.completed, True)
+
+        bridge.save_checkpoints()
+        checkpoint.db.delete.assert_called_once_with(checkpoint.db.get.return_value)
+
+        # Saving errors are only logged
+        checkpoint.db.get.side_effect = Exception('DB exception')
+        bridge.save_checkpoints()
+
+        # Catch-up sweep doesn't skip rows below checkpoint of items still in flight
+        checkpoint.db.get.side_effect = None
+        bridge.db.iterview.return_value = iter(rows)
+        bridge.fill_resource_items_queue('tenders', resume=False)
+        self.assertEqual(bridge.db.iterview.call_args[1], {})
+        self.assertEqual(checkpoint.db.get.call_count, 3)  # checkpoint is not loaded
+
+    def test_put_changed_resource_item(self):
+        bridge = ArchivariusBridge(self.config)
+        filter_func = MagicMock(side_effect=lambda row, time: row.value['status'] == 'complete')
+        bridge.resources['tenders'] = {'view_path': 'path', 'filter': filter_func}
+
+        def change(**kwargs):
+            doc = {'_id': uuid.uuid4().hex, 'doc_type': 'Tender', 'status': 'complete',
+                   'dateModified': '2016-01-01T00:00:00+02:00'}
+            doc.update(kwargs)
+            return {'seq': 1, 'id': doc['_id'], 'doc': doc}
+
+        bridge.put_changed_resource_item(dict(change(), deleted=True))
+        bridge.put_changed_resource_item(change(doc_type='Unknown'))
+        bridge.put_changed_resource_item(change(status='draft'))
+        bridge.put_changed_resource_item(change(status='active'))
+        self.assertEqual(bridge.resource_items_queue.qsize(), 0)
+        self.assertEqual(filter_func.call_count, 1)
+
+        complete = change()
+        bridge.put_changed_resource_item(complete)
+        self.assertEqual(bridge.resource_items_queue.get(), {
+            'id': complete['id'],
+            'dateModified': complete['doc']['dateModified'],
+            'resource': 'tenders'
+        })
+        row = filter_func.call_args[0][0]
+        self.assertEqual((row.id, row.key, row.doc), (complete['id'], complete['doc']['dateModified'],
+                                                      complete['doc']))
+        self.assertEqual(bridge.log_dict['add_to_resource_items_queue'], 1)
+
+        # Item is skipped while in flight
+        bridge.scan_include_docs = True
+        bridge.put_changed_resource_item(complete)
+        self.assertEqual(bridge.resource_items_queue.qsize(), 0)
+        self.assertEqual(bridge.log_dict['skiped'], 1)
+
+        bridge.resource_item_done({'id': complete['id'], 'resource': 'tenders'})
+        bridge.put_changed_resource_item(complete)
+        self.assertEqual(bridge.resource_items_queue.get()['doc'], complete['doc'])
+
+    @patch('openprocurement.archivarius.core.bridge.sleep')
+    def test_follow_changes(self, mock_sleep):
+        bridge = ArchivariusBridge(self.config)
+        bridge.changes_save_interval = 0
+        bridge.put_changed_resource_item = MagicMock()
+        bridge.db = MagicMock()
+        bridge.db.get.return_value = {'_id': '_local/archivarius_changes', 'since': 5}
+        changes = [{'seq': 6, 'id': 'a', 'doc': {}}, {'last_seq': 7}]
+        bridge.db.changes.side_effect = [iter(changes), Exception('Connection lost')]
+        mock_sleep.side_effect = [KeyboardInterrupt()]
+        with self.assertRaises(KeyboardInterrupt):
+            bridge.follow_changes()
+        self.assertEqual(bridge.db.changes.call_args_list[0][1]['since'], 5)
+        self.assertEqual(bridge.db.changes.call_args_list[0][1]['feed'], 'continuous')
+        self.assertEqual(bridge.db.changes.call_args_list[1][1]['since'], 7)
+        bridge.put_changed_resource_item.assert_called_once_with(changes[0])
+        self.assertEqual(bridge.db.save.call_args[0][0]['since'], 6)
+        self.assertEqual(bridge.log_dict['exceptions_count'], 1)
+
+    @patch('openprocurement.archivarius.core.bridge.sleep')
+    def test_sweep_controller(self, mock_sleep):
+        bridge = ArchivariusBridge(self.config)
+        bridge.resources = {'tenders': {}, 'plans': {}}
+        bridge.filter_workers_pool = MagicMock()
+        bridge.filter_workers_pool.__len__.side_effect = [1, 0]
+        mock_sleep.side_effect = [None, None, KeyboardInterrupt()]
+        with self.assertRaises(KeyboardInterrupt):
+            bridge.sweep_controller()
+        self.assertEqual(bridge.filter_workers_pool.spawn.call_count, 2)
+        self.assertEqual(bridge.filter_workers_pool.spawn.call_args[1]['resume'], False)
+
+    @patch('openprocurement.archivarius.core.bridge.ifilter')
+    def test_fill_resource_items_queue_include_docs(self, mock_ifilter):
+        doc = {'_id': uuid.uuid4().hex, '_rev': '1-' + uuid.uuid4().hex}
+        mock_ifilter.return_value = [munchify({'id': doc['_id'], 'key': "2015", 'doc': doc})]
+        self.config.set('main', 'scan_include_docs', 'True')
+        bridge = ArchivariusBridge(self.config)
+        self.config.remove_option('main', 'scan_include_docs')
+        self.assertEqual(bridge.scan_include_docs, True)
+        bridge.db = MagicMock()
+        bridge.resources['tenders'] = {'view_path': 'path', 'filter': MagicMock()}
+        bridge.fill_resource_items_queue('tenders')
+        self.assertEqual(bridge.db.iterview.call_args[1], {'include_docs': True})
+        resource_item = bridge.resource_items_queue.get()
+        self.assertEqual(resource_item['doc'], doc)
+        self.assertEqual(resource_item['doc']['_rev'], doc['_rev'])
+
+    @patch('openprocurement.archivarius.core.bridge.ArchivePipeline.spawn')
+    @patch('openprocurement.archivarius.core.bridge.ArchiveWorker.spawn')
+    def test_create_worker(self, mock_worker_spawn, mock_pipeline_spawn):
+        bridge = ArchivariusBridge(self.config)
+        self.assertEqual(bridge.worker_pipeline, False)
+        bridge.create_worker(bridge.resource_items_queue)
+        self.assertEqual(mock_worker_spawn.call_count, 1)
+        self.assertEqual(mock_pipeline_spawn.call_count, 0)
+
+        self.config.set('main', 'worker_pipeline', 'True')
+        self.config.set('main', 'dump_get_concurrency', '8')
+        self.config.set('main', 'dump_on_delete', 'false')
+        bridge = ArchivariusBridge(self.config)
+        self.config.remove_option('main', 'worker_pipeline')
+        self.config.remove_option('main', 'dump_get_concurrency')
+        self.config.remove_option('main', 'dump_on_delete')
+        self.assertEqual(bridge.workers_config['dump_get_concurrency'], 8)
+        self.assertEqual(bridge.workers_config['dump_on_delete'], False)
+        bridge.create_worker(bridge.resource_items_queue)
+        self.assertEqual(mock_worker_spawn.call_count, 1)
+        self.assertEqual(mock_pipeline_spawn.call_count, 1)
+        self.assertEqual(mock_pipeline_spawn.call_args[0][1], bridge.resource_items_queue)
+        self.assertEqual(mock_pipeline_spawn.call_args[1]['retry_scheduler'], bridge.retry_scheduler)
+        self.assertEqual(bridge.retry_scheduler.retry_queue, bridge.retry_resource_items_queue)
+
+    def test_put_resource_item(self):
+        bridge = ArchivariusBridge(self.config)
+        checkpoint = ScanCheckpoint(MagicMock(), 'tenders')
+        item = {'id': uuid.uuid4().hex, 'dateModified': '2016-01-01', 'resource': 'tenders'}
+        self.assertEqual(bridge.put_resource_item(dict(item), checkpoint), True)
+        self.assertEqual(bridge.put_resource_item(dict(item), checkpoint), False)
+        self.assertEqual(bridge.resource_items_queue.qsize(), 1)
+        self.assertEqual(bridge.log_dict['add_to_resource_items_queue'], 1)
+        self.assertEqual(bridge.log_dict['skiped'], 1)
+        self.assertEqual(bridge.in_flight, set([item['id']]))
+        self.assertEqual(checkpoint.in_flight.keys(), [item['id']])
+
+        self.assertEqual(bridge.metrics.counters[('add_to_resource_items_queue', 'tenders')], 1)
+        self.assertEqual(bridge.metrics.counters[('skiped', 'tenders')], 1)
+
+        # Finished or dropped item can be queued again
+        bridge.resource_item_done(bridge.resource_items_queue.get())
+        self.assertEqual(bridge.in_flight, set())
+        self.assertEqual(bridge.put_resource_item(dict(item)), True)
+        self.assertEqual(bridge.resource_items_queue.qsize(), 1)
+
+    @patch('openprocurement.archivarius.core.bridge.APIClient')
+    def test_metrics_gauges(self, mock_APIClient):
+        bridge = ArchivariusBridge(self.config)
+        mock_APIClient.return_value.session.headers = {'User-Agent': 'ArchivariusBridge/1'}
+        bridge.create_api_client()
+        bridge.api_clients[0]['request_interval'] = 0.5
+        bridge.resource_items_queue.put({'id': '1'})
+        pipeline = MagicMock(spec=ArchivePipeline)
+        pipeline.stages_status.return_value = [('edge_get', 1, 1), ('dump_get', 5, 2)]
+        bridge.workers_pool.add(pipeline)
+        bridge.workers_pool.add(MagicMock(spec=ArchivePipeline, **{
+            'stages_status.return_value': [('edge_get', 0, 1), ('dump_get', 3, 2)]}))
+        gauges = bridge.metrics_gauges()
+        self.assertIn(('queue_items', {'queue': 'main'}, 1), gauges)
+        self.assertIn(('queue_items', {'queue': 'api_clients'}, 1), gauges)
+        self.assertIn(('workers', {'pool': 'main'}, 2), gauges)
+        self.assertIn(('api_client_request_interval', {'client': 'ArchivariusBridge/1'}, 0.5), gauges)
+        self.assertIn(('stage_queue_items', {'pool': 'main', 'stage': 'dump_get'}, 8), gauges)
+        self.assertIn(('stage_running', {'pool': 'main', 'stage': 'edge_get'}, 2), gauges)
+        self.assertIn('archivarius_queue_items{queue="main"} 1', bridge.metrics.render(gauges))
+
+    def test_write_run_summary(self):
+        directory = tempfile.mkdtemp()
+        bridge = ArchivariusBridge(self.config)
+        bridge.run_summary_path = os.path.join(directory, 'summary.json')
+        bridge.log_dict['archived'] = 3
+        bridge.metrics.observe('edge_get', 'tenders', 'ok', 0.1)
+        bridge.log_stage_latency()
+        bridge.write_run_summary(time() - 10)
+        with open(bridge.run_summary_path) as summary_file:
+            summary = json.load(summary_file)
+        shutil.rmtree(directory)
+        self.assertEqual(summary['counters']['archived'], 3)
+        self.assertTrue(summary['duration'] >= 10)
+        self.assertEqual(summary['stages']['edge_get']['tenders']['ok']['count'], 1)
+        self.assertIn('p99', summary['stages']['edge_get']['tenders']['all'])
+
+    def test_replay_dead_letters(self):
+        directory = tempfile.mkdtemp()
+        self.config.set('main', 'dead_letters_path', os.path.join(directory, 'dead_letters'))
+        self.config.set('main', 'retry_spool_path', os.path.join(directory, 'retry.spool'))
+        bridge = ArchivariusBridge(self.config)
+        self.config.remove_option('main', 'dead_letters_path')
+        self.config.remove_option('main', 'retry_spool_path')
+        self.assertIsInstance(bridge.retry_resource_items_queue, SpillingQueue)
+        self.assertEqual(bridge.retry_scheduler.retry_queue, bridge.retry_resource_items_queue)
+        item = {'id': uuid.uuid4().hex, 'resource': 'tenders', 'dateModified': '2016-01-01',
+                'retries_count': 11, 'timeout': 6144, 'stage': 'edge_delete', '_rev': '1-edge'}
+        bridge.dead_letters.add(item)
+        bridge.replay_dead_letters()
+        self.assertEqual(bridge.resource_items_queue.get_nowait(),
+                         {'id': item['id'], 'resource': 'tenders', 'dateModified': '2016-01-01',
+                          'stage': 'edge_delete', '_rev': '1-edge'})
+        self.assertEqual(bridge.log_dict['add_to_resource_items_queue'], 1)
+        self.assertEqual(list(bridge.dead_letters.replay()), [])
+        shutil.rmtree(directory)
+
+        bridge = ArchivariusBridge(self.config)
+        self.assertEqual(bridge.dead_letters, None)
+        self.assertRaises(ConfigError, bridge.run, replay_dead_letters=True)
+
+    def test_replay_dump_spool(self):
+        self.config.set('main', 'dump_on_delete', 'true')
+        self.assertRaises(ConfigError, ArchivariusBridge, self.config)
+        directory = tempfile.mkdtemp()
+        self.config.set('main', 'dump_spool_path', os.path.join(directory, 'dumps'))
+        self.config.set('main', 'resource_items_queue_size', '1')
+        bridge = ArchivariusBridge(self.config)
+        self.config.remove_option('main', 'dump_on_delete')
+        self.config.remove_option('main', 'dump_spool_path')
+        self.config.remove_option('main', 'resource_items_queue_size')
+        items = [{'id': uuid.uuid4().hex, 'resource': 'tenders', 'dateModified': '2016-01-01',
+                  'stage': 'secret_save', '_rev': '1-edge', 'secret': {'tender': {}}} for _ in range(2)]
+        for item in items:
+            bridge.dump_spool.add(item)
+
+        # Edge documents of spooled dumps aren't queued by scan
+        bridge.replay_dump_spool()
+        self.assertEqual(bridge.in_flight, set(item['id'] for item in items))
+        self.assertFalse(bridge.put_resource_item(dict(items[0], stage=None)))
+        # Spooled items don't block on full queue
+        self.assertEqual(len(bridge.filter_workers_pool), 1)
+        replayed = [bridge.resource_items_queue.get(timeout=1) for _ in items]
+        self.assertEqual(sorted(replayed), sorted(items))
+        self.assertEqual(bridge.log_dict['add_to_resource_items_queue'], 2)
+        shutil.rmtree(directory)
+
+    def test_register_spilled_items(self):
+        directory = tempfile.mkdtemp()
+        self.config.set('main', 'retry_spool_path', os.path.join(directory, 'retry.spool'))
+        self.config.set('main', 'retry_spool_memory_limit', '1')
+        bridge = ArchivariusBridge(self.config)
+        items = [{'id': uuid.uuid4().hex, 'resource': 'tenders', 'dateModified': '2016-01-0{}'.format(i),
+                  'stage': 'secret_save', '_rev': '1-edge'} for i in range(1, 4)]
+        for item in items:
+            bridge.retry_resource_items_queue.put(item)
+
+        # Items spilled by previous run are in flight until archived
+        bridge = ArchivariusBridge(self.config)
+        self.config.remove_option('main', 'retry_spool_path')
+        self.config.remove_option('main', 'retry_spool_memory_limit')
+        bridge.checkpoints['tenders'] = checkpoint = ScanCheckpoint(MagicMock(), 'tenders')
+        bridge.register_spilled_items()
+        self.assertEqual(bridge.in_flight, set(item['id'] for item in items[1:]))
+        self.assertFalse(bridge.put_resource_item(dict(items[1], stage=None)))
+        self.assertEqual(checkpoint.watermark(), ('2016-01-02', items[1]['id']))
+        bridge.resource_item_done(bridge.retry_resource_items_queue.get_nowait())
+        self.assertEqual(checkpoint.watermark(), ('2016-01-03', items[2]['id']))
+        shutil.rmtree(directory)
 
     @patch('openprocurement.archivarius.core.bridge.spawn')
     @patch('openprocurement.archivarius.core.bridge.ArchiveWorker.spawn')
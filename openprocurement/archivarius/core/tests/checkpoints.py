@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import unittest
+import uuid
+from mock import MagicMock
+from munch import munchify
+
+from openprocurement.archivarius.core.checkpoints import ScanCheckpoint
+
+
+class TestScanCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MagicMock()
+        self.checkpoint = ScanCheckpoint(self.db, 'tenders')
+
+    def item(self, date_modified):
+        return {'id': uuid.uuid4().hex, 'dateModified': date_modified, 'resource': 'tenders'}
+
+    def test_init(self):
+        self.assertEqual(self.checkpoint.doc_id, '_local/archivarius_tenders')
+        self.assertEqual(self.checkpoint.positions, {})
+        self.assertEqual(self.checkpoint.in_flight, {})
+        self.assertEqual(self.checkpoint.completed, False)
+
+    def test_load(self):
+        self.db.get.return_value = None
+        self.assertEqual(self.checkpoint.load(), None)
+        self.db.get.return_value = {'_id': self.checkpoint.doc_id, 'key': '2016', 'id': 'abc'}
+        self.assertEqual(self.checkpoint.load(), ('2016', 'abc'))
+        self.db.get.assert_called_with('_local/archivarius_tenders')
+
+    def test_watermark(self):
+        self.checkpoint.start(0, {})
+        self.checkpoint.start(1, {'startkey': '2016-06'})
+        # First partition did not scan anything yet
+        self.assertEqual(self.checkpoint.watermark(), None)
+
+        self.checkpoint.scanned(0, munchify({'key': '2016-01', 'id': 'a'}))
+        self.assertEqual(self.checkpoint.watermark(), ('2016-01', 'a'))
+        item = self.item('2016-01')
+        self.checkpoint.add(item)
+        self.checkpoint.scanned(0, munchify({'key': '2016-03', 'id': 'b'}))
+        self.assertEqual(self.checkpoint.watermark(), ('2016-01', item['id']))
+
+        # In flight items hold watermark after partition is finished
+        self.checkpoint.finish(0)
+        self.checkpoint.scanned(1, munchify({'key': '2016-07', 'id': 'c'}))
+        self.assertEqual(self.checkpoint.watermark(), ('2016-01', item['id']))
+        self.checkpoint.done(item)
+        self.assertEqual(self.checkpoint.watermark(), ('2016-07', 'c'))
+        self.checkpoint.finish(1)
+        self.assertEqual(self.checkpoint.completed, True)
+
+    def test_save(self):
+        self.db.get.return_value = {'_id': self.checkpoint.doc_id}
+
+        # Nothing to save before scan starts
+        self.checkpoint.save()
+        self.assertEqual(self.db.save.call_count, 0)
+        self.assertEqual(self.db.delete.call_count, 0)
+
+        self.checkpoint.start(0, {'startkey': '2016-01', 'startkey_docid': 'a'})
+        item = self.item('2016-02')
+        self.checkpoint.add(item)
+        self.checkpoint.save()
+        self.db.save.assert_called_once_with({'_id': self.checkpoint.doc_id, 'key': '2016-01', 'id': 'a'})
+
+        # Unchanged watermark is not saved again
+        self.db.get.return_value = {'_id': self.checkpoint.doc_id, '_rev': '0-1', 'key': '2016-01', 'id': 'a'}
+        self.checkpoint.save()
+        self.assertEqual(self.db.save.call_count, 1)
+
+        # Completed scan removes checkpoint
+        self.checkpoint.finish(0)
+        self.checkpoint.save()
+        self.assertEqual(self.db.save.call_args[0][0]['key'], '2016-02')
+        self.checkpoint.done(item)
+        self.checkpoint.save()
+        self.db.delete.assert_called_once_with(self.db.get.return_value)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestScanCheckpoint))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
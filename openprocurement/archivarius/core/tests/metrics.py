@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import unittest
+from mock import MagicMock
+
+from openprocurement.archivarius.core.metrics import (
+    BUCKET_FACTOR, CONTENT_TYPE, Histogram, Metrics, format_sample, metrics_app
+)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_format_sample(self):
+        self.assertEqual(format_sample('archivarius_workers', {}, 2), 'archivarius_workers 2')
+        self.assertEqual(format_sample('archivarius_workers', {'pool': 'main', 'a': 'x"y'}, 2),
+                         'archivarius_workers{a="x\\"y",pool="main"} 2')
+
+    def test_render(self):
+        self.metrics.inc('archived', 'tenders')
+        self.metrics.inc('archived', 'tenders')
+        self.metrics.inc('archived', 'plans')
+        self.metrics.inc('exceptions_count', 'plans', 3)
+        self.assertEqual(self.metrics.render([('workers', {'pool': 'main'}, 1)]), '\n'.join([
+            '# TYPE archivarius_archived_total counter',
+            'archivarius_archived_total{resource="plans"} 1',
+            'archivarius_archived_total{resource="tenders"} 2',
+            '# TYPE archivarius_exceptions_count_total counter',
+            'archivarius_exceptions_count_total{resource="plans"} 3',
+            '# TYPE archivarius_workers gauge',
+            'archivarius_workers{pool="main"} 1',
+        ]) + '\n')
+
+    def test_update_rates(self):
+        self.metrics.inc('archived', 'tenders', 10)
+        self.metrics.inc('exceptions_count', 'tenders', 10)
+        self.metrics.snapshot = ({('archived', 'tenders'): 4}, self.metrics.snapshot[1] - 2)
+        self.metrics.update_rates()
+        self.assertEqual(self.metrics.rates.keys(), [('archived', 'tenders')])
+        self.assertAlmostEqual(self.metrics.rates[('archived', 'tenders')], 3, places=1)
+        self.assertIn('archivarius_archived_per_second{resource="tenders"}', self.metrics.render())
+        self.assertEqual(self.metrics.snapshot[0][('archived', 'tenders')], 10)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.summary(), {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0})
+        for _ in range(90):
+            histogram.add(0.01)
+        for _ in range(10):
+            histogram.add(1)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.total, 10.9)
+        # Quantiles are upper bounds of buckets
+        self.assertTrue(0.01 <= histogram.quantile(0.5) < 0.01 * BUCKET_FACTOR)
+        self.assertTrue(1 <= histogram.quantile(0.95) < BUCKET_FACTOR)
+        histogram.add(0)
+        self.assertEqual(histogram.buckets[0], 1)
+
+        other = Histogram()
+        other.add(1)
+        histogram.merge(other)
+        self.assertEqual(histogram.count, 102)
+        self.assertEqual(histogram.buckets[other.buckets.keys()[0]], 11)
+
+    def test_observe(self):
+        self.metrics.observe('edge_get', 'tenders', 'ok', 0.1)
+        self.metrics.observe('edge_get', 'tenders', 'failed', 0.2)
+        summary = self.metrics.stages_summary()
+        self.assertEqual(summary.keys(), ['edge_get'])
+        self.assertEqual(sorted(summary['edge_get']['tenders']), ['all', 'failed', 'ok'])
+        self.assertEqual(summary['edge_get']['tenders']['all']['count'], 2)
+        self.assertAlmostEqual(summary['edge_get']['tenders']['all']['mean'], 0.15)
+
+        rendered = self.metrics.render()
+        self.assertIn('# TYPE archivarius_stage_seconds summary', rendered)
+        self.assertIn('archivarius_stage_seconds_count{outcome="ok",resource="tenders",stage="edge_get"} 1',
+                      rendered)
+        self.assertIn('archivarius_stage_seconds{outcome="ok",quantile="0.99",resource="tenders",'
+                      'stage="edge_get"}', rendered)
+
+    def test_metrics_app(self):
+        bridge = MagicMock()
+        bridge.metrics = self.metrics
+        bridge.metrics_gauges.return_value = [('in_flight_items', {}, 5)]
+        start_response = MagicMock()
+        app = metrics_app(bridge)
+
+        body = app({'PATH_INFO': '/metrics'}, start_response)
+        start_response.assert_called_once_with('200 OK', [('Content-Type', CONTENT_TYPE)])
+        self.assertEqual(body, ['# TYPE archivarius_in_flight_items gauge\narchivarius_in_flight_items 5\n'])
+
+        app({'PATH_INFO': '/'}, start_response)
+        self.assertEqual(start_response.call_args[0][0], '404 Not Found')
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestMetrics))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
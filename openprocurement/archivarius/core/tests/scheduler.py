@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import unittest
+from gevent import sleep
+from gevent.queue import Queue
+
+from openprocurement.archivarius.core.scheduler import RetryScheduler
+
+
+class TestRetryScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = Queue()
+        self.scheduler = RetryScheduler(self.queue)
+
+    def test_schedule(self):
+        self.assertEqual(self.scheduler.pending, 0)
+        self.assertEqual(self.scheduler.next_due(), None)
+        self.scheduler.schedule({'id': 'late'}, 60)
+        self.scheduler.schedule({'id': 'early'}, 30)
+        self.scheduler.schedule({'id': 'same'}, 30)
+        self.assertEqual(self.scheduler.pending, 3)
+        self.assertEqual(self.scheduler.next_due(), self.scheduler.heap[0][0])
+        self.assertEqual(self.scheduler.heap[0][2], {'id': 'early'})
+
+    def test_release_due(self):
+        self.scheduler.schedule({'id': 'late'}, 60)
+        self.scheduler.schedule({'id': 'due'}, 0)
+        self.assertEqual(self.scheduler.release_due(), 1)
+        self.assertEqual(self.queue.get_nowait(), {'id': 'due'})
+        self.assertTrue(self.queue.empty())
+        self.assertEqual(self.scheduler.pending, 1)
+
+    def test_run(self):
+        self.scheduler.start()
+        self.scheduler.schedule({'id': 'late'}, 0.4)
+        self.scheduler.schedule({'id': 'early'}, 0.2)
+        sleep(0.1)
+        self.assertTrue(self.queue.empty())
+        sleep(0.2)
+        self.assertEqual(self.queue.get_nowait(), {'id': 'early'})
+        self.assertTrue(self.queue.empty())
+        sleep(0.2)
+        self.assertEqual(self.queue.get_nowait(), {'id': 'late'})
+        self.assertEqual(self.scheduler.pending, 0)
+        self.scheduler.shutdown()
+        sleep(0)
+        self.assertTrue(self.scheduler.dead)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestRetryScheduler))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from gevent.queue import Empty
+
+from openprocurement.archivarius.core.spool import DeadLetterSpool, DumpSpool, SpillingQueue
+
+
+class TestSpillingQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'retry.spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_spill(self):
+        queue = SpillingQueue(self.path, 2)
+        for i in range(5):
+            queue.put({'id': str(i)})
+        self.assertEqual(queue.qsize(), 5)
+        self.assertEqual(queue.queue.qsize(), 2)
+        self.assertEqual(queue.spilled, 3)
+
+        # Order is kept while spilled items are read back
+        self.assertEqual([queue.get(timeout=0.1)['id'] for _ in range(3)], ['0', '1', '2'])
+        queue.put({'id': '5'})
+        self.assertEqual([queue.get_nowait()['id'] for _ in range(3)], ['3', '4', '5'])
+        self.assertTrue(queue.empty())
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertRaises(Empty, queue.get_nowait)
+
+        queue.put({'id': '6'})
+        self.assertEqual(queue.spilled, 0)
+        self.assertEqual(queue.get_nowait(), {'id': '6'})
+
+    def test_restore(self):
+        queue = SpillingQueue(self.path, 1)
+        for i in range(3):
+            queue.put({'id': str(i)})
+        with open(self.path, 'a') as spool:
+            spool.write('{"id": "unfinished')
+
+        # Items spilled by previous run are picked up
+        queue = SpillingQueue(self.path, 1)
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual([item['id'] for item in queue.spilled_items()], ['1', '2'])
+        self.assertEqual([queue.get_nowait()['id'] for _ in range(2)], ['1', '2'])
+        self.assertTrue(queue.empty())
+        self.assertEqual(list(queue.spilled_items()), [])
+
+
+class TestDeadLetterSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dead_letters')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay(self):
+        spool = DeadLetterSpool(self.path)
+        self.assertEqual(list(spool.replay()), [])
+        spool.add({'id': '1', 'retries_count': 11})
+        spool.add({'id': '2', 'retries_count': 11})
+
+        replayed = []
+        for item in spool.replay():
+            replayed.append(item)
+            spool.add(item)  # dropped again
+        self.assertEqual([item['id'] for item in replayed], ['1', '2'])
+        self.assertFalse(os.path.exists(self.path + '.replay'))
+        self.assertEqual([item['id'] for item in spool.replay()], ['1', '2'])
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestDumpSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dumps')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_items(self):
+        spool = DumpSpool(self.path)
+        self.assertEqual(list(spool.items()), [])
+        items = [{'id': str(i), 'resource': 'tenders', 'stage': 'secret_save',
+                  'secret': {'tender': {'item': 'dump'}}} for i in range(3)]
+        for item in items:
+            spool.add(item)
+        spool.remove(items[1])
+        spool.remove(items[1])  # already removed
+        # Unfinished write is dropped
+        with open(os.path.join(self.path, 'tenders.3.json.tmp'), 'w') as tmp_file:
+            tmp_file.write('{"id": "3"')
+
+        spool = DumpSpool(self.path)
+        self.assertEqual(list(spool.items()), [items[0], items[2]])
+        self.assertEqual(sorted(os.listdir(self.path)), ['tenders.0.json', 'tenders.2.json'])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSpillingQueue))
+    suite.addTest(unittest.makeSuite(TestDeadLetterSpool))
+    suite.addTest(unittest.makeSuite(TestDumpSpool))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
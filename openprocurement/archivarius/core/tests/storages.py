@@ -0,0 +1,617 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from base64 import b64decode, b64encode
+from couchdb import Database
+from gevent import joinall, sleep, spawn
+from couchdb.client import Document
+from json import dumps, loads
+from time import sleep as time_sleep, time
+from boto.exception import S3ResponseError
+from mock import MagicMock, patch
+
+from openprocurement.archivarius.core.db import ConfigError
+from openprocurement.archivarius.core.storages import CouchStorage, S3Storage
+from openprocurement.archivarius.core.storages.filesystem import FileSystemStorage
+from openprocurement.archivarius.core.storages.segments import SegmentStorage
+from openprocurement.archivarius.core.storages.composite import CompositeStorage, get_quorum
+from openprocurement.archivarius.core.storages.compression import decode, encode, get_encoding, iterdumps, iterencode
+from openprocurement.archivarius.core.tests.workers import MockConnection, MockKey
+
+
+def secret_doc(doc_id=None):
+    return {
+        '_id': doc_id or uuid.uuid4().hex,
+        'dateModified': '2017-01-01T00:00:00+02:00',
+        'data': {
+            'dateModified': '2017-01-01T00:00:00+02:00',
+            'tender': {'item': b64encode(os.urandom(1000)), 'pubkey': b64encode(os.urandom(32))},
+            'versions': {'openprocurement.api': '2.3'}
+        }
+    }
+
+
+class MemoryStorage(object):
+
+    def __init__(self, delay=0, error=None):
+        self.docs = {}
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def _request(self):
+        self.calls += 1
+        sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+
+    def save(self, data):
+        self._request()
+        self.docs[data['_id']] = data
+
+    def get(self, key):
+        self._request()
+        return self.docs.get(key)
+
+
+class NewerMemoryStorage(MemoryStorage):
+
+    def save_newer(self, data):
+        self._request()
+        if self.docs.get(data['_id'], {}).get('dateModified') >= data['dateModified']:
+            return False
+        self.docs[data['_id']] = data
+        return True
+
+    def get_date_modified(self, doc_id):
+        self._request()
+        return self.docs.get(doc_id, {}).get('dateModified')
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_get_encoding(self):
+        self.assertEqual(get_encoding(''), None)
+        self.assertEqual(get_encoding('zlib'), 'zlib')
+        self.assertRaises(ConfigError, get_encoding, 'gzip')
+
+    def test_encode(self):
+        doc = secret_doc()
+        for encoding in ('packed', 'zlib'):
+            body = encode(doc, encoding)
+            # Item is kept binary
+            self.assertLess(len(body), len(dumps(doc)) - len(doc['data']['tender']['item']) / 5)
+            self.assertEqual(decode(body, encoding), doc)
+        self.assertRaises(ValueError, decode, body, 'gzip')
+
+        # Documents without dump are packed as is
+        doc = {'_id': uuid.uuid4().hex, 'data': 'data'}
+        self.assertEqual(decode(encode(doc, 'zlib'), 'zlib'), doc)
+
+    def test_iterencode(self):
+        doc = secret_doc()
+        doc['data']['contract'] = {'item': b64encode(os.urandom(998))}
+        chunks = list(iterencode(doc, 'packed', chunk_size=100))
+        # Header chunk, then blobs by 75 bytes decoded from 100 chars
+        self.assertEqual(max(len(chunk) for chunk in chunks[1:]), 75)
+        self.assertEqual(decode(''.join(chunks), 'packed'), doc)
+        self.assertEqual(decode(''.join(iterencode(doc, 'zlib', chunk_size=99)), 'zlib'), doc)
+
+    def test_iterdumps(self):
+        doc = secret_doc()
+        doc['data']['names'] = [u'\u0422\u0435\u043d\u0434\u0435\u0440 "1"\n' * 10, None, 1.5, True, {1: 'one'}]
+        chunks = list(iterdumps(doc, chunk_size=100))
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), 6 * 100)
+        self.assertEqual(loads(''.join(chunks)), loads(dumps(doc)))
+
+
+class TestStorages(unittest.TestCase):
+
+    @patch('openprocurement.archivarius.core.storages.storages.Key', MockKey)
+    def test_s3_encoding(self):
+        conn = MockConnection()
+        bucket = conn.create_bucket('bucket')
+        doc = secret_doc()
+        S3Storage(conn, 'bucket').save(dict(doc))
+        compressed_doc = secret_doc()
+        secret_archive = S3Storage(conn, 'bucket', encoding='zlib')
+        self.assertTrue(secret_archive.save_newer(dict(compressed_doc)))
+
+        key = bucket.get_key(secret_archive._parse_key(compressed_doc['_id']))
+        self.assertEqual(key.get_metadata('encoding'), 'zlib')
+        self.assertEqual(key.content_type, 'application/octet-stream')
+        self.assertEqual(secret_archive.get(compressed_doc['_id']), dict(compressed_doc, _rev=1))
+        # Objects written without compression are still readable
+        self.assertEqual(secret_archive.get(doc['_id']), dict(doc, _rev=1))
+
+    def test_s3_get(self):
+        connection = MagicMock()
+        bucket = connection.get_bucket.return_value
+        doc = secret_doc()
+        key = bucket.get_key.return_value
+        key.get_contents_as_string.return_value = dumps(doc)
+        key.get_metadata.return_value = None
+        secret_archive = S3Storage(connection, 'bucket')
+        self.assertEqual(secret_archive.get(doc['_id']), doc)
+        bucket.get_key.assert_called_once_with(secret_archive._parse_key(doc['_id']))
+        # Key path isn't passed as boto headers
+        key.get_contents_as_string.assert_called_once_with()
+
+        bucket.get_key.return_value = None
+        self.assertEqual(secret_archive.get(doc['_id']), None)
+        self.assertEqual(secret_archive.get('not uuid'), None)
+
+    @patch('openprocurement.archivarius.core.storages.storages.Key')
+    def test_s3_multipart(self, key):
+        connection = MagicMock()
+        bucket = connection.get_bucket.return_value
+        key.return_value.bucket = bucket
+        key.return_value.name = 'path'
+        key.return_value.metadata = {}
+        key.return_value.set_metadata.side_effect = key.return_value.metadata.__setitem__
+        upload = bucket.initiate_multipart_upload.return_value
+        upload.key_name, upload.id = 'path', 'upload'
+        secret_archive = S3Storage(connection, 'bucket', encoding='packed')
+        secret_archive.part_size = 512 * 1024
+        parts = []
+        upload.upload_part_from_file.side_effect = lambda part, number, size: \
+            parts.append(part.read(size)) or MagicMock(etag='"{}"'.format(number))
+        doc = secret_doc()
+        doc['data']['tender']['item'] = b64encode(os.urandom(3 * 1024 * 1024))
+        secret_archive.save(doc)
+
+        # Document doesn't fit into one part
+        self.assertEqual(key.return_value.set_contents_from_string.call_count, 0)
+        bucket.initiate_multipart_upload.assert_called_once_with(
+            'path', headers={'Content-Type': 'application/octet-stream'},
+            metadata={'rev': '1', 'datemodified': doc['dateModified'], 'encoding': 'packed'})
+        # Every part but the last is part_size
+        self.assertEqual(len(parts), 7)
+        self.assertEqual(set(len(part) for part in parts[:-1]), {512 * 1024})
+        self.assertEqual(decode(''.join(parts), 'packed'), doc)
+        bucket.complete_multipart_upload.assert_called_once_with(
+            'path', 'upload', '<CompleteMultipartUpload>' + ''.join(
+                '<Part><PartNumber>{0}</PartNumber><ETag>"{0}"</ETag></Part>'.format(number) for number in range(1, 8)
+            ) + '</CompleteMultipartUpload>', headers={'If-None-Match': '*'})
+
+        # Failed upload is cancelled
+        bucket.complete_multipart_upload.side_effect = S3ResponseError(412, 'Precondition Failed')
+        self.assertRaises(S3ResponseError, secret_archive.save, doc)
+        upload.cancel_upload.assert_called_once_with()
+
+        # Small document goes with one PUT
+        secret_archive.part_size = 4 * 1024 * 1024
+        secret_archive.save(doc)
+        self.assertEqual(bucket.initiate_multipart_upload.call_count, 2)
+        body = key.return_value.set_contents_from_string.call_args[0][0]
+        self.assertEqual(decode(body, 'packed'), doc)
+
+        # Long strings of plain JSON are split too
+        bucket.complete_multipart_upload.side_effect = None
+        secret_archive = S3Storage(connection, 'bucket')
+        secret_archive.part_size = 256 * 1024
+        del parts[:]
+        doc = secret_doc()
+        doc['data']['tender']['item'] = b64encode(os.urandom(3 * 1024 * 1024))
+        secret_archive.save(doc)
+        self.assertEqual(len(parts), 17)
+        self.assertEqual(set(len(part) for part in parts[:-1]), {256 * 1024})
+        self.assertEqual(loads(''.join(parts)), doc)
+
+    def test_s3_upload_file(self):
+        connection = MagicMock()
+        bucket = connection.get_bucket.return_value
+        upload = bucket.initiate_multipart_upload.return_value
+        secret_archive = S3Storage(connection, 'bucket')
+        with tempfile.NamedTemporaryFile() as upload_file:
+            upload_file.write('x' * 25)
+            upload_file.flush()
+            secret_archive.upload_file('segment', upload_file.name, part_size=10)
+            bucket.initiate_multipart_upload.assert_called_once_with('segment')
+            self.assertEqual([(args[1], kwargs['size']) for args, kwargs in upload.upload_part_from_file.call_args_list],
+                             [(1, 10), (2, 10), (3, 5)])
+            upload.complete_upload.assert_called_once_with()
+
+            upload.upload_part_from_file.side_effect = IOError
+            self.assertRaises(IOError, secret_archive.upload_file, 'segment', upload_file.name)
+            upload.cancel_upload.assert_called_once_with()
+
+        with patch('openprocurement.archivarius.core.storages.storages.Key') as key:
+            key.return_value.get_contents_as_string.return_value = 'data'
+            self.assertEqual(secret_archive.get_range('segment', 10, 4), 'data')
+        key.assert_called_once_with(bucket, 'segment')
+        key.return_value.get_contents_as_string.assert_called_once_with(headers={'Range': 'bytes=10-13'})
+
+    def test_couch_encoding(self):
+        doc = secret_doc()
+        storage = CouchStorage('http://127.0.0.1:5984/archive_db_secret', encoding='zlib')
+        with patch.object(Database, 'save', return_value=(doc['_id'], '1-rev')) as save:
+            data = dict(doc)
+            self.assertEqual(storage.save(data), (doc['_id'], '1-rev'))
+        self.assertEqual(data['_rev'], '1-rev')
+        packed_doc = save.call_args[0][0]
+        self.assertEqual(sorted(packed_doc), ['_attachments', '_id', 'dateModified', 'encoding'])
+        self.assertEqual(packed_doc['encoding'], 'zlib')
+        attachment = packed_doc['_attachments']['data']
+        self.assertEqual(decode(b64decode(attachment['data']), 'zlib'), doc)
+
+        stored_doc = Document(packed_doc, _rev='1-rev')
+        with patch.object(Database, 'get', return_value=stored_doc) as get:
+            self.assertEqual(storage.get(doc['_id']), dict(doc, _rev='1-rev'))
+        get.assert_called_once_with(doc['_id'], None, attachments=True)
+
+        # Plain documents are returned as is
+        with patch.object(Database, 'get', return_value=dict(doc, _rev='1-rev')):
+            self.assertEqual(storage.get(doc['_id']), dict(doc, _rev='1-rev'))
+        with patch.object(Database, 'get', return_value=None):
+            self.assertEqual(storage.get(doc['_id']), None)
+
+
+class TestSegmentStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'segments')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save(self):
+        storage = SegmentStorage(self.path, encoding='zlib')
+        doc = secret_doc()
+        self.assertEqual(storage.get(doc['_id']), None)
+        self.assertEqual(storage.get_date_modified(doc['_id']), None)
+        self.assertTrue(storage.save_newer(dict(doc)))
+        self.assertFalse(storage.save_newer(dict(doc)))
+        self.assertEqual(storage.get(doc['_id']), dict(doc, _rev=1))
+        self.assertEqual(storage.get_date_modified(doc['_id']), doc['dateModified'])
+
+        newer_doc = dict(doc, dateModified='2017-01-02T00:00:00+02:00')
+        storage.encoding = None
+        self.assertTrue(storage.save_newer(dict(newer_doc)))
+        self.assertEqual(storage.get(doc['_id']), dict(newer_doc, _rev=2))
+        self.assertEqual(storage.index[doc['_id']][0], 0)
+
+        # Index is restored on start
+        storage = SegmentStorage(self.path)
+        self.assertEqual(storage.get(doc['_id']), dict(newer_doc, _rev=2))
+
+    def test_recover(self):
+        storage = SegmentStorage(self.path)
+        doc, other_doc = secret_doc(), secret_doc()
+        storage.save(dict(doc))
+        storage.save(dict(other_doc))
+        size = os.path.getsize(storage._segment_path(0))
+        storage.segment_file.write('["unfinished", ')
+        storage.segment_file.flush()
+        # Last record lost its index entry
+        with open(os.path.join(self.path, 'index')) as index_file:
+            lines = index_file.readlines()
+        with open(os.path.join(self.path, 'index'), 'w') as index_file:
+            index_file.write(lines[0])
+
+        storage = SegmentStorage(self.path)
+        self.assertEqual(os.path.getsize(storage._segment_path(0)), size)
+        self.assertEqual(storage.get(other_doc['_id']), dict(other_doc, _rev=1))
+        storage.save(dict(other_doc))
+        self.assertEqual(storage.get(other_doc['_id'])['_rev'], 2)
+
+    def test_fsync(self):
+        storage = SegmentStorage(self.path, fsync_interval=0.05, fsync_batch=3)
+        with patch('os.fsync') as fsync:
+            greenlets = [spawn(storage.save, secret_doc()) for _ in range(2)]
+            sleep(0.01)
+            # Saves return once segment and index files are synced
+            self.assertEqual(fsync.call_count, 0)
+            self.assertFalse(any(greenlet.ready() for greenlet in greenlets))
+            joinall(greenlets, timeout=1)
+            self.assertTrue(all(greenlet.successful() for greenlet in greenlets))
+            self.assertEqual(fsync.call_count, 2)
+
+            fsync.side_effect = OSError(5, 'Input/output error')
+            self.assertRaises(OSError, storage.save, secret_doc())
+
+    def test_roll(self):
+        s3 = MagicMock()
+        uploaded = {}
+        s3.upload_file.side_effect = lambda name, path: uploaded.update({name: open(path, 'rb').read()})
+        s3.get_range.side_effect = lambda name, offset, length: uploaded[name][offset:offset + length]
+        storage = SegmentStorage(self.path, segment_size=1000, s3=s3, prefix='secret/',
+                                 upload_retry_interval=0.01)
+        docs = [secret_doc() for _ in range(3)]
+        for doc in docs:
+            storage.save(doc)
+        storage.uploader.join()
+
+        self.assertEqual(sorted(uploaded), ['secret/00000000.seg', 'secret/00000001.seg', 'secret/00000002.seg'])
+        self.assertEqual(sorted(os.listdir(self.path)), ['00000003.seg', 'index'])
+        self.assertEqual([storage.index[doc['_id']][0] for doc in docs], [0, 1, 2])
+        for doc in docs:
+            self.assertEqual(storage.get(doc['_id']), doc)
+        self.assertEqual(s3.get_range.call_count, 3)
+
+        # Failed upload doesn't fail save and is retried
+        s3.upload_file.side_effect = IOError
+        doc = secret_doc()
+        storage.save(doc)
+        sleep(0.05)
+        self.assertGreater(s3.upload_file.call_count, 4)
+        self.assertEqual(storage.uploads, [3])
+        self.assertEqual(storage.get(doc['_id']), doc)
+        s3.upload_file.side_effect = lambda name, path: uploaded.update({name: open(path, 'rb').read()})
+        storage.uploader.join()
+        self.assertEqual(storage.uploads, [])
+        self.assertFalse(os.path.exists(storage._segment_path(3)))
+        self.assertEqual(storage.get(doc['_id']), doc)
+
+        # Closed segment left after failed upload is uploaded on start
+        s3.upload_file.side_effect = IOError
+        storage.save(secret_doc())
+        storage.uploader.kill()
+        self.assertTrue(os.path.exists(storage._segment_path(4)))
+        s3.upload_file.side_effect = None
+        storage = SegmentStorage(self.path, segment_size=1000, s3=s3, prefix='secret/')
+        storage.uploader.join()
+        self.assertEqual(s3.upload_file.call_args[0][0], 'secret/00000004.seg')
+        self.assertEqual(storage.segment, 5)
+
+    def test_torn_index(self):
+        storage = SegmentStorage(self.path)
+        docs = [secret_doc() for _ in range(3)]
+        for doc in docs:
+            storage.save(dict(doc))
+        index_path = os.path.join(self.path, 'index')
+        with open(index_path) as index_file:
+            lines = index_file.readlines()
+        with open(index_path, 'w') as index_file:
+            index_file.write(lines[0] + lines[1][:10])
+
+        # Entries recovered from segment aren't glued to torn line
+        storage = SegmentStorage(self.path)
+        storage.save(secret_doc())
+        storage = SegmentStorage(self.path)
+        for doc in docs:
+            self.assertEqual(storage.get(doc['_id']), dict(doc, _rev=1))
+
+
+class TestFileSystemStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'archive')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save(self):
+        storage = FileSystemStorage(self.path, 10 ** 6, fsync_interval=0, merge_limit=3)
+        docs = [secret_doc() for _ in range(5)]
+        for doc in docs:
+            self.assertTrue(storage.save_newer(dict(doc)))
+        storage.merger.join()
+        # First three documents are in sorted index, last two in journal
+        self.assertEqual(storage.index_size, 3)
+        self.assertEqual(sorted(storage.index), sorted(doc['_id'] for doc in docs[3:]))
+        for doc in docs:
+            self.assertEqual(storage.get(doc['_id']), dict(doc, _rev=1))
+        self.assertEqual(storage.get(uuid.uuid4().hex), None)
+        self.assertEqual(storage.get_date_modified(docs[0]['_id']), docs[0]['dateModified'])
+        self.assertFalse(storage.save_newer(dict(docs[0])))
+
+        newer_doc = dict(docs[0], dateModified='2017-01-02T00:00:00+02:00')
+        self.assertTrue(storage.save_newer(dict(newer_doc)))
+        storage.merger.join()
+        # Journal entry replaced older one of index
+        self.assertEqual((storage.index_size, len(storage.index)), (5, 0))
+        self.assertEqual(storage.get(newer_doc['_id']), dict(newer_doc, _rev=2))
+        storage.save(dict(docs[1], _id=docs[1]['_id']))
+        self.assertEqual(storage.get(docs[1]['_id'])['_rev'], 2)
+        self.assertRaises(ValueError, storage.save, dict(docs[1], _id='x' * 33))
+
+        # Index and journal are loaded on start
+        storage = FileSystemStorage(self.path, 10 ** 6)
+        self.assertEqual((storage.index_size, len(storage.index)), (5, 1))
+        self.assertEqual(storage.get(newer_doc['_id']), dict(newer_doc, _rev=2))
+        self.assertEqual(storage.get(docs[1]['_id'])['_rev'], 2)
+        for doc in docs[2:]:
+            self.assertEqual(storage.get(doc['_id']), dict(doc, _rev=1))
+
+    def test_recover(self):
+        storage = FileSystemStorage(self.path, 10 ** 6, fsync_interval=0, merge_limit=3)
+        docs = [secret_doc() for _ in range(5)]
+        for doc in docs:
+            storage.save(dict(doc))
+        storage.merger.join()
+        # Journal of two entries lost the last one and the next is torn
+        journal_path = os.path.join(self.path, 'journal')
+        with open(journal_path) as journal_file:
+            lines = journal_file.readlines()
+        with open(journal_path, 'w') as journal_file:
+            journal_file.write(lines[0][:10])
+        storage.segment_file.write('["unfinished", ')
+        storage.segment_file.close()
+
+        # Recovered entries fill journal up to merge_limit on start
+        storage = FileSystemStorage(self.path, 10 ** 6, fsync_interval=0, merge_limit=2)
+        self.assertEqual((storage.index_size, len(storage.index)), (5, 0))
+        storage.save(secret_doc())
+        storage = FileSystemStorage(self.path, 10 ** 6, fsync_interval=0, merge_limit=2)
+        for doc in docs:
+            self.assertEqual(storage.get(doc['_id']), dict(doc, _rev=1))
+        self.assertEqual(len(storage.index), 1)
+
+    def test_fsync(self):
+        storage = FileSystemStorage(self.path, 10 ** 6, fsync_interval=0.05, fsync_batch=3)
+        with patch('os.fsync') as fsync:
+            greenlets = [spawn(storage.save, secret_doc()) for _ in range(2)]
+            sleep(0.01)
+            self.assertEqual(fsync.call_count, 0)
+            self.assertFalse(any(greenlet.ready() for greenlet in greenlets))
+            joinall(greenlets, timeout=1)
+            # Saves waited for one fsync of data and journal files
+            self.assertTrue(all(greenlet.successful() for greenlet in greenlets))
+            self.assertEqual(fsync.call_count, 2)
+
+            greenlets = [spawn(storage.save, secret_doc()) for _ in range(3)]
+            joinall(greenlets, timeout=0.02)
+            self.assertTrue(all(greenlet.successful() for greenlet in greenlets))
+            self.assertEqual(fsync.call_count, 4)
+            self.assertEqual(storage.sync_greenlet, None)
+
+            # Failed fsync is raised by every waiting save
+            fsync.side_effect = OSError(5, 'Input/output error')
+            greenlets = [spawn(storage.save, secret_doc()) for _ in range(2)]
+            joinall(greenlets, timeout=1)
+            self.assertTrue(all(isinstance(greenlet.exception, OSError) for greenlet in greenlets))
+            greenlets = [spawn(storage.save, secret_doc()) for _ in range(3)]
+            joinall(greenlets, timeout=1)
+            self.assertTrue(all(isinstance(greenlet.exception, OSError) for greenlet in greenlets))
+
+            # Save doesn't wait for fsync forever
+            fsync.side_effect = None
+            storage.fsync_interval = 10
+            storage.fsync_timeout = 0.01
+            self.assertRaises(IOError, storage.save, secret_doc())
+            storage.sync_greenlet.kill()
+
+    def test_background_merge(self):
+        storage = FileSystemStorage(self.path, 10 ** 6, fsync_interval=0, merge_limit=2)
+        write_index = storage._write_index
+
+        def slow_write_index(*args):
+            time_sleep(0.1)
+            write_index(*args)
+
+        docs = [secret_doc() for _ in range(4)]
+        with patch.object(storage, '_write_index', side_effect=slow_write_index):
+            for doc in docs[:3]:
+                storage.save(dict(doc))
+            # Saves don't wait for merge, frozen journal is still read
+            self.assertFalse(storage.merger.ready())
+            self.assertEqual(sorted(storage.merging), sorted(doc['_id'] for doc in docs[:2]))
+            self.assertEqual(list(storage.index), [docs[2]['_id']])
+            for doc in docs[:3]:
+                self.assertEqual(storage.get(doc['_id']), dict(doc, _rev=1))
+            storage.merger.join()
+        self.assertEqual((storage.index_size, storage.merging), (2, {}))
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'journal.merging')))
+
+        # Merge interrupted by restart is done on start
+        with patch.object(storage, '_write_index', side_effect=IOError('No space left on device')):
+            storage.save(dict(docs[3]))
+            sleep(0)
+            self.assertTrue(os.path.exists(os.path.join(self.path, 'journal.merging')))
+            storage.merger.kill()
+        storage = FileSystemStorage(self.path, 10 ** 6, fsync_interval=0, merge_limit=10)
+        self.assertEqual((storage.index_size, storage.index, storage.merging), (4, {}, {}))
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'journal.merging')))
+        for doc in docs:
+            self.assertEqual(storage.get(doc['_id']), dict(doc, _rev=1))
+
+
+class TestCompositeStorage(unittest.TestCase):
+
+    def test_get_quorum(self):
+        self.assertEqual(get_quorum('primary'), 'primary')
+        self.assertRaises(ConfigError, get_quorum, 'majority')
+
+    def test_quorum_all(self):
+        couch, s3 = MemoryStorage(), NewerMemoryStorage()
+        storage = CompositeStorage([('couchdb', couch), ('s3', s3)])
+        doc = secret_doc()
+        self.assertTrue(storage.save_newer(doc))
+        self.assertEqual(couch.docs[doc['_id']], doc)
+        self.assertEqual(s3.docs[doc['_id']], doc)
+        self.assertEqual(storage.get_date_modified(doc['_id']), doc['dateModified'])
+        self.assertFalse(storage.save_newer(doc))
+
+        # Document missing in one storage is not up to date
+        del couch.docs[doc['_id']]
+        self.assertEqual(storage.get_date_modified(doc['_id']), None)
+        newer_doc = dict(doc, dateModified='2017-01-02T00:00:00+02:00')
+        s3.error = IOError('S3 is down')
+        self.assertRaises(IOError, storage.save_newer, newer_doc)
+        # Other storages are written anyway
+        self.assertEqual(couch.docs[doc['_id']], newer_doc)
+
+    def test_quorum_any(self):
+        slow, fast = NewerMemoryStorage(delay=0.1), NewerMemoryStorage(error=IOError('down'))
+        storage = CompositeStorage([('slow', slow), ('fast', fast)], quorum='any')
+        doc = secret_doc()
+        self.assertTrue(storage.save_newer(doc))
+        fast.error = None
+        started = time()
+        self.assertTrue(storage.save_newer(dict(doc, dateModified='2017-01-02T00:00:00+02:00')))
+        self.assertLess(time() - started, 0.1)
+        # Slow storage is still written in background
+        self.assertEqual(slow.docs[doc['_id']]['dateModified'], doc['dateModified'])
+        sleep(0.15)
+        self.assertEqual(slow.docs[doc['_id']]['dateModified'], '2017-01-02T00:00:00+02:00')
+
+        fast.error = slow.error = IOError('down')
+        self.assertRaises(IOError, storage.save_newer, doc)
+
+    def test_quorum_primary(self):
+        primary, secondary = NewerMemoryStorage(), NewerMemoryStorage(delay=0.05)
+        storage = CompositeStorage([('primary', primary), ('secondary', secondary)], quorum='primary')
+        docs = [secret_doc() for _ in range(3)]
+        for doc in docs:
+            self.assertTrue(storage.save_newer(doc))
+        # Background writes are limited by concurrency
+        self.assertEqual(len(primary.docs), 3)
+        self.assertEqual(len(secondary.docs), 2)
+        storage.background.join()
+        self.assertEqual(len(secondary.docs), 3)
+
+        secondary.error = IOError('down')
+        doc = secret_doc()
+        self.assertTrue(storage.save_newer(doc))
+        storage.background.join()
+        self.assertEqual(storage.get_date_modified(doc['_id']), doc['dateModified'])
+        primary.error = IOError('down')
+        self.assertRaises(IOError, storage.save_newer, secret_doc())
+
+    def test_get(self):
+        slow, fast = NewerMemoryStorage(delay=0.02), NewerMemoryStorage()
+        storage = CompositeStorage([('slow', slow), ('fast', fast)])
+        doc = secret_doc()
+        storage.save_newer(doc)
+        for _ in range(3):
+            self.assertEqual(storage.get(doc['_id']), doc)
+        # Reads go to the fastest replica, both were timed by save
+        self.assertEqual((slow.calls, fast.calls), (1, 4))
+
+        # Failed replica is skipped until retry_interval passes
+        fast.error = IOError('down')
+        self.assertEqual(storage.get(doc['_id']), doc)
+        fast.error = None
+        self.assertEqual(storage.get(doc['_id']), doc)
+        self.assertEqual((slow.calls, fast.calls), (3, 5))
+        storage.retry_interval = 0
+        self.assertEqual(storage.get(doc['_id']), doc)
+        self.assertEqual(fast.calls, 6)
+
+        # Missing document is looked up in the next replica
+        del fast.docs[doc['_id']]
+        self.assertEqual(storage.get(doc['_id']), doc)
+        slow.error = IOError('down')
+        self.assertRaises(IOError, storage.get, doc['_id'])
+        slow.error = None
+        self.assertEqual(storage.get(uuid.uuid4().hex), None)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestCompression))
+    suite.addTest(unittest.makeSuite(TestStorages))
+    suite.addTest(unittest.makeSuite(TestSegmentStorage))
+    suite.addTest(unittest.makeSuite(TestFileSystemStorage))
+    suite.addTest(unittest.makeSuite(TestCompositeStorage))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 import datetime
+import json
+import os
+import shutil
+import tempfile
 import unittest
 import uuid
 import copy
 import boto
 from hashlib import md5
 from datetime import timedelta
-from gevent import sleep
+from couchdb.http import ResourceConflict
+from gevent import joinall, sleep, spawn, spawn_later
 from gevent.queue import Queue
 from mock import MagicMock, patch
 from munch import munchify
+from time import time
 from boto.utils import (
     merge_headers_by_name,
     find_matching_headers,
@@ -21,7 +27,9 @@ from openprocurement_client.exceptions import (
     RequestFailed,
     ResourceNotFound as RNF
 )
-from openprocurement.archivarius.core.workers import ArchiveWorker
+from openprocurement.archivarius.core.metrics import Metrics
+from openprocurement.archivarius.core.spool import SpillingQueue
+from openprocurement.archivarius.core.workers import ArchivePipeline, ArchiveWorker, STAGES
 from openprocurement.archivarius.core.storages import (
     S3Storage
 )
@@ -30,6 +38,14 @@ from openprocurement.archivarius.core.storages import (
 NOT_IMPL = None
 
 
+def edge_rows(*docs):
+    return [munchify({'key': doc['id'], 'doc': doc}) for doc in docs]
+
+
+def bulk_docs_results(docs):
+    return [(True, doc.get('id'), '2-' + uuid.uuid4().hex) for doc in docs]
+
+
 class MockAcl(object):
 
     def __init__(self, parent=NOT_IMPL):
@@ -85,9 +101,14 @@ class MockKey(object):
     def set_contents_from_string(self, s, headers=NOT_IMPL, replace=NOT_IMPL,
                                  cb=NOT_IMPL, num_cb=NOT_IMPL, policy=NOT_IMPL,
                                  md5=NOT_IMPL, reduced_redundancy=NOT_IMPL):
+        # Emulate conditional PUT, stored key is replaced with new one
+        stored = self.bucket.keys.get(self.name)
+        if stored is not None and stored is not self and headers is not NOT_IMPL and headers and (
+                headers.get('If-None-Match') == '*' or headers.get('If-Match', stored.etag) != stored.etag) or \
+                stored is None and headers is not NOT_IMPL and headers and 'If-Match' in headers:
+            raise boto.exception.S3ResponseError(412, 'Precondition Failed')
         self.data = copy.copy(s)
-        if self.name in self.bucket:
-            self.bucket.keys[self.name].data = self.data
+        self.bucket.keys[self.name] = self
 
         self.set_etag()
         self.size = len(s)
@@ -160,7 +181,7 @@ class MockKey(object):
         elif name.lower() == 'content-md5':
             return self.metadata['Content-MD5']
         else:
-            return self.metadata[name]
+            return self.metadata.get(name)
 
     def compute_md5(self, fp):
         """
@@ -292,8 +313,19 @@ class TestArchiveWorker(unittest.TestCase):
         'retry_default_timeout': 0.4,
         'retries_count': 5,
         'queue_timeout': 0.2,
+        'bulk_delete_interval': 1,
+        'bulk_delete_limit': 1,
+        'bulk_get_limit': 1,
         'bulk_save_limit': 1,
-        'bulk_save_interval': 1
+        'bulk_save_interval': 1,
+        'dump_on_delete': False,
+        'stage_queue_size': 2,
+        'edge_get_concurrency': 1,
+        'public_save_concurrency': 1,
+        'dump_get_concurrency': 2,
+        'secret_save_concurrency': 2,
+        'dump_delete_concurrency': 2,
+        'edge_delete_concurrency': 1
     }
 
     log_dict = {
@@ -336,6 +368,8 @@ class TestArchiveWorker(unittest.TestCase):
         self.assertEqual(worker.api_clients_queue, None)
         self.assertEqual(worker.resource_items_queue, None)
         self.assertEqual(worker.retry_resource_items_queue, None)
+        self.assertEqual(worker.done_callback, None)
+        self.assertEqual(worker.edge_deletes, [])
         self.assertGreater(datetime.datetime.now().isoformat(), worker.start_time.isoformat())
 
     def test_add_to_retry_queue(self):
@@ -370,13 +404,73 @@ class TestArchiveWorker(unittest.TestCase):
 
         # Drop from retry_resource_items_queue
         retry_item['retries_count'] = 6
+        worker.done_callback = MagicMock()
+        worker.dead_letters = MagicMock()
         self.assertEqual(worker.log_dict['droped'], 0)
         worker.add_to_retry_queue(retry_item)
         self.assertEqual(worker.log_dict['droped'], 1)
         self.assertEqual(retry_items_queue.qsize(), 0)
+        worker.done_callback.assert_called_once_with(retry_item)
+        worker.dead_letters.add.assert_called_once_with(retry_item)
 
+        # Item with dump deleted from cdb is never dropped
+        worker.config = dict(self.worker_config, dump_on_delete=True)
+        retry_item['retries_count'] = 6
+        retry_item['secret'] = {'tender': {}}
+        worker.add_to_retry_queue(retry_item)
+        self.assertEqual(worker.log_dict['droped'], 1)
+        retry_item_from_queue = retry_items_queue.get()
+        self.assertEqual(retry_item_from_queue['secret'], {'tender': {}})
+        self.assertEqual(worker.done_callback.call_count, 1)
+        self.assertEqual(worker.dead_letters.add.call_count, 1)
+
+        # Otherwise dump is still in cdb and is requested again on replay
+        worker.config = self.worker_config
+        retry_item['retries_count'] = 6
+        retry_item['stage'] = 'secret_save'
+        worker.add_to_retry_queue(retry_item)
+        self.assertEqual(worker.log_dict['droped'], 2)
+        self.assertEqual(retry_items_queue.qsize(), 0)
+        self.assertNotIn('secret', worker.dead_letters.add.call_args[0][0])
+        self.assertEqual(retry_item['stage'], 'dump_get')
+        del retry_item['stage']
+
+        # Retry scheduler delays item by its timeout
+        worker.retry_scheduler = MagicMock()
+        retry_item['retries_count'] = 0
+        retry_item['timeout'] = None
+        worker.add_to_retry_queue(retry_item)
+        worker.retry_scheduler.schedule.assert_called_once_with(
+            retry_item, worker.config['retry_default_timeout'])
+        sleep(worker.config['retry_default_timeout'] * 2)
+        self.assertEqual(retry_items_queue.qsize(), 0)
+
+        del worker
+
+    def test__count(self):
+        item = {'id': uuid.uuid4().hex, 'resource': 'plans'}
+        worker = ArchiveWorker(log_dict=self.log_dict)
+        worker._count('archived', item)
+        self.assertEqual(worker.log_dict['archived'], 1)
+
+        worker.metrics = MagicMock()
+        worker._count('archived', item)
+        self.assertEqual(worker.log_dict['archived'], 2)
+        worker.metrics.inc.assert_called_once_with('archived', 'plans')
         del worker
 
+    def test__observe(self):
+        items = [{'id': uuid.uuid4().hex, 'resource': 'plans'}, {'id': uuid.uuid4().hex, 'resource': 'tenders'}]
+        worker = ArchiveWorker(log_dict=self.log_dict)
+        worker._observe('edge_get', items, items[:1], time())
+
+        worker.metrics = Metrics()
+        worker._observe('edge_get', items, items[:1], time() - 1)
+        summary = worker.metrics.stages_summary()['edge_get']
+        self.assertEqual(sorted(summary['plans']), ['all', 'ok'])
+        self.assertEqual(summary['tenders']['failed']['count'], 1)
+        self.assertTrue(summary['tenders']['failed']['mean'] >= 1)
+
     def test__get_api_client_dict(self):
         api_clients_queue = Queue()
         client = MagicMock()
@@ -417,6 +511,350 @@ class TestArchiveWorker(unittest.TestCase):
         self.assertEqual(resource_item, None)
         del worker
 
+    def test__get_resource_items_batch(self):
+        items_queue = Queue()
+        items = [{'id': uuid.uuid4().hex,
+                  'dateModified': datetime.datetime.utcnow().isoformat(),
+                  'resource': 'tenders'} for _ in range(3)]
+        for item in items:
+            items_queue.put(item)
+        worker = ArchiveWorker(resource_items_queue=items_queue,
+                               config_dict=dict(self.worker_config, bulk_get_limit=2),
+                               log_dict=self.log_dict)
+
+        self.assertEqual(worker._get_resource_items_batch(), items[:2])
+        self.assertEqual(worker._get_resource_items_batch(), items[2:])
+        self.assertEqual(worker._get_resource_items_batch(), [])
+        del worker
+
+    def test__get_resource_items_batch_broken_spool(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'retry.spool')
+        item = {'id': uuid.uuid4().hex, 'dateModified': '2016-01-01', 'resource': 'tenders'}
+        with open(path, 'w') as spool:
+            spool.write(json.dumps(item) + '\n{"id": broken\n')
+        worker = ArchiveWorker(resource_items_queue=SpillingQueue(path, 1),
+                               config_dict=dict(self.worker_config, queue_timeout=0.01),
+                               log_dict=self.log_dict)
+
+        # Spilled items left by previous run are counted with broken lines
+        self.assertEqual(worker._get_resource_items_batch(), [item])
+        self.assertEqual(worker._get_resource_items_batch(), [])
+        with open(path, 'w') as spool:
+            spool.write('{"id": broken\n')
+        worker.resource_items_queue = SpillingQueue(path, 1)
+        self.assertEqual(worker._get_resource_items_batch(), [])
+        shutil.rmtree(directory)
+
+    def test__get_resource_items_from_edge(self):
+        retry_queue = Queue()
+        items = [{'id': uuid.uuid4().hex,
+                  'dateModified': datetime.datetime.utcnow().isoformat(),
+                  'resource': 'tenders'} for _ in range(3)]
+        docs = [{'id': item['id'], '_rev': '1-' + uuid.uuid4().hex,
+                 'dateModified': item['dateModified']} for item in items]
+        db = MagicMock()
+        done_callback = MagicMock()
+        worker = ArchiveWorker(config_dict=self.worker_config, db=db,
+                               retry_resource_items_queue=retry_queue,
+                               log_dict=self.log_dict, done_callback=done_callback)
+
+        # One request for the whole batch, missing docs are skipped
+        db.view.return_value = edge_rows(docs[0]) + \
+            [munchify({'key': items[1]['id'], 'error': 'not_found', 'doc': None})] + edge_rows(docs[2])
+        resource_items = worker._get_resource_items_from_edge(items)
+        self.assertEqual(db.view.call_count, 1)
+        self.assertEqual(db.view.call_args[1]['keys'], [item['id'] for item in items])
+        self.assertEqual(resource_items, [items[0], items[2]])
+        self.assertEqual([item['doc'] for item in resource_items], [docs[0], docs[2]])
+        done_callback.assert_called_once_with(items[1])
+        del items[0]['doc'], items[2]['doc']
+
+        # Whole batch goes to retry queue on error
+        db.view.side_effect = Exception('DB exception')
+        resource_items = worker._get_resource_items_from_edge(items)
+        self.assertEqual(resource_items, [])
+        self.assertEqual(worker.log_dict['exceptions_count'], 1)
+        self.assertEqual(worker.log_dict['add_to_retry'], 3)
+        self.assertEqual(done_callback.call_count, 1)
+
+        # Items queued with edge documents are not fetched again
+        items[0]['doc'] = docs[0]
+        items[2]['doc'] = docs[2]
+        resource_items = worker._get_resource_items_from_edge(items)
+        self.assertEqual(db.view.call_count, 3)
+        self.assertEqual(db.view.call_args[1]['keys'], [items[1]['id']])
+        self.assertEqual(resource_items, [items[0], items[2]])
+        self.assertEqual([item['doc'] for item in resource_items], [docs[0], docs[2]])
+        self.assertNotIn('doc', items[1])
+        self.assertEqual(worker.log_dict['add_to_retry'], 4)
+        self.assertEqual(done_callback.call_count, 1)
+
+        resource_items = worker._get_resource_items_from_edge(items[:1])
+        self.assertEqual(db.view.call_count, 3)
+        self.assertEqual(resource_items, [items[0]])
+        self.assertEqual(items[0]['doc'], docs[0])
+        del worker
+
+    def test__save_to_public_archive(self):
+        retry_queue = Queue()
+        archive_db = MagicMock()
+        worker = ArchiveWorker(config_dict=self.worker_config, archive_db=archive_db,
+                               retry_resource_items_queue=retry_queue,
+                               log_dict=self.log_dict)
+        date_modified = datetime.datetime.utcnow()
+        items = [{'id': uuid.uuid4().hex,
+                  'dateModified': date_modified.isoformat(),
+                  'resource': 'tenders'} for _ in range(4)]
+
+        def resource_items():
+            for item in items:
+                item['doc'] = {'_id': item['id'], 'id': item['id'], '_rev': '1-edge',
+                               'dateModified': item['dateModified']}
+            return items
+
+        # New, outdated, up to date and conflicting documents
+        archive_db.view.return_value = edge_rows(
+            {'id': items[1]['id'], '_rev': '1-old',
+             'dateModified': (date_modified - timedelta(days=1)).isoformat()},
+            {'id': items[2]['id'], '_rev': '1-actual',
+             'dateModified': items[2]['dateModified']})
+        archive_db.update.return_value = [(True, items[0]['id'], '1-new'),
+                                          (True, items[1]['id'], '2-new'),
+                                          (False, items[3]['id'], Exception('conflict'))]
+        saved_items = worker._save_to_public_archive(resource_items())
+        self.assertEqual(archive_db.view.call_count, 1)
+        self.assertEqual(archive_db.update.call_count, 1)
+        docs = archive_db.update.call_args[0][0]
+        self.assertEqual([doc['id'] for doc in docs], [items[0]['id'], items[1]['id'], items[3]['id']])
+        self.assertNotIn('_rev', docs[0])
+        self.assertEqual(docs[1]['_rev'], '1-old')
+        self.assertEqual(saved_items, [items[2], items[0], items[1]])
+        self.assertEqual([item['_rev'] for item in saved_items], ['1-edge'] * 3)
+        self.assertNotIn('doc', items[3])
+        self.assertEqual(worker.log_dict['moved_to_public_archive'], 3)
+        self.assertEqual(worker.log_dict['exceptions_count'], 1)
+        self.assertEqual(worker.log_dict['add_to_retry'], 1)
+
+        # Bulk request failed
+        archive_db.view.return_value = []
+        archive_db.update.side_effect = Exception('Bulk docs exception')
+        saved_items = worker._save_to_public_archive(resource_items())
+        self.assertEqual(saved_items, [])
+        self.assertEqual(worker.log_dict['exceptions_count'], 2)
+        self.assertEqual(worker.log_dict['add_to_retry'], 5)
+
+        # Revisions lookup failed
+        archive_db.view.side_effect = Exception('All docs exception')
+        saved_items = worker._save_to_public_archive(resource_items())
+        self.assertEqual(saved_items, [])
+        self.assertEqual(worker.log_dict['exceptions_count'], 3)
+        self.assertEqual(worker.log_dict['add_to_retry'], 9)
+        del worker
+
+    def test__flush_edge_deletes(self):
+        retry_queue = Queue()
+        db = MagicMock()
+        done_callback = MagicMock()
+        worker = ArchiveWorker(config_dict=dict(self.worker_config, bulk_delete_limit=3,
+                                                bulk_delete_interval=60),
+                               db=db, retry_resource_items_queue=retry_queue,
+                               log_dict=self.log_dict, done_callback=done_callback)
+        items = [{'id': uuid.uuid4().hex,
+                  'dateModified': datetime.datetime.utcnow().isoformat(),
+                  'resource': 'tenders',
+                  '_rev': '1-edge'} for _ in range(3)]
+
+        # Flush on batch size
+        db.update.return_value = [(True, items[0]['id'], '2-new'),
+                                  (False, items[1]['id'], Exception('conflict')),
+                                  (True, items[2]['id'], '2-new')]
+        worker._delete_from_edge(items[0])
+        worker._delete_from_edge(items[1])
+        self.assertEqual(db.update.call_count, 0)
+        worker._delete_from_edge(items[2])
+        self.assertEqual(db.update.call_count, 1)
+        self.assertEqual(db.update.call_args[0][0],
+                         [{'_id': item['id'], '_rev': '1-edge', '_deleted': True} for item in items])
+        self.assertEqual(worker.edge_deletes, [])
+        self.assertEqual(worker.log_dict['archived'], 2)
+        self.assertEqual([args[0][0] for args in done_callback.call_args_list], [items[0], items[2]])
+        self.assertEqual(worker.log_dict['exceptions_count'], 1)
+        self.assertEqual(worker.log_dict['add_to_retry'], 1)
+
+        # Flush on interval
+        db.update.return_value = [(True, items[0]['id'], '2-new')]
+        worker._delete_from_edge(items[0])
+        worker._flush_edge_deletes()
+        self.assertEqual(db.update.call_count, 1)
+        worker.edge_deletes_started -= 60
+        worker._flush_edge_deletes()
+        self.assertEqual(db.update.call_count, 2)
+        self.assertEqual(worker.log_dict['archived'], 3)
+
+        # Forced flush with failed request
+        db.update.side_effect = Exception('Bulk docs exception')
+        worker._delete_from_edge(items[0])
+        worker._delete_from_edge(items[1])
+        worker._flush_edge_deletes(force=True)
+        self.assertEqual(db.update.call_count, 3)
+        self.assertEqual(worker.edge_deletes, [])
+        self.assertEqual(worker.log_dict['exceptions_count'], 2)
+        self.assertEqual(worker.log_dict['add_to_retry'], 3)
+        del worker
+
+    def test__archive_resource_item_cdb_failures(self):
+        api_clients_queue = Queue()
+        item = {'id': uuid.uuid4().hex,
+                'dateModified': datetime.datetime.utcnow().isoformat(),
+                'resource': 'tenders',
+                '_rev': '1-edge'}
+        secret_archive_db = MagicMock()
+        secret_archive_db.get_date_modified.return_value = None
+        del secret_archive_db.save_newer  # couchdb-like storage
+        worker = ArchiveWorker(config_dict=self.worker_config, api_clients_queue=api_clients_queue,
+                               secret_archive_db=secret_archive_db, log_dict=self.log_dict)
+        worker._get_api_client_dict = MagicMock(return_value={'client': MagicMock(), 'request_interval': 0})
+        worker._delete_from_edge = MagicMock()
+
+        # Failed dump request stops archiving of item
+        worker._action_resource_item_from_cdb = MagicMock(return_value=None)
+        worker._archive_resource_item(item)
+        self.assertEqual(worker._action_resource_item_from_cdb.call_count, 1)
+        self.assertEqual(secret_archive_db.save.call_count, 0)
+        self.assertEqual(worker._delete_from_edge.call_count, 0)
+
+        # Failed delete request keeps edge document
+        worker._action_resource_item_from_cdb = MagicMock(side_effect=[{'tender': {}}, None])
+        secret_archive_db.get.return_value = None
+        worker._archive_resource_item(item)
+        self.assertEqual(secret_archive_db.save.call_count, 1)
+        self.assertEqual(worker._delete_from_edge.call_count, 0)
+
+        # Resource not found at cdb
+        worker._action_resource_item_from_cdb = MagicMock(side_effect=[{}, {}])
+        worker._archive_resource_item(item)
+        self.assertEqual(secret_archive_db.save.call_count, 1)
+        worker._delete_from_edge.assert_called_once_with(item)
+        del worker
+
+    def test__archive_resource_item_dump_on_delete(self):
+        retry_queue = Queue()
+        item = {'id': uuid.uuid4().hex,
+                'dateModified': datetime.datetime.utcnow().isoformat(),
+                'resource': 'tenders',
+                '_rev': '1-edge'}
+        secret_doc = {'tender': {'id': item['id']}}
+        secret_archive_db = MagicMock()
+        secret_archive_db.get_date_modified.return_value = None
+        del secret_archive_db.save_newer  # couchdb-like storage
+        dump_spool = MagicMock()
+        worker = ArchiveWorker(config_dict=dict(self.worker_config, dump_on_delete=True),
+                               secret_archive_db=secret_archive_db, dump_spool=dump_spool,
+                               retry_resource_items_queue=retry_queue, log_dict=self.log_dict)
+        worker._get_api_client_dict = MagicMock(return_value={'client': MagicMock(), 'request_interval': 0})
+        worker._action_resource_item_from_cdb = MagicMock(return_value=secret_doc)
+        worker._delete_from_edge = MagicMock()
+
+        # Dump from delete response is kept in item when secret save fails
+        secret_archive_db.get.return_value = None
+        secret_archive_db.save.side_effect = Exception('Secret DB exception')
+        worker._archive_resource_item(item)
+        worker._action_resource_item_from_cdb.assert_called_once_with(
+            worker._get_api_client_dict.return_value, item, 'delete_resource_dump')
+        self.assertEqual(item['secret'], secret_doc)
+        self.assertEqual(worker._delete_from_edge.call_count, 0)
+        self.assertEqual(worker.log_dict['add_to_retry'], 1)
+        # and is spooled to disk to be saved after restart
+        spooled_item = dump_spool.add.call_args[0][0]
+        self.assertEqual((spooled_item['id'], spooled_item['stage'], spooled_item['secret']),
+                         (item['id'], 'secret_save', secret_doc))
+        self.assertEqual(dump_spool.remove.call_count, 0)
+
+        # Retry saves kept dump without second delete request
+        secret_archive_db.save.side_effect = None
+        worker._archive_resource_item(item)
+        self.assertEqual(worker._action_resource_item_from_cdb.call_count, 1)
+        self.assertEqual(secret_archive_db.save.call_args[0][0]['data'], secret_doc)
+        self.assertNotIn('secret', item)
+        worker._delete_from_edge.assert_called_once_with(item)
+        self.assertEqual(worker.log_dict['dumped_to_secret_archive'], 1)
+        dump_spool.remove.assert_called_once_with(item)
+
+        # Spooling errors leave dump in memory
+        dump_spool.add.side_effect = IOError('No space left on device')
+        del item['stage']
+        worker._archive_resource_item(item)
+        self.assertEqual(worker._delete_from_edge.call_count, 2)
+        self.assertEqual(dump_spool.remove.call_count, 2)
+        del worker
+
+    def test__archive_resource_item_resume(self):
+        retry_queue = Queue()
+        queue = Queue()
+        item = {'id': uuid.uuid4().hex,
+                'dateModified': datetime.datetime.utcnow().isoformat(),
+                'resource': 'tenders',
+                '_rev': '1-edge'}
+        db = MagicMock()
+        worker = ArchiveWorker(config_dict=self.worker_config, db=db, resource_items_queue=queue,
+                               retry_resource_items_queue=retry_queue, log_dict=self.log_dict)
+        worker._dump_resource_item = MagicMock(return_value=True)
+        worker._save_to_secret_archive = MagicMock(side_effect=[False, True])
+        worker._delete_resource_dump = MagicMock(return_value=True)
+        worker._delete_from_edge = MagicMock()
+
+        # Failed stage is recorded in item
+        worker._archive_resource_item(item)
+        self.assertEqual(item['stage'], 'secret_save')
+        self.assertEqual(worker._dump_resource_item.call_count, 1)
+        self.assertEqual(worker._delete_resource_dump.call_count, 0)
+
+        # Retry continues from failed stage
+        worker._archive_resource_item(item)
+        self.assertEqual(worker._dump_resource_item.call_count, 1)
+        self.assertEqual(worker._save_to_secret_archive.call_count, 2)
+        self.assertEqual(worker._delete_resource_dump.call_count, 1)
+        worker._delete_from_edge.assert_called_once_with(item)
+        self.assertEqual(item['stage'], 'edge_delete')
+        del worker._delete_from_edge
+
+        # Item failed at edge delete skips edge and public db
+        db.update.return_value = [(False, item['id'], ResourceConflict())]
+        queue.put(item)
+        worker._run()
+        self.assertEqual(db.view.call_count, 0)
+        self.assertEqual(db.update.call_count, 1)
+        self.assertEqual(worker._save_to_secret_archive.call_count, 2)
+        self.assertEqual(db.update.call_args[0][0], [{'_id': item['id'], '_rev': '1-edge', '_deleted': True}])
+
+        # Conflict on edge delete starts item over
+        self.assertNotIn('stage', item)
+        self.assertNotIn('_rev', item)
+        self.assertEqual(worker.log_dict['add_to_retry'], 1)
+        del worker
+
+    def test__secret_archive_is_actual(self):
+        item = {'id': uuid.uuid4().hex,
+                'dateModified': datetime.datetime.utcnow().isoformat(),
+                'resource': 'tenders'}
+        worker = ArchiveWorker(config_dict=self.worker_config, secret_archive_db=object(),
+                               log_dict=self.log_dict)
+        self.assertEqual(worker._secret_archive_is_actual(item), False)
+
+        worker.secret_archive_db = MagicMock()
+        worker.secret_archive_db.get_date_modified.return_value = None
+        del worker.secret_archive_db.save_newer  # couchdb-like storage
+        self.assertEqual(worker._secret_archive_is_actual(item), False)
+        worker.secret_archive_db.get_date_modified.return_value = '2015-01-01T00:00:00'
+        self.assertEqual(worker._secret_archive_is_actual(item), False)
+        worker.secret_archive_db.get_date_modified.return_value = item['dateModified']
+        self.assertEqual(worker._secret_archive_is_actual(item), True)
+        worker.secret_archive_db.get_date_modified.assert_called_with(item['id'])
+        worker.secret_archive_db.get_date_modified.side_effect = Exception('HEAD exception')
+        self.assertEqual(worker._secret_archive_is_actual(item), False)
+        del worker
+
     @patch('openprocurement_client.client.TendersClient')
     def test__action_resource_item_from_cdb(self, mock_api_client):
         item = {
@@ -513,7 +951,7 @@ class TestArchiveWorker(unittest.TestCase):
         api_client = worker._get_api_client_dict()
         self.assertEqual(worker.api_clients_queue.qsize(), 0)
         public_item = worker._action_resource_item_from_cdb(api_client, item)
-        self.assertEqual(public_item, None)
+        self.assertEqual(public_item, {})
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         self.assertEqual(api_client['request_interval'], 0)
         self.assertEqual(worker.log_dict['exceptions_count'], 4)
@@ -562,9 +1000,17 @@ class TestArchiveWorker(unittest.TestCase):
             '_rev': '1-' + uuid.uuid4().hex,
             'rev': '1-' + uuid.uuid4().hex
         }
+
+        def put_queue_resource_item():
+            # Item is queued by scan again, not resumed from retry
+            queue_resource_item.pop('stage', None)
+            queue.put(queue_resource_item)
+
         db = MagicMock()
         archive_db = MagicMock()
         secret_archive_db = MagicMock()
+        secret_archive_db.get_date_modified.return_value = None
+        del secret_archive_db.save_newer  # couchdb-like storage
         bridge = ArchiveWorker(config_dict=self.worker_config, log_dict=self.log_dict,
                                resource_items_queue=queue, retry_resource_items_queue=retry_queue,
                                api_clients_queue=api_clients_queue, db=db, archive_db=archive_db,
@@ -576,35 +1022,33 @@ class TestArchiveWorker(unittest.TestCase):
         self.assertEqual(bridge.log_dict['add_to_retry'], 0)
 
         # Get resource from edge db
-        bridge.db.get.side_effect = [Exception('DB exception'), None, resource_item, resource_item,
-                                     resource_item, resource_item, resource_item, resource_item,
-                                     resource_item, resource_item, resource_item, resource_item]
-        queue.put(queue_resource_item)
+        resource_item['id'] = queue_resource_item['id']
+        bridge.db.view.side_effect = [Exception('DB exception'), []] + \
+            [edge_rows(resource_item) for _ in range(10)]
+        put_queue_resource_item()
         bridge._run()
         self.assertEqual(bridge.log_dict['exceptions_count'], 1)
         self.assertEqual(bridge.log_dict['add_to_retry'], 1)
 
-        queue.put(queue_resource_item)
+        put_queue_resource_item()
         bridge._run()
         self.assertEqual(bridge.log_dict['exceptions_count'], 1)
         self.assertEqual(bridge.log_dict['add_to_retry'], 1)
 
         resource_item['dateModified'] = datetime.datetime.now().isoformat()
-        bridge.archive_db.get.side_effect = [Exception('Archive DB exception'), None,
-                                             munchify(archive_doc), munchify(archive_doc),
-                                             munchify(archive_doc), munchify(archive_doc),
-                                             munchify(archive_doc), munchify(archive_doc),
-                                             munchify(archive_doc)]
-        bridge.archive_db.save = MagicMock()
+        archive_doc['id'] = queue_resource_item['id']
+        bridge.archive_db.view.side_effect = [Exception('Archive DB exception'), []] + \
+            [edge_rows(archive_doc) for _ in range(7)]
+        bridge.archive_db.update.side_effect = bulk_docs_results
 
         # Put resource to public db
-        queue.put(queue_resource_item)
+        put_queue_resource_item()
         bridge._run()
         self.assertEqual(bridge.log_dict['exceptions_count'], 2)
         self.assertEqual(bridge.log_dict['add_to_retry'], 2)
 
         # Try get api client from clients queue
-        queue.put(queue_resource_item)
+        put_queue_resource_item()
         bridge._get_api_client_dict = MagicMock(side_effect=[None, api_client_dict, api_client_dict,
                                                              api_client_dict, None, api_client_dict,
                                                              api_client_dict, api_client_dict,
@@ -631,7 +1075,7 @@ class TestArchiveWorker(unittest.TestCase):
                                                                        secret_doc, Exception('Delete'),
                                                                        secret_doc, secret_doc,
                                                                        secret_doc, secret_doc])
-        queue.put(queue_resource_item)
+        put_queue_resource_item()
         bridge._run()
         self.assertEqual(bridge.log_dict['exceptions_count'], 3)
         self.assertEqual(bridge.log_dict['add_to_retry'], 4)
@@ -640,39 +1084,187 @@ class TestArchiveWorker(unittest.TestCase):
         secret_db_doc['dateModified'] = secret_doc['data']['dateModified']
         bridge.secret_archive_db.get.side_effect = [Exception('Secret DB exception'), None, secret_db_doc,
                                                     secret_db_doc, secret_db_doc, secret_db_doc, secret_db_doc]
-        queue.put(queue_resource_item)
+        put_queue_resource_item()
         bridge._run()
         self.assertEqual(bridge.log_dict['exceptions_count'], 4)
         self.assertEqual(bridge.log_dict['add_to_retry'], 5)
 
-        queue.put(queue_resource_item)
+        put_queue_resource_item()
         bridge._run()
         self.assertEqual(bridge.log_dict['exceptions_count'], 4)
         self.assertEqual(bridge.log_dict['add_to_retry'], 5)
 
-        queue.put(queue_resource_item)
+        put_queue_resource_item()
         bridge._run()
         self.assertEqual(bridge.log_dict['exceptions_count'], 5)
         self.assertEqual(bridge.log_dict['add_to_retry'], 5)
 
         # Delete resource from edge db
-        queue.put(queue_resource_item)
-        bridge.db.save.side_effect = [True, Exception('Delete from edge')]
+        put_queue_resource_item()
+        bridge.db.update.side_effect = [[(True, queue_resource_item['id'], '2-' + uuid.uuid4().hex)],
+                                        Exception('Delete from edge')]
         bridge._run()
         self.assertEqual(bridge.log_dict['exceptions_count'], 5)
         self.assertEqual(bridge.log_dict['add_to_retry'], 5)
 
-        queue.put(queue_resource_item)
+        put_queue_resource_item()
         bridge._run()
         self.assertEqual(bridge.log_dict['exceptions_count'], 6)
         self.assertEqual(bridge.log_dict['add_to_retry'], 5)
 
+    def test_pipeline_run(self):
+        queue = Queue()
+        retry_queue = Queue()
+        items = [{'id': uuid.uuid4().hex,
+                  'dateModified': datetime.datetime.utcnow().isoformat(),
+                  'resource': 'tenders'} for _ in range(5)]
+        db = MagicMock()
+        db.view.side_effect = lambda view, keys, include_docs: edge_rows(
+            *[{'_id': key, 'id': key, '_rev': '1-edge', 'dateModified': items[0]['dateModified']}
+              for key in keys])
+        db.update.side_effect = bulk_docs_results
+        archive_db = MagicMock()
+        archive_db.view.return_value = []
+        archive_db.update.side_effect = bulk_docs_results
+        secret_archive_db = MagicMock()
+        secret_archive_db.get_date_modified.return_value = None
+        del secret_archive_db.save_newer  # couchdb-like storage
+        secret_archive_db.get.return_value = None
+        done_callback = MagicMock()
+        worker = ArchivePipeline(config_dict=self.worker_config, log_dict=self.log_dict,
+                                 resource_items_queue=queue, retry_resource_items_queue=retry_queue,
+                                 db=db, archive_db=archive_db, secret_archive_db=secret_archive_db,
+                                 done_callback=done_callback)
+        worker._get_api_client_dict = MagicMock(return_value={'client': MagicMock(), 'request_interval': 0})
+
+        def action_resource_item_from_cdb(api_client_dict, item, action='get_resource_dump'):
+            if action == 'get_resource_dump':
+                return {'tender': {}}
+            if item is items[2]:
+                worker.add_to_retry_queue(item)
+                return None
+            return {}
+        worker._action_resource_item_from_cdb = MagicMock(side_effect=action_resource_item_from_cdb)
+
+        # Every stage passes items to the next one until queues are drained
+        for item in items:
+            queue.put(item)
+        worker._run()
+        self.assertEqual(worker.log_dict['moved_to_public_archive'], 5)
+        self.assertEqual(worker.log_dict['dumped_to_secret_archive'], 5)
+        self.assertEqual(worker.log_dict['archived'], 4)
+        self.assertEqual(worker.log_dict['add_to_retry'], 1)
+        self.assertEqual(done_callback.call_count, 4)
+        self.assertEqual(db.update.call_count, 4)
+        self.assertEqual(secret_archive_db.save.call_count, 5)
+        self.assertEqual(worker._action_resource_item_from_cdb.call_count, 10)
+        self.assertEqual([stage for stage, _, _ in worker.stages_status()], list(STAGES))
+        self.assertEqual([queued for _, queued, _ in worker.stages_status()], [0] * len(STAGES))
+        self.assertEqual([running for _, _, running in worker.stages_status()], [0] * len(STAGES))
+
+        # Nothing to do on empty queue
+        worker._run()
+        self.assertEqual(worker.log_dict['archived'], 4)
+
+    def test_pipeline_get_api_client_dict(self):
+        api_clients_queue = Queue()
+        client_dict = {'client': MagicMock(), 'request_interval': 0}
+        worker = ArchivePipeline(api_clients_queue=api_clients_queue, config_dict=self.worker_config,
+                                 log_dict=self.log_dict)
+        # Stage greenlet waits for client returned by another one
+        spawn_later(0.05, api_clients_queue.put, client_dict)
+        self.assertEqual(worker._get_api_client_dict(), client_dict)
+        self.assertEqual(worker._get_api_client_dict(), None)
+
     def test_shutdown(self):
         worker = ArchiveWorker()
         self.assertEqual(worker.exit, False)
         worker.shutdown()
         self.assertEqual(worker.exit, True)
 
+    def test_storage_pool(self):
+        connections = [MagicMock(), MagicMock()]
+        connect = MagicMock(side_effect=connections[1:])
+        secret_archive = S3Storage(connections[0], 'bucket', pool_size=2, connect=connect)
+        with secret_archive._get_bucket() as bucket:
+            self.assertEqual(bucket, connections[0].get_bucket.return_value)
+            with secret_archive._get_bucket() as other_bucket:
+                self.assertEqual(other_bucket, connections[1].get_bucket.return_value)
+        for connection in connections:
+            connection.get_bucket.assert_called_once_with('bucket', validate=False)
+
+        # Bucket handles are reused, no new connections over pool size
+        for _ in range(3):
+            secret_archive.get_date_modified(uuid.uuid4().hex)
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(secret_archive.buckets.qsize(), 2)
+
+        # Greenlet waits for free bucket handle
+        used = []
+
+        def use_bucket():
+            with secret_archive._get_bucket() as bucket:
+                used.append(bucket)
+                sleep(0.1)
+        greenlets = [spawn(use_bucket) for _ in range(3)]
+        sleep(0.05)
+        self.assertEqual(len(used), 2)
+        joinall(greenlets)
+        self.assertEqual(len(used), 3)
+        self.assertEqual(secret_archive.buckets.qsize(), 2)
+
+        # Without connect storage uses single connection
+        self.assertEqual(S3Storage(connections[0], 'bucket', pool_size=2).pool_size, 1)
+
+    @patch('openprocurement.archivarius.core.storages.storages.Key', MockKey)
+    def test_storage_save_newer(self):
+        conn = MockConnection()
+        bucket = conn.create_bucket('bucket')
+        secret_archive = S3Storage(conn, 'bucket')
+        doc_id = uuid.uuid4().hex
+        path = secret_archive._parse_key(doc_id)
+        doc = {'_id': doc_id, 'dateModified': '2017-01-02', 'data': {'secret': 1}}
+
+        put = MockKey.set_contents_from_string
+        with patch.object(MockKey, 'set_contents_from_string', autospec=True, side_effect=put) as mock_put:
+            self.assertTrue(secret_archive.save_newer(dict(doc)))
+        self.assertEqual(mock_put.call_count, 1)
+        self.assertEqual(mock_put.call_args[1]['headers']['If-None-Match'], '*')
+        key = bucket.get_key(path)
+        self.assertEqual(key.get_metadata('rev'), '1')
+        self.assertEqual(key.get_metadata('datemodified'), '2017-01-02')
+        self.assertEqual(key.content_type, 'application/json')
+        self.assertEqual(secret_archive.get(doc_id), dict(doc, _rev=1))
+
+        # Same or older document is not written
+        self.assertFalse(secret_archive.save_newer(dict(doc)))
+        self.assertFalse(secret_archive.save_newer(dict(doc, dateModified='2017-01-01')))
+        self.assertIs(bucket.get_key(path), key)
+
+        # Newer document gets next revision with one conditional PUT
+        with patch.object(MockKey, 'set_contents_from_string', autospec=True, side_effect=put) as mock_put:
+            self.assertTrue(secret_archive.save_newer(dict(doc, dateModified='2017-01-03')))
+        self.assertEqual(mock_put.call_count, 1)
+        self.assertEqual(mock_put.call_args[1]['headers']['If-Match'], key.etag)
+        self.assertEqual(bucket.get_key(path).get_metadata('rev'), '2')
+        self.assertEqual(secret_archive.get(doc_id)['_rev'], 2)
+
+        # Object changed between HEAD and PUT
+        changed_key = MagicMock(etag='changed', **{'get_metadata.side_effect': {
+            'datemodified': '2017-01-03', 'rev': '2'}.get})
+        with patch.object(bucket, 'get_key', return_value=changed_key):
+            with self.assertRaises(boto.exception.S3ResponseError):
+                secret_archive.save_newer(dict(doc, dateModified='2017-01-04'))
+        self.assertEqual(secret_archive.get(doc_id)['dateModified'], '2017-01-03')
+
+        # Plain save creates only new documents without _rev
+        with self.assertRaises(boto.exception.S3ResponseError):
+            secret_archive.save(dict(doc))
+        data = dict(doc, _rev=2, dateModified='2017-01-05')
+        secret_archive.save(data)
+        self.assertEqual(data['_rev'], 3)
+        self.assertEqual(bucket.get_key(path).get_metadata('datemodified'), '2017-01-05')
+
     @patch('openprocurement_client.client.TendersClient')
     @patch('openprocurement.archivarius.core.storages.storages.Key', MockKey)
     def test_storage(self, mock_api_client):
@@ -713,12 +1305,12 @@ class TestArchiveWorker(unittest.TestCase):
                                resource_items_queue=queue, retry_resource_items_queue=retry_queue,
                                api_clients_queue=api_clients_queue, db=db, archive_db=archive_db,
                                secret_archive_db=secret_archive)
-        bridge.db.get.side_effect = [resource_item, resource_item]
-        bridge.archive_db.get.side_effect = [munchify(archive_doc), munchify(archive_doc)]
+        resource_item['id'] = queue_resource_item['id']
+        bridge.db.view.side_effect = [edge_rows(resource_item), edge_rows(resource_item)]
+        bridge.archive_db.view.side_effect = [edge_rows(archive_doc), edge_rows(archive_doc)]
+        bridge.archive_db.update.side_effect = bulk_docs_results
         bridge._get_api_client_dict = MagicMock(side_effect=[api_client_dict, api_client_dict])
 
-        bridge.archive_db.save = MagicMock()
-
         # Try get resource item dump from cdb
         resource_item['_rev'] = '1-' + uuid.uuid4().hex
         secret_doc = {
@@ -734,7 +1326,7 @@ class TestArchiveWorker(unittest.TestCase):
         }
         bridge._action_resource_item_from_cdb = MagicMock(side_effect=[secret_doc, secret_doc])
 
-        queue.put(queue_resource_item)
+        queue.put(dict(queue_resource_item))
         bridge._run()
         self.assertEqual(bridge.log_dict['exceptions_count'], 0)
         self.assertEqual(bridge.log_dict['add_to_retry'], 0)
@@ -743,6 +1335,19 @@ class TestArchiveWorker(unittest.TestCase):
         self.assertEqual(data.get('_rev'), 1)
         self.assertEqual(data.get('dateModified'), queue_resource_item['dateModified'])
         self.assertEqual(secret_doc, data.get('data'))
+        self.assertEqual(bridge.secret_archive_db.get_date_modified(queue_resource_item['id']),
+                         queue_resource_item['dateModified'])
+        self.assertEqual(bridge.secret_archive_db.get_date_modified(uuid.uuid4().hex), None)
+
+        # Dump request is skipped for up to date secret archive
+        bridge._get_api_client_dict = MagicMock(side_effect=[api_client_dict])
+        bridge._action_resource_item_from_cdb = MagicMock(side_effect=[{}])
+        queue.put(dict(queue_resource_item))
+        bridge._run()
+        self.assertEqual(bridge._action_resource_item_from_cdb.call_count, 1)
+        self.assertEqual(bridge._action_resource_item_from_cdb.call_args[0][2], 'delete_resource_dump')
+        data = bridge.secret_archive_db.get(queue_resource_item['id'])
+        self.assertEqual(data.get('_rev'), 1)
 
         # Test invalid key
         data = bridge.secret_archive_db.get('invalid')
@@ -756,13 +1361,13 @@ class TestArchiveWorker(unittest.TestCase):
 
         secret_doc_updated = secret_doc.copy()
         secret_doc_updated['data']['tender'] = {'item': 'item2', 'pubkey': 'pubkey'}
-        bridge.db.get.side_effect = [resource_item, resource_item]
-        bridge.archive_db.get.side_effect = [munchify(archive_doc), munchify(archive_doc)]
+        bridge.db.view.side_effect = [edge_rows(resource_item), edge_rows(resource_item)]
+        bridge.archive_db.view.side_effect = [edge_rows(archive_doc), edge_rows(archive_doc)]
         bridge._get_api_client_dict = MagicMock(side_effect=[api_client_dict, api_client_dict])
         bridge._action_resource_item_from_cdb = MagicMock(side_effect=[secret_doc_updated, secret_doc_updated])
         queue_resource_item_updated = queue_resource_item
         queue_resource_item_updated['dateModified'] = (datetime.datetime.now() + timedelta(days=1)).isoformat()
-        queue.put(queue_resource_item)
+        queue.put(dict(queue_resource_item))
         bridge._run()
         data = bridge.secret_archive_db.get(queue_resource_item['id'])
         self.assertEqual(data.get('_rev'), 2)
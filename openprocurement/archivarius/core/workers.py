@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
+from couchdb.http import ResourceConflict
 from gevent import Greenlet
 from gevent import spawn, sleep
+from gevent.pool import Pool
+from gevent.queue import Empty, Queue
+from time import time
 import logging
 import logging.config
 from openprocurement_client.exceptions import (
@@ -13,12 +17,18 @@ from openprocurement_client.exceptions import (
 
 logger = logging.getLogger(__name__)
 
+STAGES = ('edge_get', 'public_save', 'dump_get', 'secret_save', 'dump_delete', 'edge_delete')
+DUMP_ON_DELETE_STAGES = ('edge_get', 'public_save', 'dump_delete', 'secret_save', 'edge_delete')
+# Stages requesting cdb with api clients
+CDB_STAGES = ('dump_get', 'dump_delete')
+
 
 class ArchiveWorker(Greenlet):
 
     def __init__(self, api_clients_queue=None, resource_items_queue=None,
                  db=None, archive_db=None, secret_archive_db=None, config_dict=None, retry_resource_items_queue=None,
-                 log_dict=None):
+                 log_dict=None, done_callback=None, retry_scheduler=None, dead_letters=None,
+                 metrics=None, dump_spool=None):
         Greenlet.__init__(self)
         self.exit = False
         self.update_doc = False
@@ -30,7 +40,14 @@ class ArchiveWorker(Greenlet):
         self.api_clients_queue = api_clients_queue
         self.resource_items_queue = resource_items_queue
         self.retry_resource_items_queue = retry_resource_items_queue
+        self.done_callback = done_callback
+        self.retry_scheduler = retry_scheduler
+        self.dead_letters = dead_letters
+        self.metrics = metrics
+        self.dump_spool = dump_spool
         self.start_time = datetime.now()
+        self.edge_deletes = []
+        self.edge_deletes_started = None
 
     def add_to_retry_queue(self, resource_item, status_code=0):
         timeout = resource_item.get('timeout') or self.config['retry_default_timeout']
@@ -42,18 +59,62 @@ class ArchiveWorker(Greenlet):
             resource_item['timeout'] = timeout
             resource_item['retries_count'] = retries_count
         if resource_item['retries_count'] > self.config['retries_count']:
-            self.log_dict['droped'] += 1
-            logger.critical('{} {} reached limit retries count {} and'
-                            ' droped from retry_queue.'.format(
+            if not (self.config['dump_on_delete'] and resource_item.get('secret')):
+                if resource_item.pop('secret', None) is not None:
+                    # Dump is still in cdb, replayed item requests it again
+                    resource_item['stage'] = self.stages[2]
+                self._count('droped', resource_item)
+                logger.critical('{} {} reached limit retries count {} and'
+                                ' droped from retry_queue.'.format(
+                                    resource_item['resource'].title(),
+                                    resource_item['id'],
+                                    self.config['retries_count']))
+                if self.dead_letters is not None:
+                    self.dead_letters.add(resource_item)
+                self._resource_item_done(resource_item)
+                return
+            # Dump is already deleted from cdb and exists only in this item
+            resource_item['timeout'] = timeout
+            logger.critical('{} {} reached limit retries count {} but keeps'
+                            ' unsaved dump, retry again.'.format(
                                 resource_item['resource'].title(),
                                 resource_item['id'],
                                 self.config['retries_count']))
+        self._count('add_to_retry', resource_item)
+        if self.retry_scheduler is not None:
+            self.retry_scheduler.schedule(resource_item, timeout)
         else:
-            self.log_dict['add_to_retry'] += 1
             spawn(self.retry_resource_items_queue.put,
                   resource_item, timeout=timeout)
-            logger.info('Put {} {} to \'retries_queue\''.format(
-                resource_item['resource'], resource_item['id']))
+        logger.info('Put {} {} to \'retries_queue\''.format(
+            resource_item['resource'], resource_item['id']))
+
+    @property
+    def stages(self):
+        if self.config['dump_on_delete']:
+            return DUMP_ON_DELETE_STAGES
+        return STAGES
+
+    def _count(self, key, resource_item):
+        self.log_dict[key] += 1
+        if self.metrics is not None:
+            self.metrics.inc(key, resource_item['resource'])
+
+    def _observe(self, stage, queue_resource_items, passed_items, started):
+        # Stage latency of every item, outcome tells whether item passed the stage
+        if self.metrics is None:
+            return
+        duration = time() - started
+        passed_ids = set(id(item) for item in passed_items)
+        for queue_resource_item in queue_resource_items:
+            self.metrics.observe(stage, queue_resource_item['resource'],
+                                 'ok' if id(queue_resource_item) in passed_ids else 'failed',
+                                 duration)
+
+    def _resource_item_done(self, resource_item):
+        # Item left the pipeline: archived, dropped or gone from edge db
+        if self.done_callback is not None:
+            self.done_callback(resource_item)
 
     def _get_api_client_dict(self):
         if not self.api_clients_queue.empty():
@@ -68,8 +129,11 @@ class ArchiveWorker(Greenlet):
 
     def _get_resource_item_from_queue(self):
         if not self.resource_items_queue.empty():
-            queue_resource_item = self.resource_items_queue.get(
-                timeout=self.config['queue_timeout'])
+            try:
+                queue_resource_item = self.resource_items_queue.get(
+                    timeout=self.config['queue_timeout'])
+            except Empty:
+                return None  # spilled lines left were broken
             logger.debug('Get {} {} from main queue.'.format(queue_resource_item['resource'], queue_resource_item['id']))
             return queue_resource_item
         else:
@@ -95,7 +159,7 @@ class ArchiveWorker(Greenlet):
                              queue_resource_item['id'],
                              e.status_code))
             self.add_to_retry_queue(queue_resource_item)
-            self.log_dict['exceptions_count'] += 1
+            self._count('exceptions_count', queue_resource_item)
             return None
         except RequestFailed as e:
             if e.status_code == 429:
@@ -113,20 +177,20 @@ class ArchiveWorker(Greenlet):
                              queue_resource_item['resource'],
                              queue_resource_item['id'], e.status_code))
             self.add_to_retry_queue(queue_resource_item, status_code=e.status_code)
-            self.log_dict['exceptions_count'] += 1
+            self._count('exceptions_count', queue_resource_item)
             return None  # request failed
         except ResourceGone as e:
             logger.error('Resource archived {} at cdb: {}. {}'.format(
                 queue_resource_item['resource'], queue_resource_item['id'], e.message))
-            self.log_dict['not_found_count'] += 1
+            self._count('not_found_count', queue_resource_item)
             self.api_clients_queue.put(api_client_dict)
-            return None  # not found
+            return {}  # not found
         except ResourceNotFound as e:
             logger.error('Resource not found {} at cdb: {}. {}'.format(
                 queue_resource_item['resource'], queue_resource_item['id'], e.message))
-            self.log_dict['not_found_count'] += 1
+            self._count('not_found_count', queue_resource_item)
             self.api_clients_queue.put(api_client_dict)
-            return None  # not found
+            return {}  # not found
         except Exception as e:
             self.api_clients_queue.put(api_client_dict)
             logger.error('Error while getting resource item {} {} from'
@@ -134,67 +198,163 @@ class ArchiveWorker(Greenlet):
                              queue_resource_item['resource'],
                              queue_resource_item['id'], e.message))
             self.add_to_retry_queue(queue_resource_item)
-            self.log_dict['exceptions_count'] += 1
+            self._count('exceptions_count', queue_resource_item)
             return None
 
-    def _run(self):
-        while not self.exit:
-            # Try get item from resource items queue
-            queue_resource_item = self._get_resource_item_from_queue()
-            if queue_resource_item is None:
-                break
-
-            # Get resource from edge db
+    def _get_resource_items_batch(self):
+        queue_resource_item = self._get_resource_item_from_queue()
+        if queue_resource_item is None:
+            return []
+        queue_resource_items = [queue_resource_item]
+        while len(queue_resource_items) < self.config['bulk_get_limit'] and \
+                not self.resource_items_queue.empty():
             try:
-                resource_item_doc = self.db.get(queue_resource_item['id'])
-            except Exception as e:
-                self.add_to_retry_queue(queue_resource_item)
-                logger.error('Error while getting resource item from couchdb: '
-                             '{}'.format(e.message))
-                self.log_dict['exceptions_count'] += 1
-                continue
+                queue_resource_items.append(self.resource_items_queue.get_nowait())
+            except Empty:
+                break  # spilled lines left were broken
+        return queue_resource_items
 
-            if not resource_item_doc:
-                continue
-            resource_item_rev = resource_item_doc['_rev']
-
-            # Put resource to public db
+    def _get_resource_items_from_edge(self, queue_resource_items):
+        # Items queued with include_docs already carry edge document,
+        # the rest are fetched with one _all_docs request
+        resource_items_docs = {}
+        fetch_items = []
+        for queue_resource_item in queue_resource_items:
+            resource_item_doc = queue_resource_item.pop('doc', None)
+            if resource_item_doc:
+                resource_items_docs[queue_resource_item['id']] = resource_item_doc
+            else:
+                fetch_items.append(queue_resource_item)
+        if fetch_items:
             try:
-                archive_item_doc = self.archive_db.get(queue_resource_item['id'])
-                if archive_item_doc is None:
-                    del resource_item_doc['_rev']
-                    self.archive_db.save(resource_item_doc)
-                elif archive_item_doc['dateModified'] < resource_item_doc['dateModified']:
-                    resource_item_doc['_rev'] = archive_item_doc.rev
-                    self.archive_db.save(resource_item_doc)
+                rows = self.db.view('_all_docs', include_docs=True,
+                                    keys=[item['id'] for item in fetch_items])
+                resource_items_docs.update((row.key, row.doc) for row in rows)
             except Exception as e:
-                self.add_to_retry_queue(queue_resource_item)
-                logger.error('Error while putting resource item to couchdb: '
+                for queue_resource_item in fetch_items:
+                    self.add_to_retry_queue(queue_resource_item)
+                logger.error('Error while getting resource items from couchdb: '
                              '{}'.format(e.message))
-                self.log_dict['exceptions_count'] += 1
-                continue
-            self.log_dict['moved_to_public_archive'] += 1
+                self._count('exceptions_count', fetch_items[0])
+                queue_resource_items = [item for item in queue_resource_items
+                                        if item['id'] in resource_items_docs]
+        resource_items = []
+        for queue_resource_item in queue_resource_items:
+            resource_item_doc = resource_items_docs.get(queue_resource_item['id'])
+            if resource_item_doc:
+                queue_resource_item['doc'] = resource_item_doc
+                resource_items.append(queue_resource_item)
+            else:
+                self._resource_item_done(queue_resource_item)
+        return resource_items
 
-            # Try get api client from clients queue
-            api_client_dict = self._get_api_client_dict()
-            if api_client_dict is None:
+    def _save_to_public_archive(self, queue_resource_items):
+        # Look up existing revisions with one _all_docs request and write
+        # the whole batch with one _bulk_docs request
+        resource_items_docs = [item.pop('doc') for item in queue_resource_items]
+        try:
+            rows = self.archive_db.view('_all_docs', include_docs=True,
+                                        keys=[item['id'] for item in queue_resource_items])
+            archive_items_docs = dict((row.key, row.doc) for row in rows)
+        except Exception as e:
+            for queue_resource_item in queue_resource_items:
                 self.add_to_retry_queue(queue_resource_item)
-                sleep(self.config['worker_sleep'])
+            logger.error('Error while getting resource items from public couchdb: '
+                         '{}'.format(e.message))
+            self._count('exceptions_count', queue_resource_items[0])
+            return []
+        saved_items = []
+        pending_items = []
+        docs = []
+        for queue_resource_item, resource_item_doc in zip(queue_resource_items, resource_items_docs):
+            # Edge revision is needed to delete item from edge db later
+            queue_resource_item['_rev'] = resource_item_doc['_rev']
+            archive_item_doc = archive_items_docs.get(queue_resource_item['id'])
+            if archive_item_doc is None:
+                del resource_item_doc['_rev']
+            elif archive_item_doc['dateModified'] < resource_item_doc['dateModified']:
+                resource_item_doc['_rev'] = archive_item_doc['_rev']
+            else:
+                saved_items.append(queue_resource_item)
                 continue
-
-            # Try get resource item dump from cdb
+            pending_items.append(queue_resource_item)
+            docs.append(resource_item_doc)
+        if docs:
             try:
-                secret_doc = self._action_resource_item_from_cdb(api_client_dict, queue_resource_item)
+                results = self.archive_db.update(docs)
             except Exception as e:
-                self.api_clients_queue.put(api_client_dict)
+                for queue_resource_item in pending_items:
+                    self.add_to_retry_queue(queue_resource_item)
+                logger.error('Error while putting resource items to couchdb: '
+                             '{}'.format(e.message))
+                self._count('exceptions_count', pending_items[0])
+                results = []
+            for queue_resource_item, (success, _, rev_or_exc) in zip(pending_items, results):
+                if success:
+                    saved_items.append(queue_resource_item)
+                    continue
                 self.add_to_retry_queue(queue_resource_item)
-                logger.error('Error while getting resource item dump from cdb: {}'.format(e.message))
-                self.log_dict['exceptions_count'] += 1
-                continue
+                logger.error('Error while putting {} {} to couchdb: {}'.format(
+                    queue_resource_item['resource'], queue_resource_item['id'], rev_or_exc))
+                self._count('exceptions_count', queue_resource_item)
+        for queue_resource_item in saved_items:
+            self._count('moved_to_public_archive', queue_resource_item)
+        return saved_items
 
-            # Put secret resource to secret db
-            if secret_doc:
-                try:
+    def _secret_archive_is_actual(self, queue_resource_item):
+        # Lightweight dateModified lookup if secret storage supports it
+        get_date_modified = getattr(self.secret_archive_db, 'get_date_modified', None)
+        if get_date_modified is None:
+            return False
+        try:
+            date_modified = get_date_modified(queue_resource_item['id'])
+        except Exception as e:
+            logger.warning('Error while checking resource item in secret archive: '
+                           '{}'.format(e.message))
+            return False
+        return date_modified is not None and date_modified >= queue_resource_item['dateModified']
+
+    def _dump_resource_item(self, queue_resource_item):
+        # Skip dump request if secret archive is up to date
+        if self._secret_archive_is_actual(queue_resource_item):
+            logger.debug('{} {} already in secret archive.'.format(
+                queue_resource_item['resource'], queue_resource_item['id']))
+            queue_resource_item['secret'] = {}
+            return True
+
+        # Try get api client from clients queue
+        api_client_dict = self._get_api_client_dict()
+        if api_client_dict is None:
+            self.add_to_retry_queue(queue_resource_item)
+            sleep(self.config['worker_sleep'])
+            return False
+
+        # Try get resource item dump from cdb
+        try:
+            secret_doc = self._action_resource_item_from_cdb(api_client_dict, queue_resource_item)
+        except Exception as e:
+            self.api_clients_queue.put(api_client_dict)
+            self.add_to_retry_queue(queue_resource_item)
+            logger.error('Error while getting resource item dump from cdb: {}'.format(e.message))
+            self._count('exceptions_count', queue_resource_item)
+            return False
+        if secret_doc is None:
+            return False  # already in retry queue
+        queue_resource_item['secret'] = secret_doc
+        return True
+
+    def _save_to_secret_archive(self, queue_resource_item):
+        # Dump stays in item until saved, it may be already deleted from cdb
+        secret_doc = queue_resource_item['secret']
+        # Storage may compare dateModified itself without reading whole document
+        save_newer = getattr(self.secret_archive_db, 'save_newer', None)
+        if secret_doc:
+            try:
+                if save_newer is not None:
+                    save_newer({'_id': queue_resource_item['id'],
+                                'dateModified': queue_resource_item['dateModified'],
+                                'data': secret_doc})
+                else:
                     archive_item_doc = self.secret_archive_db.get(queue_resource_item['id'])
                     if archive_item_doc is None:
                         self.secret_archive_db.save({'_id': queue_resource_item['id'],
@@ -207,42 +367,258 @@ class ArchiveWorker(Greenlet):
                             '_rev': archive_item_doc.get('_rev'),
                             'data': secret_doc
                         })
+            except Exception as e:
+                self.add_to_retry_queue(queue_resource_item)
+                logger.error('Error while putting resource item to secret couchdb: '
+                             '{}'.format(e.message))
+                self._count('exceptions_count', queue_resource_item)
+                return False
+        del queue_resource_item['secret']
+        if self.dump_spool is not None and self.config['dump_on_delete']:
+            self.dump_spool.remove(queue_resource_item)
+        self._count('dumped_to_secret_archive', queue_resource_item)
+        return True
+
+    def _delete_resource_dump(self, queue_resource_item):
+        # Try get api client from clients queue
+        api_client_dict = self._get_api_client_dict()
+        if api_client_dict is None:
+            self.add_to_retry_queue(queue_resource_item)
+            sleep(self.config['worker_sleep'])
+            return False
+
+        # Try delete resource item from cdb
+        try:
+            secret_doc = self._action_resource_item_from_cdb(api_client_dict, queue_resource_item, 'delete_resource_dump')
+        except Exception as e:
+            self.api_clients_queue.put(api_client_dict)
+            self.add_to_retry_queue(queue_resource_item)
+            logger.error('Error while deleting resource item dump from cdb: {}'.format(e.message))
+            self._count('exceptions_count', queue_resource_item)
+            return False
+        if secret_doc is None:
+            return False  # already in retry queue
+        if self.config['dump_on_delete']:
+            # Response of delete request contains the same dump, it's spooled
+            # to disk since cdb doesn't have it anymore
+            queue_resource_item['secret'] = secret_doc
+            if secret_doc and self.dump_spool is not None:
+                try:
+                    self.dump_spool.add(dict(queue_resource_item, stage='secret_save'))
                 except Exception as e:
-                    self.add_to_retry_queue(queue_resource_item)
-                    logger.error('Error while putting resource item to secret couchdb: '
-                                 '{}'.format(e.message))
-                    self.log_dict['exceptions_count'] += 1
-                    continue
-            self.log_dict['dumped_to_secret_archive'] += 1
+                    logger.critical('Error while spooling dump of {} {}, it is kept only in memory: {}'.format(
+                        queue_resource_item['resource'], queue_resource_item['id'], e))
+                    self._count('exceptions_count', queue_resource_item)
+        return True
 
-            # Try get api client from clients queue
-            api_client_dict = self._get_api_client_dict()
-            if api_client_dict is None:
-                self.add_to_retry_queue(queue_resource_item)
-                sleep(self.config['worker_sleep'])
-                continue
+    def _archive_resource_item(self, queue_resource_item):
+        # Retried item continues from the stage it failed at
+        steps = {
+            'dump_get': self._dump_resource_item,
+            'secret_save': self._save_to_secret_archive,
+            'dump_delete': self._delete_resource_dump
+        }
+        stages = self.stages
+        start = stages.index(queue_resource_item.get('stage', stages[2]))
+        for stage in stages[start:-1]:
+            queue_resource_item['stage'] = stage
+            started = time()
+            passed = steps[stage](queue_resource_item)
+            self._observe(stage, [queue_resource_item], [queue_resource_item] if passed else [], started)
+            if not passed:
+                return
 
-            # Try delete resource item from cdb
-            try:
-                secret_doc = self._action_resource_item_from_cdb(api_client_dict, queue_resource_item, 'delete_resource_dump')
-            except Exception as e:
-                self.api_clients_queue.put(api_client_dict)
-                self.add_to_retry_queue(queue_resource_item)
-                logger.error('Error while deleting resource item dump from cdb: {}'.format(e.message))
-                self.log_dict['exceptions_count'] += 1
-                continue
+        # Delete resource from edge db
+        queue_resource_item['stage'] = stages[-1]
+        self._delete_from_edge(queue_resource_item)
 
-            # Delete resource from edge db
-            try:
-                resource_item_doc = self.db.save({'_id': queue_resource_item['id'], '_rev': resource_item_rev, '_deleted': True})
-            except Exception as e:
+    def _delete_from_edge(self, queue_resource_item):
+        if not self.edge_deletes:
+            self.edge_deletes_started = time()
+        self.edge_deletes.append(queue_resource_item)
+        self._flush_edge_deletes()
+
+    def _flush_edge_deletes(self, force=False):
+        # Tombstone collected edge documents with one _bulk_docs request
+        # when batch is full or oldest item waits longer than interval
+        if not self.edge_deletes:
+            return
+        if not force and len(self.edge_deletes) < self.config['bulk_delete_limit'] and \
+                time() - self.edge_deletes_started < self.config['bulk_delete_interval']:
+            return
+        edge_deletes, self.edge_deletes = self.edge_deletes, []
+        started = time()
+        try:
+            results = self.db.update([{'_id': queue_resource_item['id'],
+                                       '_rev': queue_resource_item['_rev'],
+                                       '_deleted': True}
+                                      for queue_resource_item in edge_deletes])
+        except Exception as e:
+            for queue_resource_item in edge_deletes:
                 self.add_to_retry_queue(queue_resource_item)
-                logger.error('Error while getting resource item from couchdb: '
-                             '{}'.format(e.message))
-                self.log_dict['exceptions_count'] += 1
+            logger.error('Error while deleting resource items from couchdb: '
+                         '{}'.format(e.message))
+            self._count('exceptions_count', edge_deletes[0])
+            self._observe('edge_delete', edge_deletes, [], started)
+            return
+        self._observe('edge_delete', edge_deletes,
+                      [item for item, (success, _, _) in zip(edge_deletes, results) if success], started)
+        for queue_resource_item, (success, _, rev_or_exc) in zip(edge_deletes, results):
+            if success:
+                self._count('archived', queue_resource_item)
+                self._resource_item_done(queue_resource_item)
                 continue
-            self.log_dict['archived'] += 1
+            if isinstance(rev_or_exc, ResourceConflict):
+                # Edge document changed since it was archived, start over
+                del queue_resource_item['stage'], queue_resource_item['_rev']
+            self.add_to_retry_queue(queue_resource_item)
+            logger.error('Error while deleting {} {} from couchdb: {}'.format(
+                queue_resource_item['resource'], queue_resource_item['id'], rev_or_exc))
+            self._count('exceptions_count', queue_resource_item)
+
+    def _run(self):
+        while not self.exit:
+            # Try get batch of items from resource items queue
+            queue_resource_items = self._get_resource_items_batch()
+            if not queue_resource_items:
+                break
+
+            # Retried items continue from the stage they failed at
+            resumed_items = [item for item in queue_resource_items if item.get('stage') in self.stages]
+            queue_resource_items = [item for item in queue_resource_items
+                                    if item.get('stage') not in self.stages]
+
+            # Get resources from edge db
+            started = time()
+            resource_items = self._get_resource_items_from_edge(queue_resource_items)
+            self._observe('edge_get', queue_resource_items, resource_items, started)
+
+            # Put resources to public db
+            if resource_items:
+                edge_items, started = resource_items, time()
+                resource_items = self._save_to_public_archive(edge_items)
+                self._observe('public_save', edge_items, resource_items, started)
+
+            for queue_resource_item in resumed_items + resource_items:
+                self._archive_resource_item(queue_resource_item)
+
+            # Delete archived resources from edge db
+            self._flush_edge_deletes()
+        self._flush_edge_deletes(force=True)
 
     def shutdown(self):
         self.exit = True
         logger.info('Worker complete his job.')
+
+
+class ArchivePipeline(ArchiveWorker):
+
+    """Archive worker running every step as a separate stage.
+
+    Each stage has own bounded queue and pool of greenlets sized by
+    '<stage>_concurrency' option, so slow stage (usually requests to cdb)
+    can be scaled without multiplying connections to couchdb.
+    """
+
+    def __init__(self, *args, **kwargs):
+        ArchiveWorker.__init__(self, *args, **kwargs)
+        self.stage_queues = {}
+        self.stage_pools = {}
+
+    def stages_status(self):
+        return [(stage, self.stage_queues[stage].qsize(), len(self.stage_pools[stage]))
+                for stage in self.stages if stage in self.stage_pools]
+
+    def _get_api_client_dict(self):
+        # Greenlets of cdb stages wait for free client instead of sending
+        # item to retry queue, bridge creates client for each of them
+        try:
+            api_client_dict = self.api_clients_queue.get(timeout=self.config['queue_timeout'])
+        except Empty:
+            return None
+        logger.debug('Got api_client {}'.format(api_client_dict['client'].session.headers['User-Agent']))
+        return api_client_dict
+
+    def _get_stage_items(self, stage, limit=1):
+        stage_queue = self.stage_queues[stage]
+        try:
+            queue_resource_items = [stage_queue.get(timeout=self.config['queue_timeout'])]
+        except Empty:
+            return []
+        while len(queue_resource_items) < limit and not stage_queue.empty():
+            queue_resource_items.append(stage_queue.get_nowait())
+        return queue_resource_items
+
+    def _each_item(self, stage, step):
+        def run_step(queue_resource_items):
+            passed_items = []
+            for queue_resource_item in queue_resource_items:
+                queue_resource_item['stage'] = stage
+                if step(queue_resource_item):
+                    passed_items.append(queue_resource_item)
+            return passed_items
+        return run_step
+
+    def _delete_from_edge_batch(self, queue_resource_items):
+        for queue_resource_item in queue_resource_items:
+            queue_resource_item['stage'] = self.stages[-1]
+            self._delete_from_edge(queue_resource_item)
+        return []
+
+    def _run_stage(self, stage, step, limit):
+        index = self.stages.index(stage)
+        while True:
+            if index == 0:
+                if self.exit:
+                    break
+                queue_resource_items = self._get_resource_items_batch()
+                if not queue_resource_items:
+                    break
+                # Retried items continue from the stage they failed at
+                for queue_resource_item in queue_resource_items:
+                    if queue_resource_item.get('stage') in self.stages:
+                        self.stage_queues[queue_resource_item['stage']].put(queue_resource_item)
+                queue_resource_items = [item for item in queue_resource_items
+                                        if item.get('stage') not in self.stages]
+                if not queue_resource_items:
+                    continue
+            else:
+                queue_resource_items = self._get_stage_items(stage, limit)
+                if not queue_resource_items:
+                    if stage == self.stages[-1]:
+                        self._flush_edge_deletes()
+                    # Previous stage finished and nothing left for this one
+                    if not len(self.stage_pools[self.stages[index - 1]]) and \
+                            self.stage_queues[stage].empty():
+                        break
+                    continue
+            started = time()
+            passed_items = step(queue_resource_items)
+            if stage == self.stages[-1]:
+                continue  # observed on flush
+            self._observe(stage, queue_resource_items, passed_items, started)
+            for queue_resource_item in passed_items:
+                self.stage_queues[self.stages[index + 1]].put(queue_resource_item)
+
+    def _run(self):
+        steps = {
+            'edge_get': (self._get_resource_items_from_edge, None),
+            'public_save': (self._save_to_public_archive, self.config['bulk_get_limit']),
+            'dump_get': (self._each_item('dump_get', self._dump_resource_item), 1),
+            'secret_save': (self._each_item('secret_save', self._save_to_secret_archive), 1),
+            'dump_delete': (self._each_item('dump_delete', self._delete_resource_dump), 1),
+            'edge_delete': (self._delete_from_edge_batch, self.config['bulk_delete_limit'])
+        }
+        # First stage reads from resource items queue
+        self.stage_queues[self.stages[0]] = self.resource_items_queue
+        for stage in self.stages[1:]:
+            self.stage_queues[stage] = Queue(maxsize=self.config['stage_queue_size'])
+        for stage in self.stages:
+            self.stage_pools[stage] = Pool()
+        for stage in self.stages:
+            step, limit = steps[stage]
+            for _ in xrange(max(self.config['{}_concurrency'.format(stage)], 1)):
+                self.stage_pools[stage].spawn(self._run_stage, stage, step, limit)
+        for stage in self.stages:
+            self.stage_pools[stage].join()
+        self._flush_edge_deletes(force=True)
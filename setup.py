@@ -32,7 +32,9 @@ test_requires = bridge_requires + api_requires + [
 entry_points = {
     'openprocurement.archivarius.storages': [
         's3 = openprocurement.archivarius.core.storages.storages:s3',
-        'couchdb = openprocurement.archivarius.core.storages.storages:couch'
+        'couchdb = openprocurement.archivarius.core.storages.storages:couch',
+        'segments = openprocurement.archivarius.core.storages.segments:segments',
+        'filesystem = openprocurement.archivarius.core.storages.filesystem:filesystem'
     ],
     'console_scripts': [
         'archivarius = openprocurement.archivarius.core.bridge:main'
@@ -61,6 +63,6 @@ setup(name='openprocurement.archivarius.core',
       zip_safe=False,
       install_requires=requires,
       tests_require=test_requires,
-      extras_require={'bridge': bridge_requires, 'test': test_requires},
+      extras_require={'bridge': bridge_requires, 'test': test_requires, 'lz4': ['lz4']},
       test_suite="openprocurement.archivarius.core.tests.main.suite",
       entry_points=entry_points)